@@ -1,9 +1,11 @@
 #!/usr/bin/python3
 # Main
 # if __name__ == '__main__':from PyQt5.uic import loadUi
+import time
+_STARTED = time.perf_counter()
 
 from PyQt5.QtWidgets import QMainWindow, QApplication, QFileDialog
-from PyQt5.QtCore import Qt, QThread, pyqtSignal, pyqtSlot
+from PyQt5.QtCore import Qt, QObject, QThread, QTimer, pyqtSignal, pyqtSlot
 from PyQt5.QtGui import  QCursor
 from layout import Ui_MainWindow
 
@@ -14,18 +16,80 @@ import string
 import re
 import traceback
 
-from stemgen import StemGen
+# stemgen imports torch and demucs: it is imported by the WarmUp thread once
+# the window is up, not here.
+
+
+class StartupTimer:
+    # Startup timing breakdown, printed when STEMGEN_STARTUP_TIMING=1 or
+    # --startup-timing is given.
+    enabled = os.environ.get("STEMGEN_STARTUP_TIMING") == "1" or "--startup-timing" in sys.argv
+
+    @classmethod
+    def report(cls, step, seconds):
+        if cls.enabled:
+            print(f"startup: {step} {seconds:.3f}s", file=sys.stderr, flush=True)
+
+
+class WarmUp(QThread):
+    # Imports the engine, probes the device and loads the default model in
+    # the background while the user picks files.
+
+    def __init__(self):
+        super().__init__()
+        self.separator = None
+
+    def run(self):
+        try:
+            start = time.perf_counter()
+            import stemgen
+            StartupTimer.report("import", time.perf_counter() - start)
+
+            start = time.perf_counter()
+            stemgen.get_device()
+            StartupTimer.report("device probe", time.perf_counter() - start)
+
+            start = time.perf_counter()
+            defaults = stemgen.StemGen()
+            separator = defaults.create_separator()
+            separator.load()
+            self.separator = separator
+            StartupTimer.report("model load", time.perf_counter() - start)
+        except Exception:
+            # the run loads the model itself and reports the error then
+            print(traceback.format_exc())
+
+
+class StemGenSignals(QObject):
+    # Re-emits the engine's callbacks as Qt signals. They are emitted from
+    # the engine's worker threads and delivered to the slots in the GUI thread.
+    song_processing = pyqtSignal(str)
+    counts = pyqtSignal(str, int, int, int, int)
+    details_update = pyqtSignal(str)
+
+    def attach(self, stemgen):
+        stemgen.song_processing.connect(self.song_processing.emit)
+        stemgen.counts.connect(self.counts.emit)
+        stemgen.details_update.connect(self.details_update.emit)
 
 
 class StemThread(QThread):
     
-    def __init__(self, tracks):
+    def __init__(self, tracks, warm_up):
         super().__init__()
-        self.stemgen = StemGen()
+        self.signals = StemGenSignals()
+        self.warm_up = warm_up
         self.tracks = tracks
 
     def run(self):
-        self.stemgen.run(self.tracks)
+        # tracks picked before the warm-up is over wait for it here, off the GUI thread
+        self.warm_up.wait()
+        from stemgen import StemGen
+
+        stemgen = StemGen()
+        stemgen.separator = self.warm_up.separator
+        self.signals.attach(stemgen)
+        stemgen.run(self.tracks)
 
 
 # Main Window
@@ -34,6 +98,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
     def __init__(self):
         super(MainWindow, self).__init__()
         self.stem_thread = None
+        self.warm_up = WarmUp()
         
         self.setupUi(self)
 
@@ -49,11 +114,11 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             try:
                 if self.stem_thread is not None:
                     return
-                self.stem_thread = StemThread(tracks)
+                self.stem_thread = StemThread(tracks, self.warm_up)
                 self.stem_thread.finished.connect(self.thread_finished)  
-                self.stem_thread.stemgen.song_processing.connect(self.update_song_processing) 
-                self.stem_thread.stemgen.counts.connect(self.update_counters)
-                self.stem_thread.stemgen.details_update.connect(self.details_update)
+                self.stem_thread.signals.song_processing.connect(self.update_song_processing) 
+                self.stem_thread.signals.counts.connect(self.update_counters)
+                self.stem_thread.signals.details_update.connect(self.details_update)
                 self.stem_thread.start()
             
             except ValueError as e:
@@ -117,6 +182,9 @@ if __name__ == '__main__':
     Screen.setWindowFlags(Qt.FramelessWindowHint)
     Screen.setAttribute(Qt.WA_TranslucentBackground)
     Screen.show()
+    # first event loop iteration after show: the window is on screen
+    QTimer.singleShot(0, lambda: StartupTimer.report("first frame", time.perf_counter() - _STARTED))
+    Screen.warm_up.start()
     sys.exit(app.exec())
 
 
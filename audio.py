@@ -0,0 +1,74 @@
+import io
+
+import torch
+import torchaudio
+import torchaudio.functional
+from demucs.audio import AudioFile, convert_audio_channels, prevent_clip, save_audio
+
+
+SAMPLE_RATE = 44100
+
+# Windowed sinc with a Kaiser window, close to `sox rate -v -s`: long
+# filter, steep transition band ending at 99% of the new Nyquist frequency
+# and a stop band attenuation above 150dB.
+_RESAMPLE_OPTIONS = {
+    "lowpass_filter_width": 64,
+    "rolloff": 0.99,
+    "beta": 14.769656459379492,
+}
+
+
+def resample(wav, sample_rate, target_sample_rate=SAMPLE_RATE):
+    if sample_rate == target_sample_rate:
+        return wav
+    try:
+        return torchaudio.functional.resample(
+            wav, sample_rate, target_sample_rate, resampling_method="sinc_interp_kaiser", **_RESAMPLE_OPTIONS
+        )
+    except ValueError:
+        # torchaudio < 2.1 names the same method "kaiser_window"
+        return torchaudio.functional.resample(
+            wav, sample_rate, target_sample_rate, resampling_method="kaiser_window", **_RESAMPLE_OPTIONS
+        )
+
+
+def load_audio(path, channels=2, target_sample_rate=SAMPLE_RATE):
+    """Decodes WAV/AIFF/FLAC/MP3 to a (channels, samples) float32 tensor at
+    target_sample_rate, without writing anything to disk."""
+    try:
+        wav, sample_rate = torchaudio.load(path)
+    except RuntimeError:
+        # no torchaudio backend for this file, decode through ffmpeg instead
+        audio_file = AudioFile(path)
+        sample_rate = audio_file.samplerate()
+        wav = audio_file.read(streams=0)
+    wav = convert_audio_channels(wav.to(torch.float32), channels)
+    return resample(wav, sample_rate, target_sample_rate)
+
+
+def save_wav(wav, path, sample_rate=SAMPLE_RATE, int24=False, clip="rescale"):
+    # same sample format demucs.separate writes its stems with
+    save_audio(
+        wav,
+        path,
+        samplerate=sample_rate,
+        bitrate=320,
+        clip=clip,
+        as_float=False,
+        bits_per_sample=24 if int24 else 16,
+    )
+
+
+def encode_wav(wav, sample_rate=SAMPLE_RATE, int24=False, clip="rescale"):
+    # The bytes save_wav would write to disk, built in memory: same clipping,
+    # same backend and same sample format.
+    buffer = io.BytesIO()
+    torchaudio.save(
+        buffer,
+        prevent_clip(wav, mode=clip),
+        sample_rate=sample_rate,
+        format="wav",
+        encoding="PCM_S",
+        bits_per_sample=24 if int24 else 16,
+    )
+    return buffer.getvalue()
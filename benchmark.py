@@ -0,0 +1,942 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import math
+import os
+import resource
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def synthetic_track(seconds, samplerate=44100, seed=0):
+    import torch
+
+    # a few tones plus some noise, deterministic for a given seed
+    generator = torch.Generator().manual_seed(seed)
+    t = torch.arange(int(seconds * samplerate)) / samplerate
+    wav = torch.zeros(2, t.shape[0])
+    for harmonic in range(1, 4):
+        frequency = 110.0 * harmonic * (1 + seed % 5)
+        wav += 0.2 / harmonic * torch.sin(2 * math.pi * frequency * t)
+    wav += 0.05 * torch.randn(2, t.shape[0], generator=generator)
+    return wav
+
+
+def tracks_per_hour(count, elapsed):
+    return count * 3600.0 / elapsed if elapsed > 0 else float("inf")
+
+
+def bench_batching(args):
+    import random
+
+    import torch
+    from demucs.apply import apply_model
+
+    from separator import Separator
+
+    separator = Separator(args.model, args.shifts, args.device)
+    model = separator.load()
+    # every track a different length, so that batches mix segments of
+    # tracks of different lengths as a real run does
+    wavs = [synthetic_track(args.seconds + seed * 0.7, separator.samplerate, seed) for seed in range(args.tracks)]
+
+    start = time.perf_counter()
+    single = [separator.separate(wav) for wav in wavs]
+    unbatched = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = []
+    for offset in range(0, len(wavs), args.batch_size):
+        batched.extend(separator.separate_batch(wavs[offset:offset + args.batch_size]))
+    batched_elapsed = time.perf_counter() - start
+
+    # demucs itself on the first track, its shifts drawn from the same seed
+    ref = wavs[0].mean(0)
+    state = random.getstate()
+    random.seed(0)
+    try:
+        with torch.no_grad():
+            reference = apply_model(model, ((wavs[0] - ref.mean()) / ref.std())[None], device=separator.device, shifts=separator.shifts, overlap=separator.overlap, progress=False)[0]
+    finally:
+        random.setstate(state)
+    reference = dict(zip(model.sources, reference * ref.std() + ref.mean()))
+
+    def difference(results, expected):
+        return max(
+            (a[name] - b[name]).abs().max().item()
+            for a, b in zip(results, expected)
+            for name in a
+        )
+
+    batched_difference = difference(batched, single)
+    reference_difference = difference(single[:1], [reference])
+
+    print(f"{args.tracks} tracks of {args.seconds}s to {args.seconds + (args.tracks - 1) * 0.7:g}s, model {args.model}, shifts {args.shifts}, device {args.device}")
+    print(f"batching off:\t{unbatched:.1f}s\t{tracks_per_hour(args.tracks, unbatched):.0f} tracks/hour")
+    print(f"batch size {args.batch_size}:\t{batched_elapsed:.1f}s\t{tracks_per_hour(args.tracks, batched_elapsed):.0f} tracks/hour")
+    failed = False
+    for label, max_difference in (("batched vs single", batched_difference), ("single vs apply_model", reference_difference)):
+        ok = max_difference <= args.tolerance
+        failed = failed or not ok
+        print(f"max difference {label}: {max_difference:.2e}, tolerance {args.tolerance:.0e}: {'ok' if ok else 'FAILED'}")
+    if failed:
+        sys.exit(1)
+
+
+def written_bytes():
+    # (bytes written by this process, bytes written by finished child processes)
+    own = 0
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    own = int(line.split()[1])
+    except OSError:
+        pass
+    return own, resource.getrusage(resource.RUSAGE_CHILDREN).ru_oublock * 512
+
+
+def box_tree(path):
+    # nested box types of moov, and per track: tkhd flags, stsd and sample sizes
+    from ni_stem import _SourceTrack, _findBox, _iterBoxes
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    def walk(start, end, depth):
+        lines = []
+        for boxType, payloadStart, boxEnd in _iterBoxes(data, start, end):
+            lines.append("  " * depth + boxType.decode("latin-1"))
+            if boxType in (b"moov", b"trak", b"mdia", b"minf", b"stbl", b"edts", b"dinf"):
+                lines.extend(walk(payloadStart, boxEnd, depth + 1))
+        return lines
+
+    moov = _findBox(data, [b"moov"])
+    tracks = []
+    for boxType, payloadStart, boxEnd in _iterBoxes(data, *moov):
+        if boxType == b"trak":
+            source = _SourceTrack.__new__(_SourceTrack)
+            source.data, source.trak, source.path = data, (payloadStart, boxEnd), path
+            source.stsz = source._rawBox([b"mdia", b"minf", b"stbl", b"stsz"])
+            tkhd = _findBox(data, [b"tkhd"], payloadStart, boxEnd)
+            tracks.append({
+                "flags": struct.unpack(">I", data[tkhd[0] : tkhd[0] + 4])[0] & 0xFFFFFF,
+                "stsd": source._rawBox([b"mdia", b"minf", b"stbl", b"stsd"]),
+                "sample_sizes": source._readSampleSizes(),
+            })
+    stem = _findBox(data, [b"moov", b"udta", b"stem"])
+    return {
+        "boxes": walk(*moov, 0),
+        "tracks": tracks,
+        "stem": json.loads(data[stem[0] : stem[1]]) if stem else None,
+    }
+
+
+def bench_mux(args):
+    # Exits with 1 when the native stem file differs from the MP4Box one in
+    # anything but the box layout.
+    import shutil
+
+    from ni_stem import StemCreator
+
+    metadata = {"version": 1, "stems": [
+        {"color": "#009E73", "name": "Drums"},
+        {"color": "#D55E00", "name": "Bass"},
+        {"color": "#CC79A7", "name": "Other"},
+        {"color": "#56B4E9", "name": "Vox"},
+    ]}
+    outputs = {}
+    directory = tempfile.mkdtemp(prefix="stemgen-mux-")
+    try:
+        for muxer in ("mp4box", "native"):
+            output = os.path.join(directory, muxer + ".stem.m4a")
+            creator = StemCreator(args.tracks[0], args.tracks[1:], "alac", json.loads(json.dumps(metadata)), muxer=muxer)
+            own, children = written_bytes()
+            start = time.perf_counter()
+            creator.save(output)
+            elapsed = time.perf_counter() - start
+            own_after, children_after = written_bytes()
+            outputs[muxer] = output
+            print(f"{muxer}:\t{elapsed:.2f}s\twritten {(own_after - own) + (children_after - children)} bytes\tfile {os.path.getsize(output)} bytes")
+
+        reference, native = box_tree(outputs["mp4box"]), box_tree(outputs["native"])
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    checks = {
+        "number of tracks": len(reference["tracks"]) == len(native["tracks"]),
+        "tkhd flags": [t["flags"] for t in reference["tracks"]] == [t["flags"] for t in native["tracks"]],
+        "sample descriptions": [t["stsd"] for t in reference["tracks"]] == [t["stsd"] for t in native["tracks"]],
+        "sample sizes": [t["sample_sizes"] for t in reference["tracks"]] == [t["sample_sizes"] for t in native["tracks"]],
+        "stem metadata": reference["stem"] == native["stem"],
+    }
+    for name, same in checks.items():
+        print(f"same {name}:", same)
+    if reference["boxes"] != native["boxes"]:
+        print("box layout differs:")
+        print("  mp4box:", " ".join(line.strip() for line in reference["boxes"]))
+        print("  native:", " ".join(line.strip() for line in native["boxes"]))
+    if not all(checks.values()):
+        sys.exit(1)
+
+
+def bench_muxer(args):
+    # Round trip of the native stem muxer over short synthetic ALAC tracks,
+    # without MP4Box or a model: each track of the stem file must have the
+    # sample description, sample sizes, durations and sample bytes of its
+    # source, stsc/stco must place every sample, the tkhd flags must be
+    # those MP4Box writes, with only the mixdown enabled, and the stem box
+    # must hold the metadata. Exits with 1 when anything differs.
+    import shutil
+
+    from ni_stem import StemMuxer, _SourceTrack
+
+    metadata = {"version": 1, "stems": [
+        {"color": "#009E73", "name": "Drums"},
+        {"color": "#D55E00", "name": "Bass"},
+        {"color": "#CC79A7", "name": "Other"},
+        {"color": "#56B4E9", "name": "Vox"},
+    ]}
+    problems = []
+    directory = tempfile.mkdtemp(prefix="stemgen-muxer-")
+    try:
+        paths = []
+        for index in range(5):
+            paths.append(os.path.join(directory, f"{index}.m4a"))
+            subprocess.run(
+                ["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", f"sine=frequency={220 * (index + 1)}:sample_rate=44100:duration={args.seconds}", "-ac", "2", "-c:a", "alac", paths[-1]],
+                check=True,
+            )
+        output = os.path.join(directory, "muxed.stem.m4a")
+        StemMuxer(paths, metadata).write(output)
+
+        tree = box_tree(output)
+        flags = [track["flags"] for track in tree["tracks"]]
+        if flags != [0x7, 0x6, 0x6, 0x6, 0x6]:
+            problems.append(f"tkhd flags {[hex(flag) for flag in flags]}")
+        if tree["stem"] != metadata:
+            problems.append(f"stem metadata {tree['stem']}")
+        for index, path in enumerate(paths):
+            source, muxed = _SourceTrack(path), _SourceTrack(output, index)
+            try:
+                if muxed.stsd != source.stsd:
+                    problems.append(f"track {index}: stsd differs")
+                if muxed.sampleSizes != source.sampleSizes or muxed.sampleDurations != source.sampleDurations:
+                    problems.append(f"track {index}: stsz or stts differs")
+                elif len(muxed.sampleOffsets) != len(muxed.sampleSizes):
+                    problems.append(f"track {index}: stsc/stco place {len(muxed.sampleOffsets)} of {len(muxed.sampleSizes)} samples")
+                elif b"".join(muxed.read(0, len(muxed.sampleSizes))) != b"".join(source.read(0, len(source.sampleSizes))):
+                    problems.append(f"track {index}: sample data differs")
+            finally:
+                source.close()
+                muxed.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    for problem in problems:
+        print(problem)
+    print(f"native muxer round trip of 5 tracks of {args.seconds}s: {'FAILED' if problems else 'ok'}")
+    if problems:
+        sys.exit(1)
+
+
+def peak_rss():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class _Passthrough:
+    # stands in for the model to check the memory of the streaming machinery alone
+    def separate(self, wav):
+        return {name: wav * 0.25 for name in ("drums", "bass", "other", "vocals")}
+
+
+def bench_streaming(args):
+    # Peak memory of streaming separation over a long input, which should
+    # not grow with the length of the input. Exits with 1 when frames are
+    # lost or the peak grows by more than --max-growth after the first 10%.
+    import torch
+
+    from streaming import StreamingSeparator
+
+    if args.passthrough:
+        separator = _Passthrough()
+    else:
+        from separator import Separator
+
+        separator = Separator(args.model, args.shifts, args.device)
+        separator.load()
+    samplerate = 44100
+    total = int(args.hours * 3600 * samplerate)
+    # the input is generated block by block, as a decoder would hand it over
+    block = synthetic_track(10.0, samplerate)
+    position = 0
+    written = 0
+    checkpoints = []
+
+    def read_into(view):
+        nonlocal position
+        frames = min(view.shape[1], total - position)
+        done = 0
+        while done < frames:
+            offset = (position + done) % block.shape[1]
+            count = min(frames - done, block.shape[1] - offset)
+            view[:, done:done + count] = block[:, offset:offset + count]
+            done += count
+        position += frames
+        return frames
+
+    def write(blocks):
+        nonlocal written
+        written += blocks["mixdown"].shape[1]
+        if len(checkpoints) < 10 and written >= total * (len(checkpoints) + 1) / 10:
+            checkpoints.append(peak_rss())
+
+    start_rss = peak_rss()
+    start = time.perf_counter()
+    with torch.no_grad():
+        StreamingSeparator(separator, args.window, args.overlap).run(read_into, write)
+    elapsed = time.perf_counter() - start
+
+    print(f"{args.hours}h input, window {args.window}s, overlap {args.overlap}s, {'passthrough' if args.passthrough else args.model}")
+    print(f"frames in {total}, frames out {written}: {'ok' if written == total else 'MISMATCH'}")
+    print(f"elapsed {elapsed:.1f}s, {args.hours * 3600 / elapsed:.1f} audio seconds per second")
+    print(f"peak RSS before: {start_rss} kB")
+    for index, rss in enumerate(checkpoints):
+        print(f"peak RSS after {(index + 1) * 10}%: {rss} kB")
+    growth = checkpoints[-1] - checkpoints[0] if checkpoints else 0
+    print(f"growth from 10% to 100%: {growth} kB, limit {args.max_growth} kB: {'ok' if growth <= args.max_growth else 'FAILED'}")
+    if written != total or growth > args.max_growth:
+        sys.exit(1)
+
+
+def bench_cache(args):
+    # Round trip of stems through the separation cache, with peaks past
+    # full scale as separations of loud masters have. Exits with 1 when a
+    # sample comes back further off than the 24-bit step of its stem.
+    import torch
+
+    from cache import SeparationCache
+
+    wav = synthetic_track(args.seconds)
+    sources = {
+        "drums": wav,
+        "bass": wav * 4.0,
+        "other": torch.clamp(wav * 10.0, -1.3, 1.2),
+        "vocals": torch.full_like(wav, 1.0),
+    }
+    with tempfile.TemporaryDirectory(prefix="stemgen-cache-") as directory:
+        cache = SeparationCache(directory)
+        cache.put("entry", sources)
+        size = os.path.getsize(cache._path("entry"))
+        loaded = cache.get("entry")
+    if loaded is None:
+        print("entry could not be read back: FAILED")
+        sys.exit(1)
+    worst = 0.0
+    for name, source in sources.items():
+        error = (loaded[name] - source).abs().max().item()
+        step = max(1.0, source.abs().max().item()) / 2 ** 23
+        print(f"{name}: peak {source.abs().max().item():.2f}, max error {error:.2e} ({error / step:.2f} steps)")
+        worst = max(worst, error / step)
+    print(f"entry {size // 1024} kB for {args.seconds}s, {'ok' if worst <= 1.0 else 'FAILED'}")
+    if worst > 1.0:
+        sys.exit(1)
+
+
+class _RecordingEngine:
+    # stands in for StemGen in the distributed check: "stems" a track by
+    # appending it to a log shared by all workers, if its lease is still ours
+    def __init__(self, log, seconds):
+        from stemgen import Signal
+
+        self.log = log
+        self.seconds = seconds
+        self.track_result = Signal()
+        self.may_publish = None
+        self.errors = []
+
+
+    def clear_results(self):
+        self.errors = []
+
+
+    def cancel(self, track):
+        pass
+
+
+    def run(self, tracks):
+        for track in tracks:
+            time.sleep(self.seconds)
+            if self.may_publish is not None and not self.may_publish(track):
+                continue
+            with open(self.log, "a") as f:
+                f.write(track + "\n")
+            self.track_result.emit({"track": track, "status": "processed"})
+
+
+def _distributed_worker(directory, log, lease, seconds):
+    from distributed import DistributedWorker, SharedQueue
+
+    worker = DistributedWorker(_RecordingEngine(log, seconds), SharedQueue(directory, lease), poll_interval=lease / 4)
+    with open(os.devnull, "w") as worker.output:
+        worker.run()
+
+
+def bench_distributed(args):
+    # N local workers on one job directory, one of whose tracks holds the
+    # expired lease of a dead worker: every track must end up done and be
+    # stemmed exactly once. Exits with 1 otherwise.
+    import multiprocessing
+    import shutil
+    from collections import Counter
+
+    from distributed import SharedQueue
+
+    directory = tempfile.mkdtemp(prefix="stemgen-distributed-")
+    try:
+        shared_queue = SharedQueue(os.path.join(directory, "queue"), args.lease)
+        tracks = [f"/music/track {index}.flac" for index in range(args.tracks)]
+        shared_queue.enqueue(tracks)
+        dead_lease = shared_queue._path("leases", shared_queue.track_ids()[0])
+        shared_queue._create_lease(dead_lease, "dead:0")
+        stale = time.time() - 2 * args.lease
+        os.utime(dead_lease, (stale, stale))
+
+        log = os.path.join(directory, "stemmed.log")
+        context = multiprocessing.get_context("spawn")
+        workers = [
+            context.Process(target=_distributed_worker, args=(shared_queue.directory, log, args.lease, args.seconds))
+            for _ in range(args.workers)
+        ]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        problems = [f"worker exit code {worker.exitcode}" for worker in workers if worker.exitcode != 0]
+        try:
+            with open(log) as f:
+                stemmed = Counter(line.rstrip("\n") for line in f)
+        except FileNotFoundError:
+            stemmed = Counter()
+        for track in tracks:
+            if stemmed[track] != 1:
+                problems.append(f"{track}: stemmed {stemmed[track]} time(s)")
+        status = shared_queue.status()
+        if status["done"] != len(tracks):
+            problems.append(f"{status['done']} of {len(tracks)} tracks done")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    for problem in problems:
+        print(problem)
+    print(f"{args.workers} workers, {args.tracks} tracks, one expired lease, {elapsed:.1f}s: {'FAILED' if problems else 'ok'}")
+    if problems:
+        sys.exit(1)
+
+
+def bench_memory(args):
+    # Measures what memory.MemoryGovernor estimates: the resident model and
+    # the peak of separating tracks of a few durations with a few segment
+    # lengths, next to the governor's estimate. Peaks are counted from before
+    # the model was loaded. A whole separation is run for each pair, so keep
+    # the durations short.
+    import memory
+    from probe import MediaInfo
+    from separator import Separator
+
+    baseline = memory.peak_rss()
+    separator = Separator(args.model, args.shifts, args.device)
+    separator.load()
+    model_bytes = memory.peak_rss() - baseline
+    governor = memory.MemoryGovernor(budget=0, padded_segments=memory.pads_segments(args.model))
+    governor.max_segment = separator.max_segment
+    segments = [segment for segment in args.segments if segment <= governor.max_segment]
+    print(f"model {args.model}, shifts {args.shifts}, device {args.device}")
+    print(f"resident model: {model_bytes // 1024 ** 2} MB (MODEL_BYTES {memory.MODEL_BYTES // 1024 ** 2} MB)")
+    print("duration\tsegment\tpeak MB\testimated MB")
+    slopes = []
+    for duration in args.durations:
+        wav = synthetic_track(duration, separator.samplerate)
+        media = MediaInfo(sample_rate=separator.samplerate, channels=2, duration=duration)
+        peaks = []
+        for segment in segments:
+            memory.reset_peak_rss()
+            separator.separate(wav, segment)
+            peak = memory.peak_rss() - baseline
+            peaks.append(peak)
+            # the estimate without the track the pipeline decodes or saves alongside
+            estimate = governor.peak(media, segment) - memory.track_bytes(media)[1]
+            print(f"{duration:.0f}s\t{segment:.2f}s\t{peak // 1024 ** 2}\t{estimate // 1024 ** 2}")
+        if len(segments) > 1:
+            slopes.append((peaks[-1] - peaks[0]) / (segments[-1] - segments[0]))
+    if slopes:
+        print(f"activations per second of segment: {sum(slopes) / len(slopes) / 1024 ** 2:.0f} MB (SEGMENT_BYTES_PER_SECOND {memory.SEGMENT_BYTES_PER_SECOND // 1024 ** 2} MB)")
+
+
+def bench_budget(args):
+    # StemGen.run() end to end under a memory budget: the budget is set to
+    # what one streaming window needs, so the short track is separated in
+    # memory and the long one only fits streamed. Exits with 1 unless both
+    # are processed and only the long one was streamed.
+    import shutil
+    from contextlib import redirect_stdout
+
+    import memory
+    from probe import MediaInfo
+    from stemgen import StemGen
+
+    directory = tempfile.mkdtemp(prefix="stemgen-budget-")
+    try:
+        short, long = synthetic_corpus(directory, [".flac"], [44100], [16], [args.window, args.window * 6])
+        stemgen = StemGen()
+        stemgen.model_name = args.model
+        stemgen.model_shifts = str(args.shifts)
+        stemgen.use_journal = False
+        stemgen.overwrite_existing = True
+        stemgen.streaming_window = args.window
+        stemgen.streaming_overlap = 1.0
+        window = stemgen.streaming_window + 2 * stemgen.streaming_overlap
+        governor = stemgen.memory_governor_for_model()
+        stemgen.memory_budget = governor.peak(MediaInfo(sample_rate=44100, channels=2, duration=window))
+        streamed = []
+        split_streaming = stemgen.split_streaming
+
+        def record_streamed(job):
+            streamed.append(job.track)
+            split_streaming(job)
+        stemgen.split_streaming = record_streamed
+
+        with redirect_stdout(sys.stderr):
+            stemgen.run([short["path"], long["path"]])
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    ok = stemgen.processed_track_count == 2 and streamed == [long["path"]]
+    print(f"budget {stemgen.memory_budget // 1024 ** 2} MB (estimate of one {window:g}s window), MODEL_BYTES {memory.MODEL_BYTES // 1024 ** 2} MB")
+    print(f"processed {stemgen.processed_track_count} of 2, streamed: {[os.path.basename(path) for path in streamed]}: {'ok' if ok else 'FAILED'}")
+    if not ok:
+        sys.exit(1)
+
+
+def sdr(reference, estimate):
+    # signal to distortion ratio in dB, the per-track SDR of the MDX challenge
+    delta = 1e-7
+    signal = (reference ** 2).sum().item()
+    distortion = ((reference - estimate) ** 2).sum().item()
+    return 10 * math.log10((signal + delta) / (distortion + delta))
+
+
+def compare_precision(args, precision):
+    # A reduced precision against fp32 on the CPU: speed, and SDR of its
+    # stems taking the fp32 stems as reference. Real tracks make a better
+    # reference set than the synthetic ones used when none are given.
+    from audio import load_audio
+    from separator import Separator, cpu_supports_bf16
+
+    start = time.perf_counter()
+    fp32 = Separator(args.model, args.shifts, "cpu")
+    fp32.load()
+    fp32_load = time.perf_counter() - start
+    start = time.perf_counter()
+    reduced = Separator(args.model, args.shifts, "cpu", precision=precision)
+    reduced.load()
+    reduced_load = time.perf_counter() - start
+    if reduced.precision != precision:
+        print(f"{precision} is not available on this machine")
+        sys.exit(2)
+    if args.tracks:
+        tracks = [(os.path.basename(path), load_audio(path)) for path in args.tracks]
+    else:
+        tracks = [(f"synthetic-{seed}", synthetic_track(args.seconds, fp32.samplerate, seed)) for seed in range(3)]
+    # first passes allocate and pick kernels, keep them out of the timings
+    fp32.separate(tracks[0][1][:, :fp32.samplerate])
+    reduced.separate(tracks[0][1][:, :fp32.samplerate])
+
+    print(f"model {args.model}, shifts {args.shifts}, {torch_threads()} threads, native bf16: {'yes' if cpu_supports_bf16() else 'no'}")
+    print(f"load: fp32 {fp32_load:.1f}s, {precision} {reduced_load:.1f}s")
+    results = []
+    for name, wav in tracks:
+        start = time.perf_counter()
+        reference = fp32.separate(wav)
+        fp32_elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        estimate = reduced.separate(wav)
+        reduced_elapsed = time.perf_counter() - start
+        scores = {source: sdr(reference[source], estimate[source]) for source in reference}
+        duration = wav.shape[-1] / fp32.samplerate
+        results.append({"track": name, "duration": duration, "fp32_seconds": fp32_elapsed, f"{precision}_seconds": reduced_elapsed, "sdr": scores})
+        print(f"{name}: fp32 {fp32_elapsed:.1f}s, {precision} {reduced_elapsed:.1f}s, SDR " + ", ".join(f"{source} {score:.1f}dB" for source, score in scores.items()))
+
+    audio = sum(result["duration"] for result in results)
+    fp32_total = sum(result["fp32_seconds"] for result in results)
+    reduced_total = sum(result[f"{precision}_seconds"] for result in results)
+    print(f"fp32: {audio / fp32_total:.1f} audio seconds per second")
+    print(f"{precision}: {audio / reduced_total:.1f} audio seconds per second, {fp32_total / reduced_total:.2f}x")
+    for source in results[0]["sdr"]:
+        print(f"mean SDR {source}: {sum(result['sdr'][source] for result in results) / len(results):.1f}dB")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"model": args.model, "shifts": args.shifts, "precision": precision, "threads": torch_threads(), "tracks": results}, f, indent=2)
+
+
+def bench_quantized(args):
+    compare_precision(args, "int8")
+
+
+def bench_bf16(args):
+    compare_precision(args, "bf16")
+
+
+def bench_onnx(args):
+    # Parity and speed of the ONNX Runtime backend against torch. Exits with
+    # 1 when a stem differs by more than --tolerance, so it can gate a
+    # deployment or an upgrade of torch, demucs or onnxruntime.
+    from audio import load_audio
+    from separator import Separator
+
+    reference = Separator(args.model, args.shifts, "cpu")
+    reference.load()
+    start = time.perf_counter()
+    onnx = Separator(args.model, args.shifts, "cpu", backend="onnx")
+    onnx.load()
+    onnx_load = time.perf_counter() - start
+    if args.tracks:
+        tracks = [(os.path.basename(path), load_audio(path)) for path in args.tracks]
+    else:
+        tracks = [(f"synthetic-{seed}", synthetic_track(args.seconds, reference.samplerate, seed)) for seed in range(2)]
+    reference.separate(tracks[0][1][:, :reference.samplerate])
+    onnx.separate(tracks[0][1][:, :reference.samplerate])
+
+    print(f"model {args.model}, shifts {args.shifts}, {torch_threads()} threads")
+    print(f"onnx load: {onnx_load:.1f}s (exported once, then read from the model cache)")
+    audio = torch_total = onnx_total = 0.0
+    worst = 0.0
+    for name, wav in tracks:
+        start = time.perf_counter()
+        expected = reference.separate(wav)
+        torch_elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        actual = onnx.separate(wav)
+        onnx_elapsed = time.perf_counter() - start
+        differences = {source: (expected[source] - actual[source]).abs().max().item() for source in expected}
+        worst = max(worst, *differences.values())
+        audio += wav.shape[-1] / reference.samplerate
+        torch_total += torch_elapsed
+        onnx_total += onnx_elapsed
+        print(
+            f"{name}: torch {torch_elapsed:.1f}s, onnx {onnx_elapsed:.1f}s, "
+            + ", ".join(f"{source} max diff {difference:.2e} SDR {sdr(expected[source], actual[source]):.1f}dB" for source, difference in differences.items())
+        )
+    print(f"torch: {audio / torch_total:.1f} audio seconds per second")
+    print(f"onnx: {audio / onnx_total:.1f} audio seconds per second, {torch_total / onnx_total:.2f}x")
+    print(f"max difference {worst:.2e}, tolerance {args.tolerance:.0e}: {'ok' if worst <= args.tolerance else 'FAILED'}")
+    if worst > args.tolerance:
+        sys.exit(1)
+
+
+def torch_threads():
+    import torch
+
+    return torch.get_num_threads()
+
+
+# ffmpeg codec and sample format for each corpus format and bit depth; MP3
+# has no bit depth and no 96kHz
+_CORPUS_CODECS = {
+    ".wav": {16: ["-c:a", "pcm_s16le"], 24: ["-c:a", "pcm_s24le"], 32: ["-c:a", "pcm_s32le"]},
+    ".aiff": {16: ["-c:a", "pcm_s16be"], 24: ["-c:a", "pcm_s24be"], 32: ["-c:a", "pcm_s32be"]},
+    ".flac": {
+        16: ["-c:a", "flac", "-sample_fmt", "s16"],
+        24: ["-c:a", "flac", "-sample_fmt", "s32", "-bits_per_raw_sample", "24"],
+        32: ["-c:a", "flac", "-sample_fmt", "s32", "-strict", "experimental"],
+    },
+    ".mp3": {None: ["-c:a", "libmp3lame", "-b:a", "320k"]},
+}
+
+
+def synthetic_corpus(directory, formats, sample_rates, bit_depths, durations):
+    # Deterministic tones plus noise in every requested format, sample rate,
+    # bit depth and duration. Combinations a format does not support are left out.
+    import numpy as np
+
+    corpus = []
+    for seconds in durations:
+        for sample_rate in sample_rates:
+            t = np.arange(int(seconds * sample_rate)) / sample_rate
+            noise = np.random.default_rng(0).standard_normal((t.shape[0], 2))
+            wav = sum(0.2 / harmonic * np.sin(2 * np.pi * 110.0 * harmonic * t) for harmonic in range(1, 4))
+            pcm = (np.stack([wav, wav], axis=1) + 0.05 * noise).astype("<f4").tobytes()
+            for extension in formats:
+                if extension == ".mp3" and sample_rate > 48000:
+                    continue
+                depths = [None] if extension == ".mp3" else bit_depths
+                for bit_depth in depths:
+                    name = f"{extension[1:]}-{sample_rate}hz-{bit_depth or 'lossy'}bit-{seconds:g}s{extension}"
+                    path = os.path.join(directory, name)
+                    result = subprocess.run(
+                        ["ffmpeg", "-v", "error", "-y", "-f", "f32le", "-ar", str(sample_rate), "-ac", "2", "-i", "pipe:0"]
+                        + _CORPUS_CODECS[extension][bit_depth]
+                        + [path],
+                        input=pcm,
+                        stderr=subprocess.PIPE,
+                    )
+                    if result.returncode != 0:
+                        print(f"skipping {name}: {result.stderr.decode(errors='replace').strip()}", file=sys.stderr)
+                        continue
+                    corpus.append({
+                        "name": name,
+                        "path": path,
+                        "format": extension[1:],
+                        "sample_rate": sample_rate,
+                        "bit_depth": bit_depth,
+                        "seconds": seconds,
+                    })
+    return corpus
+
+
+def bench_stages(args):
+    import shutil
+    from contextlib import redirect_stdout
+
+    from profiling import StageProfiler
+    from stemgen import StemGen
+
+    directory = tempfile.mkdtemp(prefix="stemgen-corpus-")
+    try:
+        corpus = synthetic_corpus(directory, args.formats, args.sample_rates, args.bit_depths, args.durations)
+
+        stemgen = StemGen()
+        stemgen.model_name = args.model
+        stemgen.model_shifts = str(args.shifts)
+        stemgen.in_process_decode = not args.sox
+        stemgen.stream_encode = not args.sox
+        stemgen.use_journal = False
+        stemgen.overwrite_existing = True
+        # one track at a time, so the CPU time of the whole process, torch's
+        # threads included, belongs to the step being measured
+        stemgen.profiler = StageProfiler(process_cpu=True)
+
+        results = {"model": args.model, "shifts": args.shifts, "sox": args.sox, "inputs": []}
+        for entry in corpus:
+            # one track per run, so that stages of different tracks do not overlap
+            stemgen.clear_results()
+            stemgen.profiler.reset()
+            start = time.perf_counter()
+            with redirect_stdout(sys.stderr):
+                stemgen.run([entry["path"]])
+            elapsed = time.perf_counter() - start
+            steps = stemgen.profiler.reset()
+            ok = stemgen.processed_track_count == 1
+            results["inputs"].append(dict(entry, path=None, ok=ok, wall=elapsed, steps=steps))
+            print(f"{entry['name']}:\t{elapsed:.2f}s\t" + ("  ".join(f"{step} {measures['wall']:.2f}s" for step, measures in steps.items()) if ok else "FAILED"))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {args.output}")
+
+
+def bench_presets(args):
+    # End-to-end speed of each preset, the figure operators use to predict
+    # how long a batch takes: all tracks in one run through the normal
+    # pipeline, model load excluded since a run or daemon loads it once.
+    # Results are merged into the file `stemgen --list-presets` reads.
+    import platform
+    import shutil
+    from contextlib import redirect_stdout
+
+    from stemgen import PRESETS, StemGen, preset_speeds_path
+
+    directory = tempfile.mkdtemp(prefix="stemgen-presets-")
+    try:
+        if args.tracks:
+            # copies, so that the stems are not written next to the originals
+            tracks = []
+            for track in args.tracks:
+                tracks.append(os.path.join(directory, os.path.basename(track)))
+                shutil.copyfile(track, tracks[-1])
+            from probe import MediaProbe
+
+            seconds = sum(MediaProbe().probe(track).duration for track in tracks)
+        else:
+            corpus = synthetic_corpus(directory, [".flac"], [44100], [24], args.durations)
+            tracks = [entry["path"] for entry in corpus]
+            seconds = sum(entry["seconds"] for entry in corpus)
+
+        output = args.output or preset_speeds_path()
+        try:
+            with open(output) as f:
+                results = json.load(f)
+        except (OSError, ValueError):
+            results = {}
+        results.update({"machine": platform.machine(), "processor": platform.processor(), "cpus": os.cpu_count(), "audio_seconds": seconds})
+        results.setdefault("presets", {})
+        for name in args.presets:
+            stemgen = StemGen()
+            stemgen.apply_preset(name)
+            stemgen.use_journal = False
+            stemgen.overwrite_existing = True
+            with redirect_stdout(sys.stderr):
+                stemgen.separator = stemgen.create_separator()
+                stemgen.separator.load()
+                start = time.perf_counter()
+                stemgen.run(tracks)
+            elapsed = time.perf_counter() - start
+            if stemgen.processed_track_count != len(tracks):
+                print(f"{name}: {stemgen.failed_track_count} track(s) failed, not recorded")
+                continue
+            results["presets"][name] = {
+                "audio_seconds_per_second": seconds / elapsed,
+                "wall": elapsed,
+                "tracks": len(tracks),
+                "precision": stemgen.separator.precision,
+                "settings": PRESETS[name],
+            }
+            print(f"{name}: {seconds / elapsed:.2f} audio seconds per second ({len(tracks)} tracks, {seconds:.0f}s of audio in {elapsed:.1f}s)")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"saved to {output}")
+
+
+def bench_compare(args):
+    # Flags steps whose wall or CPU time grew by more than the threshold,
+    # ignoring steps too short to be measured reliably.
+    with open(args.baseline) as f:
+        baseline = {entry["name"]: entry for entry in json.load(f)["inputs"]}
+    with open(args.current) as f:
+        current = {entry["name"]: entry for entry in json.load(f)["inputs"]}
+
+    regressions = 0
+    for name in sorted(set(baseline) & set(current)):
+        before, after = baseline[name], current[name]
+        if before["ok"] and not after["ok"]:
+            print(f"REGRESSION {name}: failed")
+            regressions += 1
+            continue
+        for step in sorted(set(before["steps"]) & set(after["steps"])):
+            for measure in ("wall", "cpu"):
+                old, new = before["steps"][step][measure], after["steps"][step][measure]
+                if max(old, new) < args.min_seconds:
+                    continue
+                change = (new - old) / old if old > 0 else float("inf")
+                if change > args.threshold:
+                    print(f"REGRESSION {name} {step} {measure}: {old:.3f}s -> {new:.3f}s (+{change:.0%})")
+                    regressions += 1
+                elif change < -args.threshold:
+                    print(f"improved   {name} {step} {measure}: {old:.3f}s -> {new:.3f}s ({change:.0%})")
+    for name in sorted(set(baseline) ^ set(current)):
+        print(f"only in {'baseline' if name in baseline else 'current'}: {name}")
+    print(f"{regressions} regression(s)")
+    if regressions:
+        sys.exit(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="StemGen benchmarks")
+    parser.add_argument("-n", "--model", default="htdemucs")
+    parser.add_argument("--shifts", type=int, default=1)
+    parser.add_argument("-d", "--device", default="cpu")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    batching = subparsers.add_parser("batching", help="tracks per hour with cross-track batching on and off")
+    batching.add_argument("--tracks", type=int, default=16)
+    batching.add_argument("--seconds", type=float, default=20.0)
+    batching.add_argument("--batch-size", type=int, default=8)
+    batching.add_argument("--tolerance", type=float, default=1e-4, help="largest sample difference accepted between batched, single and demucs apply_model")
+    batching.set_defaults(func=bench_batching)
+
+    mux = subparsers.add_parser("mux", help="native stem muxer against MP4Box: time, bytes written and structure")
+    mux.add_argument("tracks", nargs=5, help="mixdown and four stem .m4a files")
+    mux.set_defaults(func=bench_mux)
+
+    muxer = subparsers.add_parser("muxer", help="round trip of the native stem muxer: flags, sample tables and stem metadata")
+    muxer.add_argument("--seconds", type=float, default=3.0)
+    muxer.set_defaults(func=bench_muxer)
+
+    streaming = subparsers.add_parser("streaming", help="peak memory of windowed separation over a long synthetic input")
+    streaming.add_argument("--hours", type=float, default=3.0)
+    streaming.add_argument("--window", type=float, default=60.0)
+    streaming.add_argument("--overlap", type=float, default=5.0)
+    streaming.add_argument("--passthrough", action="store_true", help="skip the model, measure the windowing only")
+    streaming.add_argument("--max-growth", type=int, default=64 * 1024, help="peak RSS growth in kB accepted from 10%% to 100%% of the input")
+    streaming.set_defaults(func=bench_streaming)
+
+    cache = subparsers.add_parser("cache", help="round trip of stems through the separation cache, including peaks above full scale")
+    cache.add_argument("--seconds", type=float, default=10.0)
+    cache.set_defaults(func=bench_cache)
+
+    distributed = subparsers.add_parser("distributed", help="local workers on one job directory with an expired lease: each track stemmed exactly once")
+    distributed.add_argument("--workers", type=int, default=4)
+    distributed.add_argument("--tracks", type=int, default=20)
+    distributed.add_argument("--lease", type=float, default=2.0, help="lease seconds")
+    distributed.add_argument("--seconds", type=float, default=0.2, help="time each track takes")
+    distributed.set_defaults(func=bench_distributed)
+
+    stages = subparsers.add_parser("stages", help="wall, CPU and I/O per stage over a synthetic corpus, saved as JSON")
+    stages.add_argument("--formats", type=lambda value: ["." + f for f in value.split(",")], default=[".wav", ".aiff", ".flac", ".mp3"], help="comma separated, e.g. wav,flac")
+    stages.add_argument("--sample-rates", type=lambda value: [int(v) for v in value.split(",")], default=[44100, 48000, 96000])
+    stages.add_argument("--bit-depths", type=lambda value: [int(v) for v in value.split(",")], default=[16, 24, 32])
+    stages.add_argument("--durations", type=lambda value: [float(v) for v in value.split(",")], default=[10.0, 60.0], help="seconds, comma separated")
+    stages.add_argument("--sox", action="store_true", help="convert with sox and write stem wavs, as before in-process decoding")
+    stages.add_argument("-o", "--output", default="stages.json")
+    stages.set_defaults(func=bench_stages)
+
+    memory = subparsers.add_parser("memory", help="peak memory of separation by duration and segment length, against the governor's estimate")
+    memory.add_argument("--durations", type=lambda value: [float(v) for v in value.split(",")], default=[30.0, 120.0], help="seconds, comma separated")
+    memory.add_argument("--segments", type=lambda value: [float(v) for v in value.split(",")], default=[1.95, 3.9, 7.8], help="seconds, comma separated")
+    memory.set_defaults(func=bench_memory)
+
+    budget = subparsers.add_parser("budget", help="a run under a memory budget that only fits the long track streamed")
+    budget.add_argument("--window", type=float, default=10.0, help="streaming window in seconds; the tracks are 1 and 6 windows long")
+    budget.set_defaults(func=bench_budget)
+
+    quantized = subparsers.add_parser("quantized", help="int8 against fp32 on the CPU: speed and SDR of the int8 stems")
+    quantized.add_argument("tracks", nargs="*", help="reference tracks (default: synthetic)")
+    quantized.add_argument("--seconds", type=float, default=30.0, help="length of the synthetic tracks")
+    quantized.add_argument("-o", "--output", help="save the results as JSON")
+    quantized.set_defaults(func=bench_quantized)
+
+    bf16 = subparsers.add_parser("bf16", help="bfloat16 autocast against fp32 on the CPU: speed and SDR of the bf16 stems")
+    bf16.add_argument("tracks", nargs="*", help="reference tracks (default: synthetic)")
+    bf16.add_argument("--seconds", type=float, default=30.0, help="length of the synthetic tracks")
+    bf16.add_argument("-o", "--output", help="save the results as JSON")
+    bf16.set_defaults(func=bench_bf16)
+
+    onnx = subparsers.add_parser("onnx", help="parity and speed of the ONNX Runtime backend against torch")
+    onnx.add_argument("tracks", nargs="*", help="reference tracks (default: synthetic)")
+    onnx.add_argument("--seconds", type=float, default=20.0, help="length of the synthetic tracks")
+    onnx.add_argument("--tolerance", type=float, default=1e-3, help="largest sample difference accepted")
+    onnx.set_defaults(func=bench_onnx)
+
+    presets = subparsers.add_parser("presets", help="end-to-end audio seconds per second of each preset, saved for stemgen --list-presets")
+    presets.add_argument("tracks", nargs="*", help="reference tracks (default: synthetic)")
+    presets.add_argument("--presets", type=lambda value: value.split(","), default=["draft", "standard", "max"], help="comma separated")
+    presets.add_argument("--durations", type=lambda value: [float(v) for v in value.split(",")], default=[180.0, 240.0, 300.0], help="seconds of the synthetic tracks, comma separated")
+    presets.add_argument("-o", "--output", help="results file (default: the one stemgen --list-presets reads)")
+    presets.set_defaults(func=bench_presets)
+
+    compare = subparsers.add_parser("compare", help="flag per-stage regressions between two 'stages' results")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    compare.add_argument("--threshold", type=float, default=0.10, help="relative slowdown reported as a regression")
+    compare.add_argument("--min-seconds", type=float, default=0.05, help="ignore steps shorter than this")
+    compare.set_defaults(func=bench_compare)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import hashlib
+import os
+import threading
+
+import numpy as np
+import torch
+
+from paths import cache_path
+
+
+def default_cache_directory():
+    return cache_path("separations")
+
+
+def separation_key(audio, model_name, model_shifts, precision="fp32", overlap=0.25, segment=None):
+    # The same recording decoded to the same 44.1kHz samples gets the same
+    # key, whatever the file it came from.
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(audio.numpy(), dtype=np.float32).tobytes())
+    digest.update(f"{model_name}:{model_shifts}".encode("utf-8"))
+    # settings at their defaults leave the key as it was before they existed
+    if precision != "fp32":
+        digest.update(f":{precision}".encode("utf-8"))
+    if overlap != 0.25 or segment is not None:
+        digest.update(f":{overlap}:{segment}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+_SCALE = ".scale"
+
+
+def _pack(source):
+    # float stem -> (24-bit integers packed in 3 bytes, scale). Stems can go
+    # past full scale, so they are divided by their peak first when it is
+    # above 1.0; the scale restores them.
+    scale = max(1.0, source.abs().max().item())
+    samples = torch.clamp(torch.round(source / scale * 2 ** 23), -2 ** 23, 2 ** 23 - 1)
+    samples = samples.to(torch.int32).numpy().astype("<i4")
+    return samples.view(np.uint8).reshape(samples.shape + (4,))[..., :3], np.float32(scale)
+
+
+def _unpack(packed, scale):
+    samples = np.zeros(packed.shape[:-1] + (4,), dtype=np.uint8)
+    samples[..., :3] = packed
+    # sign extend from 24 to 32 bits
+    samples[..., 3] = np.where(packed[..., 2] & 0x80, 0xFF, 0)
+    return torch.from_numpy(samples.view("<i4")[..., 0].astype(np.float32) * (float(scale) / 2 ** 23))
+
+
+def save_stems(path, sources):
+    # written to a temporary file first so a crash never leaves half an entry
+    temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    arrays = {}
+    for name, source in sources.items():
+        arrays[name], arrays[name + _SCALE] = _pack(source)
+    with open(temporary, "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(temporary, path)
+
+
+def load_stems(path):
+    with np.load(path) as entry:
+        return {
+            name: _unpack(entry[name], entry[name + _SCALE])
+            for name in entry.files
+            if not name.endswith(_SCALE)
+        }
+
+
+class SeparationCache:
+    """Separated stems stored on disk by content key, with LRU eviction.
+
+    Each entry is a compressed .npz file holding the four stems as packed
+    24-bit samples, each with the scale it was divided by. Reading an entry
+    refreshes its mtime; when the cache grows above max_bytes the entries
+    with the oldest mtime are removed.
+    """
+
+    def __init__(self, directory=None, max_bytes=20 * 1024 ** 3):
+        self.directory = directory or default_cache_directory()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            sources = load_stems(path)
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return sources
+
+
+    def put(self, key, sources):
+        save_stems(self._path(key), sources)
+        self.evict()
+
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.directory):
+                if not name.endswith(".npz"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+                total += stat.st_size
+            entries.sort()
+            while total > self.max_bytes and entries:
+                _, size, name = entries.pop(0)
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+                total -= size
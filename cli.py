@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# Headless entry point: stems a batch of files without the GUI and prints one
+# JSON object per track on stdout. Progress messages go to stderr.
+import argparse
+import contextlib
+import glob
+import json
+import os
+import signal
+import sys
+import threading
+
+from stemgen import PRESETS, StemGen, preset_speeds
+from telemetry import Telemetry
+from watch import WatchDaemon
+
+
+def collect_tracks(paths, supported_files, recursive=False):
+    # Files are taken as given, directories contribute the supported files
+    # they contain and anything else is expanded as a glob pattern.
+    tracks = []
+    for path in paths:
+        if os.path.isdir(path):
+            if recursive:
+                names = [os.path.join(root, name) for root, _, files in os.walk(path) for name in files]
+            else:
+                names = [os.path.join(path, name) for name in os.listdir(path)]
+            tracks.extend(
+                sorted(
+                    name
+                    for name in names
+                    if os.path.isfile(name) and os.path.splitext(name)[1] in supported_files and not name.endswith(".stem.m4a")
+                )
+            )
+        elif os.path.exists(path):
+            tracks.append(path)
+        else:
+            matches = sorted(glob.glob(path, recursive=True))
+            if not matches:
+                print(f"stemgen: no match for {path}", file=sys.stderr)
+            tracks.extend(collect_tracks(matches, supported_files, recursive))
+
+    unique = []
+    for track in tracks:
+        track = os.path.abspath(track)
+        if track not in unique:
+            unique.append(track)
+    return unique
+
+
+def parse_size(value):
+    # bytes from "8G", "512M", "1.5g" or a plain number of bytes
+    units = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+    value = value.strip().lower().removesuffix("b")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def open_telemetry(path):
+    if not path:
+        return None
+    if path == "-":
+        return sys.stderr
+    return open(path, "a", buffering=1)
+
+
+def list_presets():
+    speeds = preset_speeds()
+    for name, settings in PRESETS.items():
+        speed = f"{speeds[name]:.1f} audio seconds per second" if name in speeds else "not measured here, see benchmark.py presets"
+        print(f"{name}: {', '.join(f'{key}={value}' for key, value in settings.items())}; {speed}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="stemgen", description="Create NI stem files from audio files.")
+    parser.add_argument("paths", nargs="*", help="audio files, directories or glob patterns")
+    parser.add_argument("-r", "--recursive", action="store_true", help="look for audio files in sub-directories too")
+    parser.add_argument("-o", "--overwrite", action="store_true", help="process tracks that already have a .stem.m4a file")
+    parser.add_argument("--preset", choices=list(PRESETS), help="model, shifts, overlap, segment and codec together (default: standard)")
+    parser.add_argument("--list-presets", action="store_true", help="show the presets and their measured speed on this machine")
+    parser.add_argument("-n", "--model", help="overrides the preset's model")
+    parser.add_argument("--shifts", type=int, help="overrides the preset's shifts")
+    parser.add_argument("--precision", choices=["auto", "fp32", "bf16", "int8"], default="auto", help="bf16: bfloat16 autocast on CPUs with AVX-512 BF16/AMX, picked by auto; int8: dynamically quantized model, CPU only")
+    parser.add_argument("--backend", choices=["torch", "onnx"], default="torch", help="onnx: run HTDemucs models with ONNX Runtime on the CPU")
+    parser.add_argument("-p", "--processes", type=int, default=0, help="separation worker processes (0 = in this process)")
+    parser.add_argument("-b", "--batch-size", type=int, default=1)
+    parser.add_argument("--cache-dir", help="cache separated stems in this directory")
+    parser.add_argument("--no-journal", action="store_true", help="do not resume an interrupted batch")
+    parser.add_argument("--memory-budget", type=parse_size, metavar="SIZE", help="keep the estimated peak memory under SIZE, e.g. 6G (default: 80%% of available memory)")
+    parser.add_argument("--no-memory-governor", action="store_true", help="do not size the work to the available memory")
+    parser.add_argument("-w", "--watch", action="store_true", help="keep running and stem files added to the given directories")
+    parser.add_argument("--settle", type=float, default=5.0, help="seconds a new file has to stay unchanged before it is stemmed")
+    parser.add_argument("--queue-size", type=int, default=8, help="complete files waiting for the worker before the watcher holds back")
+    parser.add_argument("--telemetry", metavar="FILE", help="write a JSON line per timed stage and step to FILE ('-' for stderr)")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+    args = parser.parse_args(argv)
+    if args.list_presets:
+        list_presets()
+        return 0
+    if not args.paths:
+        parser.error("the following arguments are required: paths")
+    if args.backend == "onnx" and args.precision not in ("auto", "fp32"):
+        parser.error(f"--precision {args.precision} needs the torch backend")
+
+    stemgen = StemGen()
+    if args.preset:
+        stemgen.apply_preset(args.preset)
+    if args.model:
+        stemgen.model_name = args.model
+    if args.shifts is not None:
+        stemgen.model_shifts = str(args.shifts)
+    stemgen.model_precision = args.precision
+    stemgen.separation_backend = args.backend
+    stemgen.overwrite_existing = args.overwrite
+    stemgen.separation_processes = args.processes
+    stemgen.batch_size = args.batch_size
+    stemgen.cache_directory = args.cache_dir
+    stemgen.use_journal = not args.no_journal
+    stemgen.memory_budget = args.memory_budget
+    stemgen.memory_governor = not args.no_memory_governor
+    if args.telemetry or args.metrics_port:
+        telemetry = Telemetry(open_telemetry(args.telemetry))
+        telemetry.attach(stemgen)
+        if args.metrics_port:
+            telemetry.serve(args.metrics_port)
+
+    if args.watch:
+        directories = [path for path in args.paths if os.path.isdir(path)]
+        if len(directories) != len(args.paths):
+            print("stemgen: --watch takes directories only", file=sys.stderr)
+            return 2
+        tracks = None
+    else:
+        tracks = collect_tracks(args.paths, stemgen.supported_files, args.recursive)
+        if not tracks:
+            print("stemgen: no tracks to process", file=sys.stderr)
+            return 2
+
+    # results arrive from the pipeline threads
+    output = sys.stdout
+    output_lock = threading.Lock()
+    statuses = {}
+
+    def write_result(result):
+        with output_lock:
+            statuses[result["status"]] = statuses.get(result["status"], 0) + 1
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+
+    stemgen.track_result.connect(write_result)
+    with contextlib.redirect_stdout(sys.stderr):
+        if tracks is None:
+            daemon = WatchDaemon(stemgen, directories, args.settle, args.recursive, args.queue_size, max(args.batch_size, 1))
+            signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+            try:
+                daemon.run()
+            except KeyboardInterrupt:
+                daemon.stop()
+            return 0
+        stemgen.run(tracks)
+
+    if not statuses and stemgen.errors:
+        print("stemgen: " + ", ".join(str(error) for error in stemgen.errors), file=sys.stderr)
+        return 2
+    return 1 if statuses.get("failed") else 0
+
+
+if __name__ == "__main__":
+    import multiprocessing
+
+    multiprocessing.freeze_support()
+    multiprocessing.set_start_method("spawn")
+    sys.exit(main())
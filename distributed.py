@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""Work distribution between nodes through a shared job directory.
+
+    python3 distributed.py enqueue /nas/queue /nas/library/incoming -r
+    python3 distributed.py work /nas/queue          (on every node)
+    python3 distributed.py status /nas/queue
+
+The job directory holds one file per track in tracks/, a lease file per
+track being worked on in leases/ and a result file per finished track in
+done/. Every node must see the tracks under the same paths.
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import uuid
+
+from cli import collect_tracks
+from stemgen import PRESETS, StemGen
+
+
+class SharedQueue:
+    """Tracks to stem, claimed by workers through lease files.
+
+    A lease is created with O_CREAT | O_EXCL, which only one worker can win,
+    and holds a token unique to that claim. The owner refreshes the lease
+    mtime while it works; a lease whose mtime is older than lease_seconds
+    belongs to a dead worker and may be taken over. Taking over renames the
+    stale lease away first, which again only one worker can do, then checks
+    that the renamed lease is the stale one it looked at.
+    """
+
+    def __init__(self, directory, lease_seconds=120.0):
+        self.directory = directory
+        self.lease_seconds = lease_seconds
+        for name in ("tracks", "leases", "done"):
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+
+    def _path(self, kind, track_id):
+        return os.path.join(self.directory, kind, track_id + (".lease" if kind == "leases" else ".json"))
+
+
+    def _write_json(self, path, data):
+        temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temporary, "w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+
+
+    def _read_json(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+    def enqueue(self, tracks):
+        added = 0
+        for track in tracks:
+            track_id = hashlib.sha1(track.encode("utf-8")).hexdigest()
+            path = self._path("tracks", track_id)
+            if not os.path.exists(path):
+                self._write_json(path, {"track": track})
+                added += 1
+        return added
+
+
+    def track_ids(self):
+        return [name[:-5] for name in os.listdir(os.path.join(self.directory, "tracks")) if name.endswith(".json")]
+
+
+    def is_done(self, track_id):
+        return os.path.exists(self._path("done", track_id))
+
+
+    def claim(self, worker):
+        # (track id, track, lease token) of a track nobody works on, None
+        # when every open track is leased, or False when all tracks are done
+        track_ids = [track_id for track_id in self.track_ids() if not self.is_done(track_id)]
+        if not track_ids:
+            return False
+        # workers start at different places to avoid fighting over the same lease
+        random.shuffle(track_ids)
+        for track_id in track_ids:
+            lease = self._path("leases", track_id)
+            token = self._create_lease(lease, worker)
+            if token is None and self._expired(lease):
+                token = self._take_over(lease, worker)
+            if token is None:
+                continue
+            # finished by another worker between the listing and the claim
+            if self.is_done(track_id):
+                self.release(track_id, token)
+                continue
+            job = self._read_json(self._path("tracks", track_id))
+            if job is None:
+                self.release(track_id, token)
+                continue
+            return track_id, job["track"], token
+        return None
+
+
+    def _create_lease(self, lease, worker):
+        token = uuid.uuid4().hex
+        try:
+            fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return None
+        with os.fdopen(fd, "w") as f:
+            json.dump({"token": token, "worker": worker}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        return token
+
+
+    def _lease_token(self, lease):
+        data = self._read_json(lease)
+        return data.get("token") if data else None
+
+
+    def _expired(self, lease):
+        try:
+            return time.time() - os.stat(lease).st_mtime > self.lease_seconds
+        except FileNotFoundError:
+            return False
+
+
+    def _take_over(self, lease, worker):
+        stale_token = self._lease_token(lease)
+        if stale_token is None:
+            return None
+        stolen = f"{lease}.{uuid.uuid4().hex}.stale"
+        try:
+            os.rename(lease, stolen)
+        except FileNotFoundError:
+            # another worker took it over first
+            return None
+        if self._lease_token(stolen) != stale_token:
+            # between the read and the rename another worker took the stale
+            # lease over and created its own, which is what got renamed (a
+            # heartbeat only touches the mtime, the token of a lease never
+            # changes): give it back unless the path was claimed again since
+            try:
+                os.link(stolen, lease)
+            except OSError:
+                pass
+            os.remove(stolen)
+            return None
+        os.remove(stolen)
+        return self._create_lease(lease, worker)
+
+
+    def owns(self, track_id, token):
+        return self._lease_token(self._path("leases", track_id)) == token
+
+
+    def heartbeat(self, track_id, token):
+        # refreshes the lease, False when it was lost to another worker
+        if not self.owns(track_id, token):
+            return False
+        try:
+            os.utime(self._path("leases", track_id))
+        except FileNotFoundError:
+            return False
+        return True
+
+
+    def release(self, track_id, token):
+        if self.owns(track_id, token):
+            try:
+                os.remove(self._path("leases", track_id))
+            except FileNotFoundError:
+                pass
+
+
+    def complete(self, track_id, token, result):
+        # the result is published before the lease goes away, so the track
+        # is never seen as both unleased and not done
+        self._write_json(self._path("done", track_id), result)
+        self.release(track_id, token)
+
+
+    def status(self):
+        counts = {"tracks": 0, "done": 0, "leased": 0}
+        for track_id in self.track_ids():
+            counts["tracks"] += 1
+            if self.is_done(track_id):
+                counts["done"] += 1
+            elif os.path.exists(self._path("leases", track_id)) and not self._expired(self._path("leases", track_id)):
+                counts["leased"] += 1
+        counts["waiting"] = counts["tracks"] - counts["done"] - counts["leased"]
+        return counts
+
+
+class DistributedWorker:
+    """Claims tracks from a SharedQueue one at a time and stems them.
+
+    A heartbeat thread keeps the current lease alive; if the lease is lost
+    the track is cancelled so two nodes never keep working on it. A worker
+    that lost its lease after the last cancellation check still does not
+    publish: ownership is checked again right before the stem file is moved
+    into place and the shared work directory removed.
+    """
+
+    def __init__(self, stemgen, shared_queue, poll_interval=10.0):
+        self.stemgen = stemgen
+        self.queue = shared_queue
+        self.poll_interval = poll_interval
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self.current = None
+        self.result = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        # results go to stdout even while engine progress is sent to stderr
+        self.output = sys.stdout
+        stemgen.track_result.connect(self.on_result)
+        stemgen.may_publish = self.owns
+
+
+    def on_result(self, result):
+        self.result = result
+
+
+    def owns(self, track):
+        # whether the lease of the track being processed is still ours
+        with self.lock:
+            current = self.current
+        return current is not None and current[1] == track and self.queue.owns(current[0], current[2])
+
+
+    def heartbeat(self):
+        while not self.stopped.wait(self.queue.lease_seconds / 4):
+            with self.lock:
+                current = self.current
+            if current is None:
+                continue
+            track_id, track, token = current
+            if not self.queue.heartbeat(track_id, token):
+                print(f"lease lost for {track}", file=sys.stderr)
+                self.stemgen.cancel(track)
+
+
+    def run(self):
+        heartbeat = threading.Thread(target=self.heartbeat, name="heartbeat", daemon=True)
+        heartbeat.start()
+        try:
+            while not self.stopped.is_set():
+                claim = self.queue.claim(self.worker)
+                if claim is False:
+                    break
+                if claim is None:
+                    # the remaining tracks are leased, wait for them to finish or expire
+                    self.stopped.wait(self.poll_interval)
+                    continue
+                self.process(*claim)
+        finally:
+            self.stopped.set()
+            heartbeat.join()
+
+
+    def process(self, track_id, track, token):
+        with self.lock:
+            self.current = (track_id, track, token)
+        self.result = None
+        self.stemgen.clear_results()
+        try:
+            self.stemgen.run([track])
+        finally:
+            with self.lock:
+                self.current = None
+        result = self.result or {"track": track, "status": "failed", "error": ", ".join(str(error) for error in self.stemgen.errors) or "not processed"}
+        if result["status"] == "cancelled" or not self.queue.owns(track_id, token):
+            # lease lost: whoever holds it now finishes the track
+            return
+        self.queue.complete(track_id, token, dict(result, worker=self.worker, finished=time.time()))
+        print(json.dumps(result), file=self.output, flush=True)
+
+
+    def stop(self):
+        self.stopped.set()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stem a batch on several nodes through a shared job directory")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue = subparsers.add_parser("enqueue", help="add tracks to the job directory")
+    enqueue.add_argument("queue")
+    enqueue.add_argument("paths", nargs="+", help="audio files, directories or glob patterns")
+    enqueue.add_argument("-r", "--recursive", action="store_true")
+
+    work = subparsers.add_parser("work", help="stem tracks from the job directory until all are done")
+    work.add_argument("queue")
+    work.add_argument("--lease", type=float, default=120.0, help="seconds without heartbeat after which a lease expires")
+    work.add_argument("--preset", choices=list(PRESETS), help="model, shifts, overlap, segment and codec together (default: standard)")
+    work.add_argument("-n", "--model", help="overrides the preset's model")
+    work.add_argument("--shifts", type=int, help="overrides the preset's shifts")
+    work.add_argument("-o", "--overwrite", action="store_true")
+
+    status = subparsers.add_parser("status", help="count done, leased and waiting tracks")
+    status.add_argument("queue")
+    args = parser.parse_args(argv)
+
+    if args.command == "enqueue":
+        tracks = collect_tracks(args.paths, StemGen().supported_files, args.recursive)
+        print(f"{SharedQueue(args.queue).enqueue(tracks)} track(s) added", file=sys.stderr)
+    elif args.command == "status":
+        print(json.dumps(SharedQueue(args.queue).status()))
+    else:
+        stemgen = StemGen()
+        if args.preset:
+            stemgen.apply_preset(args.preset)
+        if args.model:
+            stemgen.model_name = args.model
+        if args.shifts is not None:
+            stemgen.model_shifts = str(args.shifts)
+        stemgen.overwrite_existing = args.overwrite
+        worker = DistributedWorker(stemgen, SharedQueue(args.queue, args.lease))
+        with contextlib.redirect_stdout(sys.stderr):
+            try:
+                worker.run()
+            except KeyboardInterrupt:
+                worker.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import threading
+
+from paths import cache_path
+
+
+STAGES = ["prepared", "split", "saved"]
+
+
+def default_journal_directory():
+    return cache_path("journals")
+
+
+class BatchJournal:
+    """Records which stages finished for each track of a batch.
+
+    The journal of a batch is a JSON file named after the set of tracks, so
+    running the same selection again finds it. Each track entry holds the
+    size and mtime of the source, the finished stages and the artifacts they
+    left behind. The file is replaced atomically after every update, so it
+    survives a crash or the app being closed mid-batch.
+    """
+
+    def __init__(self, tracks, directory=None):
+        directory = directory or default_journal_directory()
+        os.makedirs(directory, exist_ok=True)
+        batch = hashlib.sha1("\n".join(sorted(os.path.abspath(track) for track in tracks)).encode("utf-8")).hexdigest()
+        self.path = os.path.join(directory, batch + ".json")
+        self.lock = threading.Lock()
+        self.tracks = {}
+        try:
+            with open(self.path) as f:
+                self.tracks = json.load(f).get("tracks", {})
+        except (OSError, ValueError):
+            self.tracks = {}
+
+
+    def _signature(self, track):
+        stat = os.stat(track)
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+    def resume_stage(self, track):
+        # The last stage that finished for an unchanged track, or None.
+        with self.lock:
+            entry = self.tracks.get(os.path.abspath(track))
+        if entry is None:
+            return None
+        try:
+            if entry["signature"] != self._signature(track):
+                return None
+        except OSError:
+            return None
+        finished = [stage for stage in STAGES if stage in entry["stages"]]
+        return finished[-1] if finished else None
+
+
+    def artifacts(self, track):
+        with self.lock:
+            return dict(self.tracks.get(os.path.abspath(track), {}).get("artifacts", {}))
+
+
+    def record(self, track, stage, **artifacts):
+        key = os.path.abspath(track)
+        with self.lock:
+            entry = self.tracks.get(key)
+            if entry is None or stage == STAGES[0]:
+                entry = {"signature": self._signature(track), "stages": [], "artifacts": {}}
+                self.tracks[key] = entry
+            if stage not in entry["stages"]:
+                entry["stages"].append(stage)
+            entry["artifacts"].update(artifacts)
+            self._write()
+
+
+    def forget(self, track):
+        with self.lock:
+            self.tracks.pop(os.path.abspath(track), None)
+            self._write()
+
+
+    def _write(self):
+        if not self.tracks:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump({"tracks": self.tracks}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
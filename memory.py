@@ -0,0 +1,177 @@
+import gc
+import resource
+import sys
+
+
+SAMPLE_RATE = 44100
+SOURCES = 4
+
+# Rough figures for htdemucs on CPU; `benchmark.py memory` measures them
+# for a model on a given machine.
+# model weights, torch and the interpreter, once per process holding a model
+MODEL_BYTES = 768 * 1024 ** 2
+# model activations per second of segment, for each track of a batch
+SEGMENT_BYTES_PER_SECOND = 96 * 1024 ** 2
+
+# htdemucs is trained on 7.8s segments and accepts nothing longer
+DEFAULT_SEGMENT = 7.8
+MIN_SEGMENT = 1.0
+
+
+def pads_segments(model_name):
+    # HTDemucs models pad every segment to the length they were trained on,
+    # so a shorter segment does not make their activations any smaller
+    return model_name.startswith("htdemucs")
+
+
+def available_memory():
+    # MemAvailable in bytes, None where /proc/meminfo is missing
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss():
+    # Peak resident memory of this process in bytes, since it started or
+    # since the last reset_peak_rss().
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss cannot be reset; kilobytes on Linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def reset_peak_rss():
+    # brings VmHWM back to the current RSS (Linux 4.0+), False when not possible
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def is_out_of_memory(exc):
+    # torch reports failed allocations as RuntimeError ("CUDA out of memory",
+    # "DefaultCPUAllocator: can't allocate memory", "MPS backend out of memory")
+    if isinstance(exc, MemoryError):
+        return True
+    message = str(exc).lower()
+    return isinstance(exc, RuntimeError) and ("out of memory" in message or "can't allocate memory" in message)
+
+
+def free_cached_memory():
+    # after a failed allocation, so the retry starts from what is really in use
+    gc.collect()
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def track_bytes(media, window=None):
+    # (separating, alongside): memory a track holds while it is separated,
+    # without the model activations, and while it is decoded or saved.
+    # Decoding holds the source as float, its stereo downmix and the
+    # resampled copy; separating the input, its normalized copy and every
+    # source twice (accumulated by demucs, then denormalized); saving the
+    # mixdown and the sources. A streamed track only holds one window of
+    # `window` seconds at a time.
+    duration = min(media.duration, window) if window else media.duration
+    stereo = duration * SAMPLE_RATE * 2 * 4
+    decoding = duration * (media.sample_rate or SAMPLE_RATE) * ((media.channels or 2) + 2) * 4 + stereo
+    separating = stereo * (2 + 2 * SOURCES)
+    saving = stereo * (1 + SOURCES)
+    return int(separating), int(max(decoding, saving))
+
+
+class MemoryGovernor:
+    """Sizes separation work to a memory budget.
+
+    The peak of a run is estimated from the longest track: every track being
+    separated at once (worker processes times batch size) with the
+    activations of its forward pass, which grow with the segment length, one
+    more track being decoded or saved alongside, and one model per process.
+    To fit the budget the batch size is lowered first, then the number of
+    worker processes, then the segment length of the tracks that still do
+    not fit, and the tracks that do not fit with any segment are streamed.
+
+    Models that pad every segment to their training length (HTDemucs,
+    `padded_segments`) keep the activations of a whole training segment
+    whatever the segment: for them a track that does not fit is streamed
+    straight away.
+
+    The kernel kills a process that runs out of memory rather than making an
+    allocation fail, so staying under the budget is what protects a run;
+    retrying with a shorter segment, or streaming the track, catches failed
+    allocations the estimate missed.
+    """
+
+    def __init__(self, budget=None, fraction=0.8, padded_segments=False):
+        # budget in bytes, by default a fraction of the memory available now
+        if budget is None:
+            available = available_memory()
+            budget = int(available * fraction) if available else None
+        self.budget = budget
+        self.max_segment = DEFAULT_SEGMENT
+        self.padded_segments = padded_segments
+
+
+    def peak(self, media, segment=None, processes=0, batch_size=1, window=None):
+        # window: seconds held at once by a streamed track
+        tracks = max(1, processes) * batch_size
+        separating, alongside = track_bytes(media, window)
+        if self.padded_segments or not segment:
+            segment = self.max_segment
+        return (
+            MODEL_BYTES * max(1, processes)
+            + tracks * (separating + int(SEGMENT_BYTES_PER_SECOND * segment))
+            + alongside
+        )
+
+
+    def fits(self, media, segment=None, processes=0, batch_size=1):
+        return self.budget is None or self.peak(media, segment, processes, batch_size) <= self.budget
+
+
+    def plan(self, medias, processes, batch_size):
+        # (worker processes, batch size) for a run of tracks with these medias
+        if self.budget is None or not medias:
+            return processes, batch_size
+        largest = max(medias, key=self.peak)
+        while batch_size > 1 and not self.fits(largest, None, processes, batch_size):
+            batch_size -= 1
+        while processes > 1 and not self.fits(largest, None, processes, batch_size):
+            processes -= 1
+        return processes, batch_size
+
+
+    def segment_for(self, media, processes=0, batch_size=1):
+        # None when the model's own segment fits, the longest shorter segment
+        # that fits otherwise, or False when none does
+        segment = self.max_segment
+        if self.fits(media, segment, processes, batch_size):
+            return None
+        while not self.padded_segments and segment / 2 >= MIN_SEGMENT:
+            segment /= 2
+            if self.fits(media, segment, processes, batch_size):
+                return segment
+        return False
+
+
+    def smaller(self, segment):
+        # segment to retry with after an allocation failure, None when at the
+        # minimum or when a shorter segment would not help
+        if self.padded_segments:
+            return None
+        segment = (segment or self.max_segment) / 2
+        return segment if segment >= MIN_SEGMENT else None
@@ -47,11 +47,33 @@ def get_cover(FILE_EXTENSION, FILE_PATH, OUTPUT_PATH, FILE_NAME):
     #print("Done.")
 
 
-def get_metadata(FILE_PATH, OUTPUT_PATH, FILE_NAME):
+def get_metadata(FILE_PATH, OUTPUT_PATH, FILE_NAME, TAGS=None):
     #print("Extracting metadata...")
 
+    # Tags already read by the media probe are reused as is
+    if TAGS is None:
+        TAGS = read_tags(FILE_PATH, FILE_NAME)
+    else:
+        TAGS = dict(TAGS)
+
+    # `cover`
+    if os.path.exists(os.path.join(OUTPUT_PATH, FILE_NAME, "cover.jpg")):
+        TAGS["cover"] = f"{os.path.join(OUTPUT_PATH, FILE_NAME, 'cover.jpg')}"
+
+    #print(TAGS)
+
+    #print("Creating tags.json...")
+
+    with open(os.path.join(OUTPUT_PATH, FILE_NAME, "tags.json"), "w") as f:
+        json.dump(TAGS, f)
+
+    #print("Done.")
+
+
+def read_tags(FILE_PATH, FILE_NAME, file=None):
     # Extract metadata with mutagen
-    file = mutagen.File(FILE_PATH)
+    if file is None:
+        file = mutagen.File(FILE_PATH)
     #if file.tags is not None:
     #    print(file.tags.pprint())
 
@@ -273,18 +295,7 @@ def get_metadata(FILE_PATH, OUTPUT_PATH, FILE_NAME):
     if "COUNTRY" in file:
         TAGS["country"] = file["COUNTRY"][0]
 
-    # `cover`
-    if os.path.exists(os.path.join(OUTPUT_PATH, FILE_NAME, "cover.jpg")):
-        TAGS["cover"] = f"{os.path.join(OUTPUT_PATH, FILE_NAME, 'cover.jpg')}"
-
-    #print(TAGS)
-
-    #print("Creating tags.json...")
-
-    with open(os.path.join(OUTPUT_PATH, FILE_NAME, "tags.json"), "w") as f:
-        json.dump(TAGS, f)
-
-    #print("Done.")
+    return TAGS
 
 
 def create_metadata_json(stems, path):
@@ -1,14 +1,17 @@
 import codecs
+import contextlib
 import json
 import base64
 import mutagen
 import mutagen.mp4
 import mutagen.id3
+import mmap
 import os
 import platform
 import subprocess
 import sys
 import re
+import struct
 
 stemDescription = "stem-meta"
 stemOutExtension = ".m4a"
@@ -52,8 +55,26 @@ def _findCmd(cmd):
     return None
 
 
+def _runChecked(callArgs, description, input=None):
+    # runs ffmpeg, qaac or MP4Box and raises with the end of its error output
+    # when it fails, instead of leaving a missing file for a later step
+    result = subprocess.run(callArgs, input=input, capture_output=True)
+    if result.returncode != 0:
+        errors = result.stderr.decode("utf-8", errors="replace").strip().splitlines()
+        raise RuntimeError(
+            description
+            + " failed ("
+            + os.path.basename(callArgs[0])
+            + " exit code "
+            + str(result.returncode)
+            + ")"
+            + (": " + errors[-1] if errors else "")
+        )
+    return result
+
+
 def _checkAvailableAacEncoders():
-    subprocess.run([_findCmd("ffmpeg"), "-v", "error", "-codecs"], capture_output=True)
+    output = subprocess.run([_findCmd("ffmpeg"), "-v", "error", "-codecs"], capture_output=True).stdout
     aac_codecs = [
         x for x in output.splitlines() if "AAC (Advanced Audio Coding)" in str(x)
     ][0]
@@ -81,6 +102,21 @@ def _getAacCodec():
     return codec
 
 
+def encoderArgs(fileFormat):
+    # ffmpeg arguments encoding to "alac", or to "aac" with the best AAC
+    # encoder available at its highest VBR quality
+    if fileFormat != "aac":
+        return ["-c:a", "alac"]
+    aacCodec = _getAacCodec()
+    args = ["-c:a", aacCodec]
+    if aacCodec == "aac_at":
+        args.extend(["-q:a", "0"])
+    elif aacCodec == "libfdk_aac":
+        args.extend(["-vbr", "5"])
+        # args.extend(["-cutoff", "20000"])
+    return args
+
+
 def _getSampleRate(trackPath):
     output = subprocess.check_output(
         [
@@ -94,12 +130,395 @@ def _getSampleRate(trackPath):
             "-of",
             "default=noprint_wrappers=1:nokey=1",
             trackPath,
-        ],
-        capture_output=True
+        ]
     )
     return int(output)
 
 
+class MemoryTrack:
+    """A track held in memory as WAV bytes instead of a file on disk.
+
+    `path` is where the WAV would have been written; the encoded track is
+    named after it. The data is streamed to the encoder through a pipe.
+    `data` may also be a callable returning the bytes, so that only the
+    track being encoded is held in memory.
+    """
+
+    def __init__(self, path, data, sampleRate):
+        self.path = path
+        self.data = data
+        self.sampleRate = sampleRate
+
+    def read(self):
+        return self.data() if callable(self.data) else self.data
+
+
+def _trackPath(track):
+    return track.path if isinstance(track, MemoryTrack) else track
+
+
+# ---------------------------------------------------------------------------
+# MP4 box reading and writing
+# ---------------------------------------------------------------------------
+
+_containerBoxes = [b"moov", b"trak", b"mdia", b"minf", b"stbl", b"udta", b"edts", b"dinf"]
+
+
+def _iterBoxes(data, start, end):
+    # Yields (type, payloadStart, boxEnd) for the boxes found in data[start:end].
+    offset = start
+    while offset + 8 <= end:
+        size, boxType = struct.unpack(">I4s", data[offset : offset + 8])
+        headerSize = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[offset + 8 : offset + 16])[0]
+            headerSize = 16
+        elif size == 0:
+            size = end - offset
+        if size < headerSize:
+            break
+        yield boxType, offset + headerSize, min(offset + size, end)
+        offset += size
+
+
+def _findBox(data, path, start=0, end=None):
+    # Returns (payloadStart, boxEnd) of the first box matching a path such as
+    # [b"moov", b"udta", b"stem"], or None.
+    if end is None:
+        end = len(data)
+    for boxType, payloadStart, boxEnd in _iterBoxes(data, start, end):
+        if boxType == path[0]:
+            if len(path) == 1:
+                return payloadStart, boxEnd
+            found = _findBox(data, path[1:], payloadStart, boxEnd)
+            if found is not None:
+                return found
+    return None
+
+
+def _box(boxType, *payloads):
+    payload = b"".join(payloads)
+    return struct.pack(">I4s", len(payload) + 8, boxType) + payload
+
+
+def _fullBox(boxType, version, flags, *payloads):
+    return _box(boxType, struct.pack(">I", (version << 24) | flags), *payloads)
+
+
+_identityMatrix = struct.pack(">9I", 0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0, 0x40000000)
+
+
+class _SourceTrack:
+    """An audio track of an .m4a file, the first one by default, as needed to
+    copy it into a stem file."""
+
+    def __init__(self, path, trackIndex=0):
+        self.path = path
+        self._file = open(path, "rb")
+        self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self.data
+
+        mvhd = _findBox(data, [b"moov", b"mvhd"])
+        version = data[mvhd[0]]
+        self.movieTimescale = struct.unpack(
+            ">I", data[mvhd[0] + (20 if version == 1 else 12) : mvhd[0] + (24 if version == 1 else 16)]
+        )[0]
+
+        moov = _findBox(data, [b"moov"])
+        self.trak = None
+        audioTracks = 0
+        for boxType, payloadStart, boxEnd in _iterBoxes(data, *moov):
+            if boxType == b"trak":
+                hdlr = _findBox(data, [b"mdia", b"hdlr"], payloadStart, boxEnd)
+                if hdlr is not None and data[hdlr[0] + 8 : hdlr[0] + 12] == b"soun":
+                    if audioTracks == trackIndex:
+                        self.trak = (payloadStart, boxEnd)
+                        break
+                    audioTracks += 1
+        if self.trak is None:
+            raise RuntimeError("No audio track in " + path if trackIndex == 0 else "Fewer than " + str(trackIndex + 1) + " audio tracks in " + path)
+
+        tkhd = _findBox(data, [b"tkhd"], *self.trak)
+        if data[tkhd[0]] == 1:
+            self.duration = struct.unpack(">Q", data[tkhd[0] + 28 : tkhd[0] + 36])[0]
+        else:
+            self.duration = struct.unpack(">I", data[tkhd[0] + 20 : tkhd[0] + 24])[0]
+
+        self.mdhd = self._rawBox([b"mdia", b"mdhd"])
+        mdhd = _findBox(data, [b"mdia", b"mdhd"], *self.trak)
+        if data[mdhd[0]] == 1:
+            self.timescale = struct.unpack(">I", data[mdhd[0] + 20 : mdhd[0] + 24])[0]
+        else:
+            self.timescale = struct.unpack(">I", data[mdhd[0] + 12 : mdhd[0] + 16])[0]
+
+        self.stsd = self._rawBox([b"mdia", b"minf", b"stbl", b"stsd"])
+        self.stts = self._rawBox([b"mdia", b"minf", b"stbl", b"stts"])
+        self.stsz = self._rawBox([b"mdia", b"minf", b"stbl", b"stsz"])
+        self.editList = self._readEditList()
+        self.sampleSizes = self._readSampleSizes()
+        self.sampleDurations = self._readSampleDurations()
+        self.sampleOffsets = self._readSampleOffsets()
+
+    def _rawBox(self, path):
+        found = _findBox(self.data, path, *self.trak)
+        if found is None:
+            raise RuntimeError("Missing " + b"/".join(path).decode() + " in " + self.path)
+        payloadStart, boxEnd = found
+        # whole box including its 8 byte header
+        return self.data[payloadStart - 8 : boxEnd]
+
+    def _readEditList(self):
+        found = _findBox(self.data, [b"edts", b"elst"], *self.trak)
+        if found is None:
+            return []
+        data = self.data
+        version = data[found[0]]
+        count = struct.unpack(">I", data[found[0] + 4 : found[0] + 8])[0]
+        entries = []
+        offset = found[0] + 8
+        for _ in range(count):
+            if version == 1:
+                segmentDuration, mediaTime = struct.unpack(">Qq", data[offset : offset + 16])
+                offset += 16
+            else:
+                segmentDuration, mediaTime = struct.unpack(">Ii", data[offset : offset + 8])
+                offset += 8
+            rate = data[offset : offset + 4]
+            offset += 4
+            entries.append((segmentDuration, mediaTime, rate))
+        return entries
+
+    def _readSampleSizes(self):
+        sampleSize, count = struct.unpack(">II", self.stsz[12:20])
+        if sampleSize != 0:
+            return [sampleSize] * count
+        return list(struct.unpack(">%dI" % count, self.stsz[20 : 20 + 4 * count]))
+
+    def _readSampleDurations(self):
+        count = struct.unpack(">I", self.stts[12:16])[0]
+        durations = []
+        for i in range(count):
+            sampleCount, sampleDelta = struct.unpack(">II", self.stts[16 + 8 * i : 24 + 8 * i])
+            durations.extend([sampleDelta] * sampleCount)
+        return durations
+
+    def _readSampleOffsets(self):
+        stsc = self._rawBox([b"mdia", b"minf", b"stbl", b"stsc"])
+        count = struct.unpack(">I", stsc[12:16])[0]
+        runs = [struct.unpack(">III", stsc[16 + 12 * i : 28 + 12 * i]) for i in range(count)]
+
+        if _findBox(self.data, [b"mdia", b"minf", b"stbl", b"co64"], *self.trak) is not None:
+            co64 = self._rawBox([b"mdia", b"minf", b"stbl", b"co64"])
+            chunkCount = struct.unpack(">I", co64[12:16])[0]
+            chunkOffsets = struct.unpack(">%dQ" % chunkCount, co64[16 : 16 + 8 * chunkCount])
+        else:
+            stco = self._rawBox([b"mdia", b"minf", b"stbl", b"stco"])
+            chunkCount = struct.unpack(">I", stco[12:16])[0]
+            chunkOffsets = struct.unpack(">%dI" % chunkCount, stco[16 : 16 + 4 * chunkCount])
+
+        offsets = []
+        sample = 0
+        for chunk in range(chunkCount):
+            samplesPerChunk = 0
+            for firstChunk, perChunk, descriptionIndex in runs:
+                if firstChunk <= chunk + 1:
+                    samplesPerChunk = perChunk
+            offset = chunkOffsets[chunk]
+            for _ in range(samplesPerChunk):
+                if sample >= len(self.sampleSizes):
+                    break
+                offsets.append(offset)
+                offset += self.sampleSizes[sample]
+                sample += 1
+        return offsets
+
+    def read(self, firstSample, lastSample):
+        # Bytes of samples [firstSample, lastSample), one slice per contiguous run.
+        start = self.sampleOffsets[firstSample]
+        end = start
+        for sample in range(firstSample, lastSample):
+            offset = self.sampleOffsets[sample]
+            if offset != end:
+                yield self.data[start:end]
+                start = offset
+            end = offset + self.sampleSizes[sample]
+        yield self.data[start:end]
+
+    def close(self):
+        self.data.close()
+        self._file.close()
+
+
+class StemMuxer:
+    """Writes an NI Stem file without MP4Box.
+
+    The first track is the enabled mixdown, the others are disabled stem
+    tracks, and moov/udta carries the `stem` box with the JSON metadata. The
+    encoded samples are copied from single-track .m4a files. Since the layout
+    is computed up front, moov is written first and the file is produced in
+    one sequential pass. Room for the iTunes tags is reserved in moov/udta/meta
+    so that mutagen can tag the file in place afterwards.
+    """
+
+    chunkDuration = 0.5  # seconds of audio per chunk when interleaving tracks
+
+    def __init__(self, trackPaths, metadata, tagPadding=16384):
+        self._trackPaths = trackPaths
+        self._metadata = metadata
+        self._tagPadding = tagPadding
+        self.bytesWritten = 0
+
+    def write(self, outputFilePath):
+        sources = [_SourceTrack(path) for path in self._trackPaths]
+        try:
+            self._write(sources, outputFilePath)
+        finally:
+            for source in sources:
+                source.close()
+        return self.bytesWritten
+
+    def _chunks(self, source):
+        # [(firstSample, lastSample)] of about chunkDuration seconds each
+        chunks = []
+        limit = max(1, int(source.timescale * self.chunkDuration))
+        first = 0
+        elapsed = 0
+        for sample, duration in enumerate(source.sampleDurations[: len(source.sampleSizes)]):
+            elapsed += duration
+            if elapsed >= limit:
+                chunks.append((first, sample + 1))
+                first = sample + 1
+                elapsed = 0
+        if first < len(source.sampleSizes):
+            chunks.append((first, len(source.sampleSizes)))
+        return chunks
+
+    def _write(self, sources, outputFilePath):
+        movieTimescale = sources[0].movieTimescale
+
+        # interleave the chunks of all tracks by time
+        layout = []
+        for index, source in enumerate(sources):
+            time = 0
+            for first, last in self._chunks(source):
+                size = sum(source.sampleSizes[first:last])
+                layout.append((time / source.timescale, index, first, last, size))
+                time += sum(source.sampleDurations[first:last])
+        layout.sort(key=lambda chunk: (chunk[0], chunk[1]))
+
+        mdatSize = sum(chunk[4] for chunk in layout)
+        largeMdat = mdatSize + 8 > 0xFFFFFFFF
+        mdatHeader = (
+            struct.pack(">I4sQ", 1, b"mdat", mdatSize + 16)
+            if largeMdat
+            else struct.pack(">I4s", mdatSize + 8, b"mdat")
+        )
+        ftyp = _box(b"ftyp", b"M4A ", struct.pack(">I", 0x200), b"M4A ", b"isom", b"iso2", b"mp42")
+
+        # moov does not change size with the offset values, so lay it out once
+        # to learn its size and once more with the final chunk offsets
+        moov = self._moov(sources, layout, movieTimescale, 0, largeMdat)
+        dataStart = len(ftyp) + len(moov) + len(mdatHeader)
+        moov = self._moov(sources, layout, movieTimescale, dataStart, largeMdat)
+
+        with open(outputFilePath, "wb") as f:
+            f.write(ftyp)
+            f.write(moov)
+            f.write(mdatHeader)
+            for _, index, first, last, _ in layout:
+                for data in sources[index].read(first, last):
+                    f.write(data)
+            self.bytesWritten = f.tell()
+
+    def _moov(self, sources, layout, movieTimescale, dataStart, largeOffsets):
+        chunkOffsets = [[] for _ in sources]
+        chunkSamples = [[] for _ in sources]
+        offset = dataStart
+        for _, index, first, last, size in layout:
+            chunkOffsets[index].append(offset)
+            chunkSamples[index].append(last - first)
+            offset += size
+        largeOffsets = largeOffsets or offset > 0xFFFFFFFF
+
+        durations = [source.duration * movieTimescale // source.movieTimescale for source in sources]
+        mvhd = _fullBox(
+            b"mvhd", 0, 0,
+            struct.pack(">IIII", 0, 0, movieTimescale, max(durations)),
+            struct.pack(">IH10x", 0x00010000, 0x0100),
+            _identityMatrix,
+            bytes(24),
+            struct.pack(">I", len(sources) + 1),
+        )
+        traks = [
+            self._trak(source, index + 1, durations[index], movieTimescale, chunkOffsets[index], chunkSamples[index], largeOffsets)
+            for index, source in enumerate(sources)
+        ]
+
+        stem = _box(b"stem", json.dumps(self._metadata).encode("utf-8"))
+        meta = _fullBox(
+            b"meta", 0, 0,
+            _fullBox(b"hdlr", 0, 0, bytes(4), b"mdir", b"appl", bytes(8), b"\x00"),
+            _box(b"ilst"),
+            _box(b"free", bytes(self._tagPadding)),
+        )
+        udta = _box(b"udta", stem, meta)
+        return _box(b"moov", mvhd, *traks, udta)
+
+    def _trak(self, source, trackId, duration, movieTimescale, chunkOffsets, chunkSamples, largeOffsets):
+        # every track is in the movie and in the preview (0x2 | 0x4), as
+        # MP4Box writes them; only the first track (the mixdown) is enabled
+        flags = 0x7 if trackId == 1 else 0x6
+        tkhd = _fullBox(
+            b"tkhd", 0, flags,
+            struct.pack(">IIII", 0, 0, trackId, 0),
+            struct.pack(">I", duration),
+            bytes(8),
+            struct.pack(">hhh2x", 0, 0, 0x0100),
+            _identityMatrix,
+            struct.pack(">II", 0, 0),
+        )
+
+        edts = b""
+        if source.editList:
+            entries = b"".join(
+                struct.pack(">Qq", segmentDuration * movieTimescale // source.movieTimescale, mediaTime) + rate
+                for segmentDuration, mediaTime, rate in source.editList
+            )
+            edts = _box(b"edts", _fullBox(b"elst", 1, 0, struct.pack(">I", len(source.editList)), entries))
+
+        # stsc: one entry per run of chunks with the same number of samples
+        runs = []
+        for chunk, samples in enumerate(chunkSamples):
+            if not runs or runs[-1][1] != samples:
+                runs.append((chunk + 1, samples))
+        stsc = _fullBox(
+            b"stsc", 0, 0,
+            struct.pack(">I", len(runs)),
+            b"".join(struct.pack(">III", firstChunk, samples, 1) for firstChunk, samples in runs),
+        )
+        if largeOffsets:
+            stco = _fullBox(b"co64", 0, 0, struct.pack(">I%dQ" % len(chunkOffsets), len(chunkOffsets), *chunkOffsets))
+        else:
+            stco = _fullBox(b"stco", 0, 0, struct.pack(">I%dI" % len(chunkOffsets), len(chunkOffsets), *chunkOffsets))
+
+        stbl = _box(b"stbl", source.stsd, source.stts, stsc, source.stsz, stco)
+        minf = _box(
+            b"minf",
+            _fullBox(b"smhd", 0, 0, bytes(4)),
+            _box(b"dinf", _fullBox(b"dref", 0, 0, struct.pack(">I", 1), _fullBox(b"url ", 0, 1))),
+            stbl,
+        )
+        hdlr = _fullBox(b"hdlr", 0, 0, bytes(4), b"soun", bytes(12), b"SoundHandler\x00")
+        mdia = _box(b"mdia", source.mdhd, hdlr, minf)
+        return _box(b"trak", tkhd, edts, mdia)
+
+
+def _ffmpegInput(track):
+    if isinstance(track, MemoryTrack):
+        return ["-f", "wav", "-i", "pipe:0"]
+    return ["-i", track]
+
+
 class StemCreator:
     _defaultMetadata = [
         {"name": "Drums", "color": "#009E73"},
@@ -109,8 +528,14 @@ class StemCreator:
     ]
 
     def __init__(
-        self, mixdownTrack, stemTracks, fileFormat, metadata={}, tags=None
+        self, mixdownTrack, stemTracks, fileFormat, metadata={}, tags=None, muxer="native", measure=None
     ):
+        # muxer: "native" writes the file with StemMuxer, "mp4box" uses the bundled MP4Box
+        self._muxer = muxer
+        # measure(step, **labels) returns a context manager timing a step of
+        # save(): one "encode" per track, then "mux" or "mp4box", then "tag"
+        self._measure = measure or (lambda step, **labels: contextlib.nullcontext())
+        self.bytesWritten = 0
         self._mixdownTrack = mixdownTrack
         self._stemTracks = stemTracks
         self._format = fileFormat if fileFormat else "alac"
@@ -151,7 +576,9 @@ class StemCreator:
                 ]
             )
 
-    def _convertToFormat(self, trackPath, format):
+    def _convertToFormat(self, track, format):
+        trackPath = _trackPath(track)
+        inMemory = isinstance(track, MemoryTrack)
         trackName, fileExtension = os.path.splitext(trackPath)
 
         if fileExtension in _supported_files_no_conversion:
@@ -183,22 +610,14 @@ class StemCreator:
                     print("using QAAC Audio Toolbox codec")
 
                     converterArgs = [qaac]
-                    converterArgs.extend([trackPath])
+                    converterArgs.extend(["-" if inMemory else trackPath])
                     converterArgs.extend(["--tvbr", "127"])
                     converterArgs.extend(["-o"])
                 else:
-                    aacCodec = _getAacCodec()
-                    sampleRate = _getSampleRate(trackPath)
-
-                    #print("using " + aacCodec + " codec")
-
-                    converterArgs.extend(["-i", trackPath])
-                    converterArgs.extend(["-c:a", aacCodec])
-                    if aacCodec == "aac_at":
-                        converterArgs.extend(["-q:a", "0"])
-                    elif aacCodec == "libfdk_aac":
-                        converterArgs.extend(["-vbr", "5"])
-                        # converterArgs.extend(["-cutoff", "20000"])
+                    sampleRate = track.sampleRate if inMemory else _getSampleRate(trackPath)
+
+                    converterArgs.extend(_ffmpegInput(track))
+                    converterArgs.extend(encoderArgs("aac"))
                     converterArgs.extend(["-c:v", "copy"])
                     # If the sample rate is superior to 48kHz, we need to downsample to 48kHz
                     if sampleRate > 48000:
@@ -206,12 +625,13 @@ class StemCreator:
                         converterArgs.extend(["-ar", "48000"])
             else:
                 # ALAC
-                converterArgs.extend(["-i", trackPath])
+                converterArgs.extend(_ffmpegInput(track))
                 converterArgs.extend(["-c:a", "alac"])  # "alac_at"
                 converterArgs.extend(["-c:v", "copy"])
 
             converterArgs.extend([newPath])
-            subprocess.run(converterArgs,capture_output=True)
+            with self._measure("encode", track=os.path.basename(trackPath)):
+                _runChecked(converterArgs, "Encoding " + trackPath, input=track.read() if inMemory else None)
             return newPath
         else:
             print('invalid input file format "' + fileExtension + '"')
@@ -220,18 +640,7 @@ class StemCreator:
             )
             sys.exit()
 
-    def save(self, outputFilePath=None):
-        # When using mp4box, in order to get a playable file, the initial file
-        # extension has to be .m4a -> this gets renamed at the end of the method.
-        if not outputFilePath:
-            root, ext = os.path.splitext(self._mixdownTrack)
-            root += ".stem"
-        else:
-            root, ext = os.path.splitext(outputFilePath)
-
-        outputFilePath = "".join([root, stemOutExtension])
-        _removeFile(outputFilePath)
-        
+    def _saveWithMp4Box(self, outputFilePath):
         folderName = "GPAC_win" if _windows else "GPAC_mac" if _macos else "GPAC_linux"
         executable = "mp4box.exe" if _windows else "mp4box" if _macos else "MP4Box"
         if (getattr(sys, 'frozen', False)):# and hasattr(sys, '_MEIPASS')):
@@ -264,9 +673,44 @@ class StemCreator:
         metadata = base64.b64encode(metadata.encode("utf-8"))
         metadata = "0:type=stem:src=base64," + metadata.decode("utf-8")
         callArgs.extend(["-udta", metadata])
-        subprocess.run(callArgs, capture_output=True)
+        with self._measure("mp4box"):
+            _runChecked(callArgs, "Writing " + outputFilePath)
+        sys.stdout.flush()
+        if os.path.isfile(outputFilePath):
+            self.bytesWritten = os.path.getsize(outputFilePath)
+
+    def save(self, outputFilePath=None):
+        # When using mp4box, in order to get a playable file, the initial file
+        # extension has to be .m4a -> this gets renamed at the end of the method.
+        if not outputFilePath:
+            root, ext = os.path.splitext(_trackPath(self._mixdownTrack))
+            root += ".stem"
+        else:
+            root, ext = os.path.splitext(outputFilePath)
+
+        outputFilePath = "".join([root, stemOutExtension])
+        _removeFile(outputFilePath)
+        
+        if self._muxer == "mp4box":
+            self._saveWithMp4Box(outputFilePath)
+        else:
+            trackPaths = [self._convertToFormat(self._mixdownTrack, format)]
+            for stemTrack in self._stemTracks:
+                trackPaths.append(self._convertToFormat(stemTrack, format))
+            # reserve room for the tags and the cover so they are written in place
+            tagPadding = 16384
+            if "cover" in self._tags and os.path.isfile(self._tags["cover"]):
+                tagPadding += os.path.getsize(self._tags["cover"])
+            with self._measure("mux"):
+                muxer = StemMuxer(trackPaths, self._metadata, tagPadding)
+                self.bytesWritten = muxer.write(outputFilePath)
         sys.stdout.flush()
 
+        with self._measure("tag"):
+            self._writeTags(outputFilePath)
+        return outputFilePath
+
+    def _writeTags(self, outputFilePath):
         # https://picard-docs.musicbrainz.org/en/appendices/tag_mapping.html
         # http://www.jthink.net/jaudiotagger/tagmapping.html
         # https://mutagen.readthedocs.io/en/latest/api/mp4.html
@@ -457,10 +901,23 @@ class StemCreator:
         tags["TAUT"] = "STEM"
         tags.save(outputFilePath)
 
-        #print("\n[Done 6/6]\n")
-        sys.stdout.flush()
 
-        #print("creating " + outputFilePath + " was successful!")
+def readStemMetadata(stemFile):
+    # Reads the JSON of the moov/udta/stem box. The file is memory-mapped and
+    # only the box headers on the way to moov/udta are looked at; nothing is
+    # written to disk.
+    with open(stemFile, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise RuntimeError(stemFile + " is empty")
+        try:
+            found = _findBox(data, [b"moov", b"udta", b"stem"])
+            if found is None:
+                raise RuntimeError("No stem metadata in " + stemFile)
+            return json.loads(data[found[0] : found[1]].decode("utf-8"))
+        finally:
+            data.close()
 
 
 class StemMetadataViewer:
@@ -468,22 +925,7 @@ class StemMetadataViewer:
         self._metadata = {}
 
         if stemFile:
-            folderName = (
-                "GPAC_win" if _windows else "GPAC_mac" if _macos else "GPAC_linux"
-            )
-            executable = "mp4box.exe" if _windows else "mp4box" if _macos else "MP4Box"
-            mp4box = os.path.join(_getProgramPath(), folderName, executable)
-
-            callArgs = [mp4box]
-            callArgs.extend(["-dump-udta", "0:stem", stemFile])
-            subprocess.run(callArgs, capture_output=True)
-
-            root, ext = os.path.splitext(stemFile)
-            udtaFile = root + "_stem.udta"
-            fileObj = codecs.open(udtaFile, encoding="utf-8")
-            fileObj.seek(8)
-            self._metadata = json.load(fileObj)
-            os.remove(udtaFile)
+            self._metadata = readStemMetadata(stemFile)
 
     def dump(self, metadataFile=None, reportFile=None):
         if metadataFile:
@@ -0,0 +1,124 @@
+import os
+import types
+import uuid
+
+import demucs
+import torch
+from demucs.apply import BagOfModels
+from demucs.htdemucs import HTDemucs
+from demucs.pretrained import get_model
+
+from separator import default_model_directory
+
+
+class _Core(torch.nn.Module):
+    # HTDemucs.forward between the STFT and the iSTFT, which is what gets
+    # exported: takes the mix and its spectrogram as real channels, returns
+    # the time branch output and the spectrogram of the sources. The STFT,
+    # the masking and the iSTFT are swapped for pass-throughs while tracing.
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+
+    def forward(self, mix, mag):
+        model = self.model
+        spec = []
+        model._spec = lambda x: None
+        model._magnitude = lambda z: mag
+        model._mask = lambda z, m: spec.append(m)
+        # the time branch plus 0 is the time branch alone
+        model._ispec = lambda z, length=None, scale=0: 0
+        try:
+            time = HTDemucs.forward(model, mix)
+        finally:
+            for name in ("_spec", "_magnitude", "_mask", "_ispec"):
+                delattr(model, name)
+        return time, spec[0]
+
+
+def _training_length(model):
+    return int(model.segment * model.samplerate)
+
+
+def export_onnx(model, path):
+    # exported for a batch of one at the training length, the only shape
+    # HTDemucs is ever run with
+    mix = torch.zeros(1, model.audio_channels, _training_length(model))
+    mag = model._magnitude(model._spec(mix))
+    temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+    with torch.no_grad():
+        torch.onnx.export(
+            _Core(model).eval(),
+            (mix, mag),
+            temporary,
+            input_names=["mix", "mag"],
+            output_names=["time", "spec"],
+            opset_version=17,
+        )
+    os.replace(temporary, path)
+
+
+def _run_onnx(model, session, mix):
+    # HTDemucs.forward with the network run by ONNX Runtime; the STFT, the
+    # masking and the iSTFT stay in torch
+    length = mix.shape[-1]
+    training_length = _training_length(model)
+    if length < training_length:
+        mix = torch.nn.functional.pad(mix, (0, training_length - length))
+    z = model._spec(mix)
+    mag = model._magnitude(z)
+    times, specs = [], []
+    for index in range(mix.shape[0]):
+        time, spec = session.run(
+            None,
+            {
+                "mix": mix[index:index + 1].contiguous().numpy(),
+                "mag": mag[index:index + 1].contiguous().numpy(),
+            },
+        )
+        times.append(torch.from_numpy(time))
+        specs.append(torch.from_numpy(spec))
+    x = model._ispec(model._mask(z, torch.cat(specs)), training_length)
+    x = torch.cat(times) + x
+    return x[..., :length]
+
+
+def _onnx_submodel(model, path, threads):
+    import onnxruntime
+
+    if not os.path.isfile(path):
+        export_onnx(model, path)
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = threads
+    options.inter_op_num_threads = 1
+    session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+    # The network weights now live in the session: drop them from the torch
+    # model and keep the rest of it (STFT settings, segment, sources) for
+    # apply_model, which then splits, shifts and overlap-adds exactly as with
+    # the torch backend. apply_model looks up the device of a parameter.
+    model._modules.clear()
+    model.register_parameter("device_marker", torch.nn.Parameter(torch.zeros(0), requires_grad=False))
+    model.forward = types.MethodType(lambda self, mix: _run_onnx(self, session, mix), model)
+    return model
+
+
+def onnx_model(model_name, directory=None, threads=None):
+    # A model that apply_model uses like the demucs one, with the network
+    # exported once to <directory>/<model>-<index>-....onnx and run by ONNX
+    # Runtime on the CPU. Only HTDemucs models, and bags of them, have the
+    # STFT split out this way.
+    directory = directory or default_model_directory()
+    os.makedirs(directory, exist_ok=True)
+    threads = threads or torch.get_num_threads()
+    model = get_model(model_name)
+    model.eval()
+    models = model.models if isinstance(model, BagOfModels) else [model]
+    for index, submodel in enumerate(models):
+        if not isinstance(submodel, HTDemucs):
+            raise ValueError(f"The ONNX backend only supports HTDemucs models, {model_name} is a {type(submodel).__name__}")
+        path = os.path.join(directory, f"{model_name}-{index}-torch{torch.__version__}-demucs{demucs.__version__}.onnx")
+        _onnx_submodel(submodel, path, threads)
+    return model
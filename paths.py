@@ -0,0 +1,8 @@
+import os
+
+
+def cache_path(*names):
+    # <$XDG_CACHE_HOME or ~/.cache>/stemgen/<names>, where StemGen keeps its
+    # probe database, separations, journals, models and preset speeds
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "stemgen", *names)
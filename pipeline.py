@@ -0,0 +1,137 @@
+import queue
+import threading
+import traceback
+
+
+_STOP = object()
+
+
+class Pipeline:
+    """Runs items through a list of stages connected by bounded queues.
+
+    Each stage is a (name, function, workers) tuple. `workers` threads pull
+    items from the stage's input queue, call `function(item)` and push the
+    item to the next stage. A stage given as (name, function, workers,
+    batch_size) instead calls `function(items)` with up to batch_size items
+    that are already waiting in its queue; when that call raises, the items
+    are passed to `function([item])` one at a time and only those that fail
+    again are dropped. Queues hold at most `queue_size` items, so a fast
+    stage blocks instead of piling up work in front of a slow one.
+
+    Callbacks:
+        on_stage(stage_name, item, busy)  an item entered (busy=True) or left a stage
+        on_done(item)                     an item went through every stage
+        on_error(item, stage_name, exc)   a stage raised; the item is dropped
+    """
+
+    def __init__(self, stages, queue_size=1, on_stage=None, on_done=None, on_error=None):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.on_stage = on_stage
+        self.on_done = on_done
+        self.on_error = on_error
+        self.queues = []
+
+
+    def queue_depths(self):
+        # items waiting in front of each stage, empty when not running
+        return {stage[0]: stage_queue.qsize() for stage, stage_queue in zip(self.stages, self.queues)}
+
+
+    def run(self, items):
+        queues = [queue.Queue(maxsize=max(1, self.queue_size)) for _ in self.stages]
+        self.queues = queues
+        remaining = [max(1, stage[2]) for stage in self.stages]
+        lock = threading.Lock()
+        threads = []
+
+        for index, stage in enumerate(self.stages):
+            name, function, workers = stage[:3]
+            batch_size = stage[3] if len(stage) > 3 else None
+            for _ in range(max(1, workers)):
+                thread = threading.Thread(
+                    target=self._work,
+                    args=(index, name, function, batch_size, queues, remaining, lock),
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+
+        for item in items:
+            queues[0].put(item)
+        for _ in range(remaining[0]):
+            queues[0].put(_STOP)
+
+        for thread in threads:
+            thread.join()
+        self.queues = []
+
+
+    def _work(self, index, name, function, batch_size, queues, remaining, lock):
+        last = index == len(self.stages) - 1
+        stopped = False
+        while not stopped:
+            item = queues[index].get()
+            if item is _STOP:
+                break
+            items = [item]
+            # batch whatever is already queued, without waiting for more
+            while batch_size and len(items) < batch_size:
+                try:
+                    item = queues[index].get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopped = True
+                    break
+                items.append(item)
+
+            for item in items:
+                self._notify(self.on_stage, name, item, True)
+            errors = {}
+            try:
+                if batch_size:
+                    function(items)
+                else:
+                    function(items[0])
+            except Exception as exc:
+                print(traceback.format_exc())
+                errors = {0: exc} if len(items) == 1 else self._one_by_one(function, items)
+            for position, item in enumerate(items):
+                self._notify(self.on_stage, name, item, False)
+                if position in errors:
+                    self._notify(self.on_error, item, name, errors[position])
+                elif last:
+                    self._notify(self.on_done, item)
+                else:
+                    queues[index + 1].put(item)
+
+        # the last worker of a stage to stop tells the next stage to stop
+        with lock:
+            remaining[index] -= 1
+            stop_next = remaining[index] == 0 and not last
+        if stop_next:
+            for _ in range(remaining[index + 1]):
+                queues[index + 1].put(_STOP)
+
+
+    def _one_by_one(self, function, items):
+        # a batch that raised is run again one item at a time, so that only
+        # the items that fail on their own are dropped; {position: exception}
+        errors = {}
+        for position, item in enumerate(items):
+            try:
+                function([item])
+            except Exception as exc:
+                print(traceback.format_exc())
+                errors[position] = exc
+        return errors
+
+
+    def _notify(self, callback, *args):
+        if callback is None:
+            return
+        try:
+            callback(*args)
+        except Exception:
+            print(traceback.format_exc())
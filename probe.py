@@ -0,0 +1,174 @@
+import json
+import os
+import sqlite3
+import subprocess
+import threading
+
+import mutagen
+
+from metadata import read_tags
+from paths import cache_path
+
+
+def default_cache_path():
+    return cache_path("probe.sqlite")
+
+
+class MediaInfo:
+    """Everything StemGen needs to know about an input file, from one probe."""
+
+    def __init__(self, codec=None, bit_depth=0, sample_rate=0, channels=0, duration=0.0, has_cover=False, tags=None, error=None):
+        self.codec = codec
+        self.bit_depth = bit_depth
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.duration = duration
+        self.has_cover = has_cover
+        self.tags = tags if tags is not None else {}
+        self.error = error
+
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**values)
+
+
+class MediaProbe:
+    """Probes audio files with a single ffprobe call and caches the results.
+
+    Records are stored in a SQLite database keyed by path, size and mtime, so
+    files that did not change since the last run are never probed again.
+    Pass cache_path=None to disable the on-disk cache.
+    """
+
+    def __init__(self, cache_path=""):
+        if cache_path == "":
+            cache_path = default_cache_path()
+        self.cache_path = cache_path
+        self.connection = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def _connect(self):
+        if self.connection is None and self.cache_path:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+            self.connection = sqlite3.connect(self.cache_path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS probes (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, record TEXT)"
+            )
+            self.connection.commit()
+        return self.connection
+
+
+    def cached(self, path):
+        # the cached record for an unchanged file, without probing it
+        # otherwise; None too for a file that is missing or cannot be read,
+        # which probe() then reports
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            connection = self._connect()
+            if connection is None:
+                return None
+            row = connection.execute(
+                "SELECT record FROM probes WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, stat.st_size, stat.st_mtime_ns),
+            ).fetchone()
+        if row is None:
+            return None
+        return MediaInfo.from_dict(json.loads(row[0]))
+
+
+    def probe(self, path):
+        path = os.path.abspath(path)
+        info = self.cached(path)
+        if info is not None:
+            self.hits += 1
+            return info
+        self.misses += 1
+
+        stat = os.stat(path)
+        info = self._probe(path)
+
+        with self.lock:
+            connection = self._connect()
+            if connection is not None:
+                connection.execute(
+                    "INSERT OR REPLACE INTO probes (path, size, mtime_ns, record) VALUES (?, ?, ?, ?)",
+                    (path, stat.st_size, stat.st_mtime_ns, json.dumps(info.to_dict(), default=str)),
+                )
+                connection.commit()
+        return info
+
+
+    def _probe(self, path):
+        filename = os.path.basename(path)
+        extension = os.path.splitext(filename)[1]
+        try:
+            output = subprocess.check_output(
+                [
+                    "ffprobe",
+                    "-v",
+                    "error",
+                    "-show_streams",
+                    "-show_format",
+                    "-of",
+                    "json",
+                    path,
+                ]
+            )
+        except subprocess.CalledProcessError as exc:
+            # unreadable files are cached too, so they are not probed again
+            return MediaInfo(error=str(exc))
+
+        probed = json.loads(output)
+        streams = probed.get("streams", [])
+        audio = next((stream for stream in streams if stream.get("codec_type") == "audio"), None)
+        if audio is None:
+            return MediaInfo(error=f"No audio stream in {filename}")
+
+        # same fields get_bit_depth used to read
+        if extension == ".flac":
+            bit_depth = audio.get("bits_per_raw_sample", 0)
+        else:
+            bit_depth = audio.get("bits_per_sample", 0)
+
+        has_cover = any(
+            stream.get("codec_type") == "video" and stream.get("disposition", {}).get("attached_pic") == 1
+            for stream in streams
+        )
+
+        try:
+            file = mutagen.File(path)
+            # ffprobe does not report ID3 cover art in WAV/AIFF, mutagen does
+            if extension in (".wav", ".wave", ".aif", ".aiff"):
+                has_cover = file is not None and "APIC:" in file
+            tags = read_tags(path, os.path.splitext(filename)[0], file) if file is not None else {}
+        except Exception:
+            tags = {}
+
+        return MediaInfo(
+            codec=audio.get("codec_name"),
+            bit_depth=int(bit_depth or 0),
+            sample_rate=int(audio.get("sample_rate", 0)),
+            channels=int(audio.get("channels", 0)),
+            duration=float(audio.get("duration") or probed.get("format", {}).get("duration") or 0),
+            has_cover=has_cover,
+            tags=tags,
+        )
+
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
@@ -0,0 +1,79 @@
+import contextlib
+import resource
+import threading
+import time
+
+
+def _thread_io():
+    # (bytes read, bytes written) by the calling thread, Linux only
+    read = written = 0
+    try:
+        with open("/proc/thread-self/io") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    read = int(line.split()[1])
+                elif line.startswith("wchar:"):
+                    written = int(line.split()[1])
+    except OSError:
+        pass
+    return read, written
+
+
+def snapshot(process_cpu=False):
+    # Wall time, CPU time of this thread, CPU time of finished child
+    # processes (sox, ffmpeg, MP4Box), and bytes read and written by this
+    # thread plus the blocks read and written by finished children. With
+    # process_cpu the CPU time is the whole process's, which includes
+    # torch's intra-op threads but also any other track being processed.
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read, written = _thread_io()
+    return {
+        "wall": time.perf_counter(),
+        "cpu": time.process_time() if process_cpu else time.thread_time(),
+        "children_cpu": children.ru_utime + children.ru_stime,
+        "read_bytes": read + children.ru_inblock * 512,
+        "written_bytes": written + children.ru_oublock * 512,
+    }
+
+
+def difference(start, end):
+    return {key: end[key] - start[key] for key in start}
+
+
+class StageProfiler:
+    """Sums wall time, CPU time and I/O bytes of named steps.
+
+    Steps nest: "save" includes the "encode", "mux" and "tag" steps done
+    while saving. Child process figures are process wide, so they are only
+    attributed correctly when one track is processed at a time; so is CPU
+    time with process_cpu, which counts the threads torch separates with
+    rather than only the one that called it.
+    """
+
+    def __init__(self, process_cpu=False):
+        self.steps = {}
+        self.lock = threading.Lock()
+        self.process_cpu = process_cpu
+
+
+    @contextlib.contextmanager
+    def span(self, step, **labels):
+        start = snapshot(self.process_cpu)
+        try:
+            yield
+        finally:
+            self.add(step, difference(start, snapshot(self.process_cpu)))
+
+
+    def add(self, step, measures):
+        with self.lock:
+            totals = self.steps.setdefault(step, dict.fromkeys(measures, 0))
+            totals["count"] = totals.get("count", 0) + 1
+            for key, value in measures.items():
+                totals[key] += value
+
+
+    def reset(self):
+        with self.lock:
+            steps, self.steps = self.steps, {}
+        return steps
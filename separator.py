@@ -0,0 +1,461 @@
+import contextlib
+import multiprocessing
+import os
+import random
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import demucs
+import torch
+from demucs.apply import BagOfModels, TensorChunk, tensor_chunk
+from demucs.htdemucs import HTDemucs
+from demucs.pretrained import get_model
+from demucs.separate import load_track
+from demucs.utils import center_trim
+
+from audio import SAMPLE_RATE, save_wav
+from paths import cache_path
+
+
+def _apply_model_batched(model, mixes, device, shifts, overlap, segment, batch_size):
+    # demucs.apply.apply_model(split=True) for several (1, channels, length)
+    # mixes of different lengths at once. Every track is shifted, cut into
+    # overlapping segments and each segment padded exactly as apply_model
+    # does for that track alone; the padded segments of all tracks are then
+    # run batch_size at a time, and overlap-added back per track. The shift
+    # offsets come from a generator of their own seeded with 0, the same for
+    # every track, instead of the process-wide `random`. The model runs on
+    # device, the results stay on the device of the mixes.
+    generator = random.Random(0)
+    if isinstance(model, BagOfModels):
+        submodels = list(zip(model.models, model.weights))
+    else:
+        submodels = [(model, None)]
+    estimates = [0.0] * len(mixes)
+    totals = [0.0] * len(model.sources)
+    for submodel, weights in submodels:
+        outputs = _apply_submodel_batched(submodel, mixes, device, shifts, overlap, segment, batch_size, generator)
+        if weights is not None:
+            for output in outputs:
+                for index, weight in enumerate(weights):
+                    output[:, index] *= weight
+            for index, weight in enumerate(weights):
+                totals[index] += weight
+        estimates = [estimate + output for estimate, output in zip(estimates, outputs)]
+    if isinstance(model, BagOfModels):
+        for estimate in estimates:
+            for index, total in enumerate(totals):
+                estimate[:, index] /= total
+    return estimates
+
+
+def _apply_submodel_batched(model, mixes, device, shifts, overlap, segment, batch_size, generator):
+    max_shift = int(0.5 * model.samplerate)
+    outputs = [0.0] * len(mixes)
+    for _ in range(max(shifts, 1)):
+        if shifts:
+            offset = generator.randint(0, max_shift)
+            inputs = []
+            for mix in mixes:
+                length = mix.shape[-1]
+                padded = tensor_chunk(mix).padded(length + 2 * max_shift)
+                inputs.append(TensorChunk(padded, offset, length + max_shift - offset))
+        else:
+            inputs = [tensor_chunk(mix) for mix in mixes]
+        split = _split_batched(model, inputs, device, overlap, segment, batch_size)
+        for index, out in enumerate(split):
+            outputs[index] = outputs[index] + (out[..., max_shift - offset:] if shifts else out)
+    if shifts:
+        outputs = [output / shifts for output in outputs]
+    return outputs
+
+
+def _split_batched(model, chunks, device, overlap, segment, batch_size):
+    # the split branch of apply_model, with the leaf forward passes of all
+    # tracks pooled and run batch_size padded segments at a time
+    segment_length = int(model.samplerate * (segment or model.segment))
+    stride = int((1 - overlap) * segment_length)
+    weight = torch.cat([
+        torch.arange(1, segment_length // 2 + 1),
+        torch.arange(segment_length - segment_length // 2, 0, -1),
+    ])
+    mix_device = chunks[0].tensor.device
+    weight = (weight / weight.max()).to(mix_device)
+    outs, sum_weights = [], []
+    for chunk in chunks:
+        batch, channels, length = chunk.shape
+        outs.append(torch.zeros(batch, len(model.sources), channels, length, device=mix_device))
+        sum_weights.append(torch.zeros(length, device=mix_device))
+
+    def forward(pending):
+        outputs = model(torch.cat([padded for _, _, _, padded in pending]).to(device)).to(mix_device)
+        for (index, offset, length, _), output in zip(pending, outputs):
+            output = center_trim(output[None], length)
+            outs[index][..., offset:offset + segment_length] += weight[:length] * output
+            sum_weights[index][offset:offset + segment_length] += weight[:length]
+
+    # one segment of each track in turn; segments padded to different
+    # lengths (models without a fixed training length) are not batched together
+    pending = {}
+    starts = [range(0, chunk.length, stride) for chunk in chunks]
+    for position in range(max(len(offsets) for offsets in starts)):
+        for index, chunk in enumerate(chunks):
+            if position >= len(starts[index]):
+                continue
+            offset = starts[index][position]
+            piece = TensorChunk(chunk, offset, segment_length)
+            if isinstance(model, HTDemucs) and segment is not None:
+                valid_length = int(segment * model.samplerate)
+            elif hasattr(model, "valid_length"):
+                valid_length = model.valid_length(piece.length)
+            else:
+                valid_length = piece.length
+            group = pending.setdefault(valid_length, [])
+            group.append((index, offset, piece.length, piece.padded(valid_length)))
+            if len(group) == batch_size:
+                forward(group)
+                del pending[valid_length]
+    for group in pending.values():
+        forward(group)
+    return [out / sum_weight for out, sum_weight in zip(outs, sum_weights)]
+
+
+# model precisions and inference backends a Separator can run with
+PRECISIONS = ("auto", "fp32", "bf16", "int8")
+BACKENDS = ("torch", "onnx")
+
+
+def cpu_supports_bf16():
+    # native bfloat16 instructions: AVX-512 BF16 or AMX on x86, BF16 on Arm
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith(("flags", "Features")):
+                    flags = line.split(":", 1)[1].split()
+                    return any(flag in flags for flag in ("avx512_bf16", "amx_bf16", "bf16"))
+    except OSError:
+        pass
+    return False
+
+
+def resolve_precision(precision, device="cpu", backend="torch"):
+    # The precision a separator really runs with: "auto" is bf16 where the
+    # CPU has native bf16 instructions and fp32 elsewhere, and a precision
+    # the device or backend cannot run falls back to fp32.
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision should be one of {PRECISIONS}, not {precision}")
+    supported = device == "cpu" and backend == "torch"
+    if precision == "auto":
+        return "bf16" if supported and cpu_supports_bf16() else "fp32"
+    if precision != "fp32" and not supported:
+        print(f"{precision} inference needs the torch backend on the CPU, running in fp32")
+        return "fp32"
+    if precision == "bf16" and not cpu_supports_bf16():
+        # emulated bf16 is slower than fp32
+        print("This CPU has no native bfloat16 instructions, running in fp32")
+        return "fp32"
+    return precision
+
+
+def _in_fp32(method):
+    def method_in_fp32(*args, **kwargs):
+        args = [arg.float() if torch.is_tensor(arg) and arg.is_floating_point() else arg for arg in args]
+        with torch.autocast("cpu", enabled=False):
+            return method(*args, **kwargs)
+    return method_in_fp32
+
+
+def keep_spectrograms_fp32(model):
+    # Under bf16 autocast the STFT, masking and iSTFT of the hybrid models
+    # still run in fp32: there is no bf16 complex type, and the phase needs
+    # more precision than bf16 has. Only the network runs in bf16.
+    for submodel in (model.models if hasattr(model, "models") else [model]):
+        for name in ("_spec", "_ispec", "_magnitude", "_mask"):
+            if hasattr(submodel, name):
+                setattr(submodel, name, _in_fp32(getattr(submodel, name)))
+    return model
+
+
+def default_model_directory():
+    return cache_path("models")
+
+
+def quantized_model(model_name, directory=None):
+    # Dynamic int8 quantization of the Linear and LSTM layers (the
+    # transformer of htdemucs, the BLSTMs of the older models): weights are
+    # stored as int8 and activations quantized on the fly, convolutions stay
+    # fp32. Built once and kept on disk; the file name includes the torch and
+    # demucs versions since a pickled quantized module only loads back into
+    # the versions that wrote it.
+    directory = directory or default_model_directory()
+    path = os.path.join(directory, f"{model_name}-int8-torch{torch.__version__}-demucs{demucs.__version__}.pt")
+    if os.path.isfile(path):
+        try:
+            return torch.load(path, weights_only=False)
+        except Exception as exc:
+            print(f"Ignoring unreadable quantized model {path}: {exc}")
+    model = get_model(model_name)
+    model.eval()
+    model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8)
+    os.makedirs(directory, exist_ok=True)
+    # written to a temporary file first, several processes may build it at once
+    temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+    torch.save(model, temporary)
+    os.replace(temporary, path)
+    return model
+
+
+class Separator:
+    """Keeps one demucs model loaded and applies it to any number of tracks.
+
+    demucs.separate.main() parses its arguments and loads the weights from
+    disk on every call. A Separator does that once and is then reused for
+    every track of a run.
+    """
+
+    def __init__(self, model_name, shifts=1, device="cpu", overlap=0.25, segment=None, precision="fp32", backend="torch"):
+        if backend not in BACKENDS:
+            raise ValueError(f"backend should be one of {BACKENDS}, not {backend}")
+        # what a run's settings have to match for the separator to be reused
+        self.settings = (model_name, int(shifts), overlap, segment, precision, backend)
+        self.model_name = model_name
+        self.shifts = int(shifts)
+        self.device = device
+        self.overlap = overlap
+        self.segment = segment
+        # "bf16" runs the model under CPU bfloat16 autocast, "int8" quantizes
+        # it dynamically; both CPU only
+        self.requested_precision = precision
+        self.precision = resolve_precision(precision, device, backend)
+        # "onnx" runs the network with ONNX Runtime on the CPU
+        self.backend = backend
+        self.model = None
+        # one forward pass at a time: threads sharing the separator queue up
+        # here instead of oversubscribing the cores
+        self.lock = threading.RLock()
+
+
+    @property
+    def sources(self):
+        return self.load().sources
+
+
+    @property
+    def samplerate(self):
+        return self.load().samplerate
+
+
+    def load(self):
+        with self.lock:
+            if self.model is None:
+                if self.backend == "onnx" and self.device != "cpu":
+                    print(f"The ONNX backend runs on the CPU only, using torch on {self.device}")
+                    self.backend = "torch"
+                if self.backend == "onnx":
+                    from onnx_backend import onnx_model
+
+                    model = onnx_model(self.model_name)
+                elif self.precision == "int8":
+                    model = quantized_model(self.model_name)
+                else:
+                    model = get_model(self.model_name)
+                    model.to(self.device)
+                    if self.precision == "bf16":
+                        keep_spectrograms_fp32(model)
+                model.eval()
+                self.model = model
+            return self.model
+
+
+    def autocast(self):
+        if self.precision == "bf16":
+            return torch.autocast("cpu", dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+
+    @property
+    def max_segment(self):
+        # longest segment the model accepts, in seconds: the one it was trained on
+        model = self.load()
+        inner = model.models[0] if hasattr(model, "models") else model
+        return float(inner.segment)
+
+
+    def separate(self, wav, segment=None):
+        # wav is a (channels, samples) float tensor at the model sample rate.
+        # Returns a dict mapping each source name to a (channels, samples) tensor.
+        return self.separate_batch([wav], segment)[0]
+
+
+    def separate_batch(self, wavs, segment=None):
+        # Separates several tracks of any lengths with one batched forward
+        # pass per group of segments, one segment from each track. Each
+        # segment is cut and padded as demucs does for a track alone, so
+        # each result matches the unbatched one. A shorter segment than the
+        # separator's lowers peak memory.
+        model = self.load()
+        refs = [wav.mean(0) for wav in wavs]
+        mixes = [((wav - ref.mean()) / ref.std())[None] for wav, ref in zip(wavs, refs)]
+        # under bf16 autocast the stems are still accumulated and returned in fp32
+        with self.lock, torch.no_grad(), self.autocast():
+            sources = _apply_model_batched(model, mixes, self.device, self.shifts, self.overlap, segment or self.segment, len(wavs))
+
+        results = []
+        for track_sources, ref in zip(sources, refs):
+            track_sources = track_sources[0] * ref.std() + ref.mean()
+            results.append(dict(zip(model.sources, track_sources)))
+        return results
+
+
+    def separate_file(self, track, output_directory, int24=False, segment=None):
+        # Same layout and sample format as `demucs.separate` would produce:
+        # <output_directory>/<stem>.wav
+        return self.separate_files([track], [output_directory], [int24], segment)[0]
+
+
+    def separate_files(self, tracks, output_directories, int24s, segment=None):
+        model = self.load()
+        wavs = [load_track(track, model.audio_channels, model.samplerate) for track in tracks]
+        return self.separate_audios(wavs, output_directories, int24s, segment)
+
+
+    def separate_audios(self, wavs, output_directories, int24s, segment=None):
+        # wavs are already decoded (channels, samples) tensors at the model sample rate
+        results = self.separate_batch(wavs, segment)
+        for sources, output_directory, int24 in zip(results, output_directories, int24s):
+            self.save_sources(sources, output_directory, int24)
+        return results
+
+
+    def save_sources(self, sources, output_directory, int24=False):
+        if not os.path.exists(output_directory):
+            os.makedirs(output_directory)
+
+        for name, source in sources.items():
+            save_wav(source, os.path.join(output_directory, f"{name}.wav"), self.samplerate, int24)
+
+
+# Separator living in a SeparatorPool worker process
+_worker_separator = None
+
+
+def _init_worker(model_name, shifts, device, threads, precision="fp32", backend="torch", overlap=0.25, segment=None):
+    global _worker_separator
+    if threads:
+        torch.set_num_threads(threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            # already set for this process
+            pass
+    _worker_separator = Separator(model_name, shifts, device, overlap, segment, precision, backend)
+    _worker_separator.load()
+
+
+def _separate_files_in_worker(tracks, output_directories, int24s, segment=None):
+    _worker_separator.separate_files(tracks, output_directories, int24s, segment)
+    return output_directories
+
+
+def _separate_batch_in_worker(wavs, segment=None):
+    return _worker_separator.separate_batch(wavs, segment)
+
+
+def _separate_audios_in_worker(wavs, output_directories, int24s, segment=None):
+    _worker_separator.separate_audios(wavs, output_directories, int24s, segment)
+    return output_directories
+
+
+class SeparatorPool:
+    """Separates tracks in `processes` worker processes, one track per worker.
+
+    Each worker loads its own model once and is limited to `threads` torch
+    intra-op threads, so that processes * threads matches the cores of the
+    machine. The stems are written by the workers and the output directory
+    is handed back to the caller. Works with the `spawn` start method.
+    """
+
+    def __init__(self, model_name, shifts=1, device="cpu", processes=2, threads=None, precision="fp32", backend="torch", overlap=0.25, segment=None):
+        self.model_name = model_name
+        self.shifts = int(shifts)
+        self.device = device
+        self.overlap = overlap
+        self.segment = segment
+        self.requested_precision = precision
+        self.precision = resolve_precision(precision, device, backend)
+        self.backend = backend
+        self.processes = max(1, processes)
+        self.threads = threads or max(1, (os.cpu_count() or 1) // self.processes)
+        # what a run's settings have to match for the pool to be reused
+        self.settings = (model_name, int(shifts), overlap, segment, precision, backend, self.processes, threads)
+        self.executor = None
+        self.lock = threading.Lock()
+        # set when a call failed on a restarted pool too, so that a run does
+        # not keep the pool
+        self.broken = False
+
+
+    def start(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.model_name, self.shifts, self.device, self.threads, self.precision, self.backend, self.overlap, self.segment),
+                )
+            return self.executor
+
+
+    def call(self, fn, *args):
+        # Runs fn(*args) in a worker and blocks the calling thread until it is
+        # done. A worker that died (killed for memory, crashed in native code)
+        # breaks the whole executor: it is shut down and started again once.
+        # Of several split workers that hit the same broken executor, only
+        # the first drops it.
+        for attempt in range(2):
+            executor = self.start()
+            try:
+                return executor.submit(fn, *args).result()
+            except BrokenProcessPool:
+                with self.lock:
+                    if self.executor is executor:
+                        self.executor = None
+                executor.shutdown()
+                if attempt:
+                    self.broken = True
+                    raise
+
+
+    def separate_file(self, track, output_directory, int24=False, segment=None):
+        return self.separate_files([track], [output_directory], [int24], segment)[0]
+
+
+    def separate_files(self, tracks, output_directories, int24s, segment=None):
+        return self.call(_separate_files_in_worker, tracks, output_directories, int24s, segment)
+
+
+    def separate(self, wav, segment=None):
+        return self.separate_batch([wav], segment)[0]
+
+
+    def separate_batch(self, wavs, segment=None):
+        return self.call(_separate_batch_in_worker, wavs, segment)
+
+
+    @property
+    def samplerate(self):
+        return SAMPLE_RATE
+
+
+    def separate_audios(self, wavs, output_directories, int24s, segment=None):
+        return self.call(_separate_audios_in_worker, wavs, output_directories, int24s, segment)
+
+
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown()
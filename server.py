@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""Local HTTP job server around the StemGen engine.
+
+    POST   /jobs              {"paths": [...], "recursive": false, "overwrite": false, "preset": "draft"}
+    GET    /jobs              every job
+    GET    /jobs/<id>         status, current stage, error and output of a job
+    DELETE /jobs/<id>         cancel a job
+    GET    /jobs/<id>/result  the .stem.m4a file of a finished job
+    GET    /presets           presets and their measured speed on this machine
+
+Paths are files, directories or glob patterns on this machine, expanded
+like on the command line. The server only listens on localhost.
+"""
+import argparse
+import contextlib
+import json
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+import traceback
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cli import collect_tracks, open_telemetry, parse_size
+from memory import available_memory
+from stemgen import PRESETS, StemGen, preset_speeds
+from telemetry import Telemetry
+
+
+FINISHED = ("processed", "skipped", "failed", "cancelled")
+
+
+class Job:
+    def __init__(self, path, overwrite=False, preset=None):
+        self.id = uuid.uuid4().hex
+        self.path = path
+        self.overwrite = overwrite
+        # None = the server's settings
+        self.preset = preset
+        # queued, running, then one of FINISHED
+        self.status = "queued"
+        self.stage = None
+        self.error = None
+        self.output = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        # the worker's StemGen while the job is running
+        self.engine = None
+
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "path": self.path,
+            "preset": self.preset,
+            "status": self.status,
+            "stage": self.stage,
+            "error": self.error,
+            "output": self.output,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class JobQueue:
+    """Jobs shared by the HTTP handlers and a pool of workers.
+
+    Each worker owns a StemGen but all of them use the same loaded
+    separator, so the model is in memory once; forward passes are serialized
+    on it while the other workers prepare and save their tracks. Jobs with a
+    preset of their own share a separator for that preset. A file that
+    already has a queued or running job is not queued twice: submitting it
+    again returns the existing job.
+    """
+
+    def __init__(self, workers=2, configure=None):
+        self.jobs = {}
+        self.active = {}
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        # configure(stemgen) applies the server options to each worker's engine
+        self.configure = configure or (lambda stemgen: None)
+        # separators by StemGen.separator_settings()
+        self.separators = {}
+        self.threads = [threading.Thread(target=self.work, name=f"worker-{index}", daemon=True) for index in range(workers)]
+
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+
+    def submit(self, paths, overwrite=False, preset=None):
+        submitted = []
+        with self.lock:
+            for path in paths:
+                job = self.active.get(path)
+                coalesced = job is not None
+                if not coalesced:
+                    job = Job(path, overwrite, preset)
+                    self.jobs[job.id] = job
+                    self.active[path] = job
+                    self.pending.put(job)
+                submitted.append({"id": job.id, "path": path, "coalesced": coalesced})
+        return submitted
+
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return job.to_dict() if job else None
+
+
+    def list(self):
+        with self.lock:
+            return [job.to_dict() for job in self.jobs.values()]
+
+
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.status in FINISHED:
+                return job.to_dict() if job else None
+            if job.status == "queued":
+                self.finish(job, "cancelled")
+            else:
+                # dropped by the engine before its next stage
+                job.engine.cancel(job.path)
+            return job.to_dict()
+
+
+    def finish(self, job, status, **details):
+        # called with the lock held
+        job.status = status
+        job.error = details.get("error", job.error)
+        job.output = details.get("output", job.output)
+        job.finished = time.time()
+        if self.active.get(job.path) is job:
+            del self.active[job.path]
+
+
+    def separator_for(self, stemgen):
+        with self.lock:
+            settings = stemgen.separator_settings()
+            if settings not in self.separators:
+                # loads the model on first use
+                self.separators[settings] = stemgen.create_separator()
+            return self.separators[settings]
+
+
+    def work(self):
+        stemgen = StemGen()
+        self.configure(stemgen)
+        # the server's settings, restored after a job with a preset of its own
+        defaults = {setting: getattr(stemgen, setting) for setting in list(PRESETS["standard"]) + ["preset"]}
+        current = {}
+
+        def on_stage(track, stage, busy):
+            with self.lock:
+                if busy and track in current:
+                    current[track].stage = stage
+
+        def on_result(result):
+            with self.lock:
+                job = current.get(result["track"])
+                if job is not None:
+                    self.finish(job, result["status"], error=result.get("error") or result.get("reason"), output=result.get("output"))
+
+        stemgen.track_stage.connect(on_stage)
+        stemgen.track_result.connect(on_result)
+        while True:
+            job = self.pending.get()
+            stemgen.clear_results()
+            stemgen.overwrite_existing = job.overwrite
+            for setting, value in defaults.items():
+                setattr(stemgen, setting, value)
+            with self.lock:
+                if job.status != "queued":
+                    continue
+                job.status = "running"
+                job.started = time.time()
+                job.engine = stemgen
+                current[job.path] = job
+            failure = None
+            try:
+                if job.preset:
+                    stemgen.apply_preset(job.preset)
+                stemgen.separator = self.separator_for(stemgen)
+                stemgen.run([job.path])
+            except Exception as exc:
+                # the job fails, the worker goes on with the next one
+                traceback.print_exc()
+                failure = str(exc) or type(exc).__name__
+            with self.lock:
+                del current[job.path]
+                job.engine = None
+                if job.status == "running":
+                    # the engine stopped before it got to the track (setup error)
+                    self.finish(job, "failed", error=failure or ", ".join(str(error) for error in stemgen.errors) or "not processed")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "StemGen"
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def route(self):
+        # ("jobs", job id or None, "result" or None), or None for an unknown path
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        if not parts or parts[0] != "jobs" or len(parts) > 3 or (len(parts) == 3 and parts[2] != "result"):
+            return None
+        return parts[0], parts[1] if len(parts) > 1 else None, parts[2] if len(parts) > 2 else None
+
+
+    def do_GET(self):
+        if self.path.split("?")[0].rstrip("/") == "/presets":
+            speeds = preset_speeds()
+            return self.send_json(200, {"presets": {name: dict(settings, audio_seconds_per_second=speeds.get(name)) for name, settings in PRESETS.items()}})
+        route = self.route()
+        if route is None:
+            return self.send_json(404, {"error": "not found"})
+        _, job_id, result = route
+        if job_id is None:
+            return self.send_json(200, {"jobs": self.server.jobs.list()})
+        job = self.server.jobs.get(job_id)
+        if job is None:
+            return self.send_json(404, {"error": "no such job"})
+        if result is None:
+            return self.send_json(200, job)
+        if job["status"] not in ("processed", "skipped") or not job["output"] or not os.path.isfile(job["output"]):
+            return self.send_json(409, {"error": "no result", "status": job["status"]})
+        with open(job["output"], "rb") as f:
+            self.send_response(200)
+            self.send_header("Content-Type", "audio/mp4")
+            self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+            self.send_header("Content-Disposition", f"attachment; filename=\"{os.path.basename(job['output'])}\"")
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile)
+
+
+    def do_POST(self):
+        route = self.route()
+        if route is None or route[1] is not None:
+            return self.send_json(404, {"error": "not found"})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            paths = body["paths"]
+            if isinstance(paths, str):
+                paths = [paths]
+        except (ValueError, KeyError, TypeError):
+            return self.send_json(400, {"error": "expected a JSON object with a \"paths\" list"})
+        preset = body.get("preset")
+        if preset is not None and preset not in PRESETS:
+            return self.send_json(400, {"error": f"unknown preset, should be one of {', '.join(PRESETS)}"})
+        tracks = collect_tracks(paths, self.server.supported_files, bool(body.get("recursive")))
+        if not tracks:
+            return self.send_json(400, {"error": "no tracks found"})
+        self.send_json(202, {"jobs": self.server.jobs.submit(tracks, bool(body.get("overwrite")), preset)})
+
+
+    def do_DELETE(self):
+        route = self.route()
+        if route is None or route[1] is None or route[2] is not None:
+            return self.send_json(404, {"error": "not found"})
+        job = self.server.jobs.cancel(route[1])
+        if job is None:
+            return self.send_json(404, {"error": "no such job"})
+        self.send_json(200, job)
+
+
+def serve(port=8765, workers=2, configure=None):
+    jobs = JobQueue(workers, configure)
+    server = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+    server.daemon_threads = True
+    server.jobs = jobs
+    server.supported_files = StemGen().supported_files
+    jobs.start()
+    print(f"stemgen server listening on http://127.0.0.1:{server.server_address[1]}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="StemGen job server, localhost only")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("-j", "--workers", type=int, default=2)
+    parser.add_argument("--preset", choices=list(PRESETS), help="settings of jobs without a preset (default: standard)")
+    parser.add_argument("-n", "--model", help="overrides the preset's model")
+    parser.add_argument("--shifts", type=int, help="overrides the preset's shifts")
+    parser.add_argument("--precision", choices=["auto", "fp32", "bf16", "int8"], default="auto", help="bf16: bfloat16 autocast on CPUs with AVX-512 BF16/AMX, picked by auto; int8: dynamically quantized model, CPU only")
+    parser.add_argument("--backend", choices=["torch", "onnx"], default="torch", help="onnx: run HTDemucs models with ONNX Runtime on the CPU")
+    parser.add_argument("--cache-dir", help="cache separated stems in this directory")
+    parser.add_argument("--memory-budget", type=parse_size, metavar="SIZE", help="estimated peak memory of all workers together, e.g. 8G (default: 80%% of available memory)")
+    parser.add_argument("--telemetry", metavar="FILE", help="write a JSON line per timed stage and step to FILE ('-' for stderr)")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+    args = parser.parse_args(argv)
+    if args.backend == "onnx" and args.precision not in ("auto", "fp32"):
+        parser.error(f"--precision {args.precision} needs the torch backend")
+
+    # one Telemetry shared by every worker
+    telemetry = None
+    if args.telemetry or args.metrics_port:
+        telemetry = Telemetry(open_telemetry(args.telemetry))
+        if args.metrics_port:
+            telemetry.serve(args.metrics_port)
+
+    # workers run side by side, each gets its share of the budget
+    budget = args.memory_budget
+    if budget is None and available_memory():
+        budget = int(available_memory() * 0.8)
+    workers = max(1, args.workers)
+
+    def configure(stemgen):
+        if args.preset:
+            stemgen.apply_preset(args.preset)
+        if args.model:
+            stemgen.model_name = args.model
+        if args.shifts is not None:
+            stemgen.model_shifts = str(args.shifts)
+        stemgen.model_precision = args.precision
+        stemgen.separation_backend = args.backend
+        stemgen.cache_directory = args.cache_dir
+        stemgen.memory_budget = budget // workers if budget else None
+        if telemetry is not None:
+            telemetry.attach(stemgen)
+
+    # engine progress goes to stderr like the CLI
+    with contextlib.redirect_stdout(sys.stderr):
+        serve(args.port, workers, configure)
+
+
+if __name__ == "__main__":
+    main()
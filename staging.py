@@ -0,0 +1,54 @@
+import ctypes
+import ctypes.util
+import os
+import platform
+import shutil
+
+# ioctl request to clone a file on Linux (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def _reflink(source, destination):
+    # Copy-on-write clone: the new file shares the blocks of the source until
+    # one of them is modified. Returns False when the filesystem can't do it.
+    system = platform.system()
+    if system == "Linux":
+        import fcntl
+
+        try:
+            with open(source, "rb") as src, open(destination, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError:
+            if os.path.exists(destination):
+                os.remove(destination)
+            return False
+    if system == "Darwin":
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "clonefile"):
+            return False
+        return libc.clonefile(os.fsencode(source), os.fsencode(destination), 0) == 0
+    return False
+
+
+def stage_file(source, destination):
+    """Makes `destination` a scratch copy of `source` as cheaply as possible.
+
+    Tries a hardlink, then a copy-on-write reflink, and copies the data only
+    if neither is supported. Returns the method used and the number of bytes
+    that had to be copied.
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+
+    try:
+        os.link(source, destination)
+        return "hardlink", 0
+    except OSError:
+        pass
+
+    if _reflink(source, destination):
+        return "reflink", 0
+
+    shutil.copyfile(source, destination)
+    return "copy", os.path.getsize(destination)
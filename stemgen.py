@@ -1,40 +1,239 @@
 import argparse
+import json
 import os
 import shutil
 import sys
 import subprocess
+import threading
 from pathlib import Path
 import unicodedata
 import traceback
-import torch
-import demucs.separate
+import contextlib
 from metadata import get_cover, get_metadata
-from tkinter import filedialog
 
-from ni_stem import StemCreator
+from ni_stem import MemoryTrack, StemCreator
+from separator import Separator, SeparatorPool
+from pipeline import Pipeline
+from probe import MediaProbe
+from staging import stage_file
+from audio import encode_wav, load_audio, save_wav
+from cache import SeparationCache, load_stems, save_stems, separation_key
+from journal import BatchJournal
+from streaming import FfmpegReader, PcmEncoder, StreamingSeparator
+from paths import cache_path
+from memory import MemoryGovernor, free_cached_memory, is_out_of_memory, pads_segments, peak_rss, reset_peak_rss
 
-from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot
 
+_device = None
 
-DEVICE = (
-    ("cuda" if torch.cuda.is_available() else (
-    "mps" if torch.backends.mps.is_available() else "cpu"))
-)
 
-class StemGen(QObject):
-    song_processing = pyqtSignal(str)
-    counts = pyqtSignal(str, int, int, int, int)
-    details_update = pyqtSignal(str)
-    
+def get_device():
+    # Probed on first use rather than at import: probing CUDA/MPS takes a
+    # noticeable part of a cold start.
+    global _device
+    if _device is None:
+        import torch
+
+        _device = "cuda" if torch.cuda.is_available() else ("mps" if torch.backends.mps.is_available() else "cpu")
+    return _device
+
+
+# Named quality/speed trade-offs, applied with StemGen.apply_preset().
+# `benchmark.py presets` measures the audio seconds per second of each on a
+# machine; `stemgen --list-presets` shows them.
+PRESETS = {
+    # one pass without shifts and little segment overlap, AAC output: promos
+    "draft": {"model_name": "htdemucs", "model_shifts": "0", "model_overlap": 0.1, "model_segment": None, "output_codec": "aac"},
+    # the defaults
+    "standard": {"model_name": "htdemucs", "model_shifts": "1", "model_overlap": 0.25, "model_segment": None, "output_codec": "alac"},
+    # the fine-tuned bag of four models, averaged over two shifts with half
+    # overlapping segments: releases
+    "max": {"model_name": "htdemucs_ft", "model_shifts": "2", "model_overlap": 0.5, "model_segment": None, "output_codec": "alac"},
+}
+
+
+def preset_speeds_path():
+    return cache_path("presets.json")
+
+
+def preset_speeds(path=None):
+    # {preset: audio seconds per second} as measured on this machine by
+    # `benchmark.py presets`, empty until it has been run
+    try:
+        with open(path or preset_speeds_path()) as f:
+            results = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {name: result["audio_seconds_per_second"] for name, result in results.get("presets", {}).items()}
+
+
+class TrackJob:
+    def __init__(self, track):
+        self.track = track
+        self.directory = os.path.dirname(track) + "/"
+        self.filename = os.path.basename(track)
+        self.filename_extension = os.path.splitext(self.filename)[1]
+        self.filename_without_extension = self.filename.removesuffix(self.filename_extension)
+        self.copied_track = None
+        self.bit_depth = None
+        self.media = None
+        self.audio = None
+        self.sources = None
+        self.cache_key = None
+        self.cache_hit = False
+        # stems already available (cache or checkpoint), no need to split
+        self.separated = False
+        # last stage finished by an earlier, interrupted run
+        self.resume_from = None
+        # long track separated window by window straight to the encoders
+        self.streamed = False
+        # segment length chosen by the memory governor (None = the model's),
+        # estimated and measured peak memory in bytes
+        self.segment = None
+        self.estimated_bytes = None
+        self.peak_rss = None
+
+
+class TrackCancelled(Exception):
+    pass
+
+
+class Signal:
+    """A list of callbacks, connected and emitted like a Qt signal.
+
+    Callbacks run in the thread that emits, which for StemGen is a pipeline
+    worker. A GUI has to hand the values over to its own thread, which is
+    what the Qt adapter in StemGenApp.py does.
+    """
+
     def __init__(self):
-        super(StemGen, self).__init__()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+
+    def connect(self, callback):
+        with self.lock:
+            self.callbacks.append(callback)
+
+
+    def disconnect(self, callback):
+        with self.lock:
+            self.callbacks.remove(callback)
+
+
+    def emit(self, *args):
+        with self.lock:
+            callbacks = list(self.callbacks)
+        for callback in callbacks:
+            callback(*args)
+
+
+class StemGen:
+    def __init__(self):
+        # song_processing(activity), counts(status, total, processed, skipped,
+        # failed), details_update(details), track_stage(track, stage, busy)
+        # and track_result(result), where result is a dict describing what
+        # happened to one track
+        self.song_processing = Signal()
+        self.counts = Signal()
+        self.details_update = Signal()
+        self.track_stage = Signal()
+        self.track_result = Signal()
         
         self.supported_files = [".wave", ".wav", ".aiff", ".aif", ".flac", ".mp3"]
         self.required_packages = ["ffmpeg", "sox"]
         
         self.model_name = "htdemucs"
         self.model_shifts = "1"
+        # share of a segment overlapping the next one, and segment length in
+        # seconds (None = the model's)
+        self.model_overlap = 0.25
+        self.model_segment = None
+        # codec of the stems and mixdown in the stem file: "alac" or "aac"
+        self.output_codec = "alac"
+        # name of the last preset applied, None when set field by field
+        self.preset = None
+        # "fp32"; "bf16" for bfloat16 autocast on CPUs with native bf16
+        # instructions (AVX-512 BF16, AMX), "auto" picks it where available;
+        # "int8" for dynamically quantized Linear/LSTM layers on the CPU.
+        # Faster, at some cost in quality: `benchmark.py bf16` and `quantized`
+        self.model_precision = "auto"
+        # "torch", or "onnx" to run HTDemucs models with ONNX Runtime on the CPU
+        self.separation_backend = "torch"
         self.overwrite_existing = False
+        self.separator = None
+        self.media_probe = MediaProbe()
+
+        # bytes copied while staging inputs, and how each input was staged
+        self.staged_bytes = 0
+        self.staged_methods = {}
+
+        # pipeline settings: worker threads per stage and queue length between stages
+        self.stage_workers = {"preparing": 1, "splitting": 1, "saving": 1}
+        self.queue_size = 1
+
+        # multi-process separation: number of worker processes (0 = separate in
+        # this process) and torch threads per worker (None = cores / processes)
+        self.separation_processes = 0
+        self.threads_per_process = None
+        # keep the worker processes and their models between runs, for an
+        # engine that runs batch after batch; close() stops them
+        self.keep_separator_pool = False
+
+        # cross-track batching: up to batch_size queued tracks are separated
+        # with one batched forward pass (1 = no batching)
+        self.batch_size = 1
+
+        # decode and resample in this process and hand the tensor straight to
+        # the separator, instead of converting to a 44.1kHz wav with sox
+        self.in_process_decode = True
+        # keep the separated stems in memory and pipe them to the encoder,
+        # instead of writing and reading back stem wav files
+        self.stream_encode = True
+
+        # content-addressed cache of separated stems (None = disabled), only
+        # used with in_process_decode and stream_encode
+        self.cache_directory = None
+        self.cache_max_bytes = 20 * 1024 ** 3
+        self.separation_cache = None
+
+        # per-batch journal of finished stages, so that an interrupted or
+        # failed batch resumes where each track stopped
+        self.use_journal = True
+        self.journal = None
+
+        # tracks longer than streaming_threshold seconds (None = never) are
+        # separated in overlapping windows of streaming_window seconds, so
+        # memory stays flat however long the mix is
+        self.streaming_threshold = 20 * 60
+        self.streaming_window = 60.0
+        self.streaming_overlap = 5.0
+
+        # memory governor: worker processes, batch size and segment length are
+        # lowered, or tracks streamed, to keep the estimated peak under
+        # memory_budget bytes (None = 80% of the memory available when a run
+        # starts), and separation is retried with shorter segments when an
+        # allocation fails
+        self.memory_governor = True
+        self.memory_budget = None
+        self.memory = None
+        self.peak_memory = []
+
+        # per-step timing (wall, CPU, bytes read and written), None = off.
+        # Anything with a span(step, **labels) context manager: a
+        # profiling.StageProfiler or a telemetry.Telemetry
+        self.profiler = None
+        # the pipeline of the run in progress, for queue_depths()
+        self.pipeline = None
+        # None, or a function of the track returning False when its stem file
+        # must not be published any more (a distributed worker that lost its
+        # lease); asked right before the file is moved into place
+        self.may_publish = None
+
+        self.active_stages = {}
+        self.lock = threading.RLock()
+        # tracks to drop at their next stage
+        self.cancelled_tracks = set()
         
         self.tracks = []
         self.processed_tracks = []
@@ -43,6 +242,45 @@ class StemGen(QObject):
         self.errors = []
         
         
+    def apply_preset(self, name):
+        if name not in PRESETS:
+            raise ValueError(f"Unknown preset {name}, should be one of {', '.join(PRESETS)}")
+        for setting, value in PRESETS[name].items():
+            setattr(self, setting, value)
+        self.preset = name
+
+
+    def separator_settings(self):
+        # compared with Separator.settings to decide whether a loaded separator can be reused
+        return (self.model_name, int(self.model_shifts), self.model_overlap, self.model_segment, self.model_precision, self.separation_backend)
+
+
+    def create_separator(self):
+        # in-process separator for the current model settings
+        return Separator(self.model_name, self.model_shifts, get_device(), self.model_overlap, self.model_segment, self.model_precision, self.separation_backend)
+
+
+    def clear_results(self):
+        # for a resident engine that runs batch after batch
+        self.processed_tracks = []
+        self.skipped_tracks = []
+        self.failed_tracks = []
+        self.errors = []
+        self.cancelled_tracks = set()
+        self.peak_memory = []
+
+
+    def cancel(self, track):
+        with self.lock:
+            self.cancelled_tracks.add(track)
+
+
+    def check_cancelled(self, job):
+        with self.lock:
+            if job.track in self.cancelled_tracks:
+                raise TrackCancelled(f"{job.filename} cancelled")
+
+
     @property
     def track_count(self):
         return len(self.tracks)
@@ -70,42 +308,407 @@ class StemGen(QObject):
             print(traceback.format_exc())
             self.emit_error(exc)
             return
-            
+
+        self.staged_bytes = 0
+        self.staged_methods = {}
+        if self.cache_directory and self.in_process_decode and self.stream_encode:
+            self.separation_cache = SeparationCache(self.cache_directory, self.cache_max_bytes)
+        else:
+            self.separation_cache = None
+
         self.tracks = tracks
         if self.tracks is not None and len(tracks)>0:
+            self.journal = BatchJournal(self.tracks) if self.use_journal else None
+            jobs = []
             for track in self.tracks:
-                directory = os.path.dirname(track) + "/"
-                filename = os.path.basename(track)
-                filename_extension = os.path.splitext(filename)[1]
-                filename_without_extension = filename.removesuffix(filename_extension)
-                self.song_processing.emit(filename_without_extension)
-                self.update_track_counts_ui("processing")
+                job = TrackJob(track)
+                if self.journal is not None and os.path.isfile(track):
+                    job.resume_from = self.journal.resume_stage(track)
                 if track.endswith(".stem.m4a"):
-                    self.skipped_tracks.append(filename_without_extension)
+                    self.skipped_tracks.append(job.filename_without_extension)
                     self.update_track_counts_ui("processing - skipping (already a stem)")
+                    self.emit_track_result(job, "skipped", reason="already a stem")
                     
-                elif os.path.isfile(os.path.join(directory, f"{filename_without_extension}.stem.m4a")) and not self.overwrite_existing:
-                    self.skipped_tracks.append(filename_without_extension)
+                elif os.path.isfile(self.stem_path(job)) and not self.overwrite_existing:
+                    self.skipped_tracks.append(job.filename_without_extension)
                     self.update_track_counts_ui("processing - skipping (already stemmed)")
+                    self.emit_track_result(job, "skipped", reason="already stemmed", output=self.stem_path(job))
                     
+                elif job.filename_extension in self.supported_files and self.known_unreadable(job):
+                    self.failed_tracks.append(job.filename_without_extension)
+                    self.update_track_counts_ui("processing - error (" + job.media.error + ")")
+                    self.emit_track_result(job, "failed", stage="probing", error=job.media.error)
+
                 else:
-                    try:
-                        self.update_track_counts_ui("Processing - preparing")
-                        copied_track, bit_depth = self.prepare(track, directory, filename, filename_extension, filename_without_extension)
-                        self.update_track_counts_ui("Processing - splitting using " + DEVICE)
-                        self.split_stems(copied_track, directory, filename, filename_extension, filename_without_extension, bit_depth)
-                        self.update_track_counts_ui("Processing - saving")
-                        self.create_stem(directory, filename, filename_extension, filename_without_extension)
-                        self.update_track_counts_ui("Processing - cleaning")
-                        self.clean_dir(directory, filename_without_extension)
-                        self.processed_tracks.append(filename_without_extension)
-                        self.update_track_counts_ui("Processing - done")
-                    except Exception as exc:
-                        print(traceback.format_exc())
-                        self.emit_error(exc)
-                        self.failed_tracks.append(filename_without_extension)
-                        self.update_track_counts_ui("Processing - error")
+                    jobs.append(job)
+
+            processes, batch_size = self.separation_processes, self.batch_size
+            self.memory = None
+            if self.memory_governor:
+                processes, batch_size = self.plan_memory(jobs, processes, batch_size)
+
+            # One resident model for the whole run instead of one load per track.
+            if processes > 0:
+                pool = self.separator
+                if not isinstance(pool, SeparatorPool) or pool.broken or pool.settings != self.separator_settings() + (processes, self.threads_per_process):
+                    self.close()
+                    self.separator = SeparatorPool(self.model_name, self.model_shifts, get_device(), processes, self.threads_per_process, self.model_precision, self.separation_backend, self.model_overlap, self.model_segment)
+                # one split worker per process so every process always has a track
+                self.stage_workers["splitting"] = processes
+            elif not isinstance(self.separator, Separator) or self.separator.settings != self.separator_settings():
+                self.close()
+                self.separator = self.create_separator()
+
+            # prepare track N+1 and save track N-1 while track N is being split
+            pipeline = Pipeline(
+                [
+                    ("preparing", self.measured("prepare", self.prepare_stage), self.stage_workers["preparing"]),
+                    ("splitting", self.measured("split", self.split_stage), self.stage_workers["splitting"], batch_size if batch_size > 1 else None),
+                    ("saving", self.measured("save", self.save_stage), self.stage_workers["saving"]),
+                ],
+                queue_size=max(self.queue_size, batch_size),
+                on_stage=self.stage_changed,
+                on_done=self.track_done,
+                on_error=self.track_failed,
+            )
+            self.pipeline = pipeline
+            try:
+                pipeline.run(jobs)
+            finally:
+                self.pipeline = None
+                # a pool whose workers kept dying is not kept for the next run
+                if not self.keep_separator_pool or isinstance(self.separator, SeparatorPool) and self.separator.broken:
+                    self.close()
             self.print_report()
+
+
+    def close(self):
+        # stops the worker processes of a separator pool; an in-process
+        # separator is kept, it holds no processes
+        if isinstance(self.separator, SeparatorPool):
+            self.separator.shutdown()
+
+
+    def plan_memory(self, jobs, processes, batch_size):
+        # Fits the run to the memory budget before anything is decoded:
+        # returns the worker processes and batch size to use, and gives each
+        # track that does not fit a shorter segment, or streams it when no
+        # segment is short enough. Probing up front costs nothing extra, the
+        # results are cached for the prepare stage.
+        self.memory = self.memory_governor_for_model()
+        if self.memory.budget is None:
+            return processes, batch_size
+        if self.model_segment and not self.memory.padded_segments:
+            self.memory.max_segment = float(self.model_segment)
+        for job in jobs:
+            if job.media is None and job.resume_from != "saved":
+                try:
+                    with self.measure("probe"):
+                        job.media = self.media_probe.probe(job.track)
+                except OSError:
+                    # missing or moved: the track fails when it is prepared
+                    continue
+        medias = [job.media for job in jobs if job.media is not None and job.media.error is None and job.media.duration]
+        planned = self.memory.plan(medias, processes, batch_size)
+        if planned != (processes, batch_size):
+            print(f"memory budget {self.memory.budget // 1024 ** 2} MB: {planned[0]} worker process(es), batch size {planned[1]}")
+        processes, batch_size = planned
+        for job in jobs:
+            if job.media is None or job.media.error is not None or not job.media.duration:
+                continue
+            job.segment = self.memory.segment_for(job.media, processes, batch_size)
+            window = None
+            if job.segment is False:
+                job.segment = None
+                if self.can_stream():
+                    # only one window at a time is in memory
+                    job.streamed = True
+                    window = self.streaming_window + 2 * self.streaming_overlap
+                    print(f"{job.filename} does not fit the memory budget, streaming it")
+            elif job.segment is not None:
+                print(f"{job.filename}: {job.segment:.2f}s segments to fit the memory budget")
+            job.estimated_bytes = self.memory.peak(job.media, job.segment, processes, batch_size, window)
+        return processes, batch_size
+
+
+    def memory_governor_for_model(self):
+        return MemoryGovernor(self.memory_budget, padded_segments=pads_segments(self.model_name))
+
+
+    def can_stream(self):
+        return self.in_process_decode and self.streaming_threshold is not None
+
+
+    def measure(self, step, **labels):
+        # context manager timing a step when profiling is on
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.span(step, **labels)
+
+
+    def queue_depths(self):
+        # {stage: tracks waiting in front of it}, empty between runs
+        pipeline = self.pipeline
+        return pipeline.queue_depths() if pipeline is not None else {}
+
+
+    def measured(self, step, function):
+        # a pipeline stage function timed as a whole; unchanged when profiling is off
+        if self.profiler is None:
+            return function
+
+        def stage(job):
+            jobs = job if isinstance(job, list) else [job]
+            with self.measure(step, tracks=[job.filename for job in jobs]):
+                return function(job)
+        return stage
+
+
+    def known_unreadable(self, job):
+        # files already probed without success are not probed again
+        job.media = self.media_probe.cached(job.track)
+        return job.media is not None and job.media.error is not None
+
+
+    def prepare_stage(self, job):
+        self.check_cancelled(job)
+        if job.resume_from is not None:
+            self.resume(job)
+            return
+
+        if self.in_process_decode:
+            if job.media is None:
+                with self.measure("probe"):
+                    job.media = self.media_probe.probe(job.track)
+            job.streamed = job.streamed or self.is_long(job.media)
+            job.audio, job.bit_depth = self.prepare_audio(job.track, job.directory, job.filename, job.filename_extension, job.filename_without_extension, job.media, decode=not job.streamed)
+            if self.separation_cache is not None and not job.streamed:
+                job.cache_key = separation_key(job.audio, self.model_name, self.model_shifts, self.separator.precision, self.model_overlap, self.model_segment)
+                job.sources = self.separation_cache.get(job.cache_key)
+                job.cache_hit = job.separated = job.sources is not None
+        else:
+            job.copied_track, job.bit_depth = self.prepare(job.track, job.directory, job.filename, job.filename_extension, job.filename_without_extension, job.media)
+        self.record_stage(job, "prepared", bit_depth=job.bit_depth, streamed=job.streamed)
+
+
+    def is_long(self, media):
+        return self.streaming_threshold is not None and media.error is None and (media.duration or 0) > self.streaming_threshold
+
+
+    def resume(self, job):
+        # Picks a track up after the last stage an earlier run finished.
+        # Cover and tags are already in the work directory; the decoded audio
+        # is not kept between runs and is decoded again.
+        artifacts = self.journal.artifacts(job.track)
+        job.bit_depth = artifacts.get("bit_depth", 16)
+        job.streamed = artifacts.get("streamed", False)
+        self.update_track_counts_ui(f"Processing - resuming {job.filename_without_extension} after '{job.resume_from}'")
+        if job.resume_from == "saved":
+            job.separated = True
+            return
+
+        mixdown = os.path.join(job.directory, job.filename_without_extension, job.filename_without_extension + ".wav")
+        if self.in_process_decode:
+            # streamed tracks are decoded window by window while splitting
+            if not job.streamed:
+                job.audio = load_audio(job.track)
+        else:
+            job.copied_track = mixdown if job.filename_extension == ".wav" else job.track
+
+        if job.resume_from == "split":
+            stems = artifacts.get("stems")
+            if stems and stems.endswith(".npz") and os.path.isfile(stems):
+                try:
+                    job.sources = load_stems(stems)
+                    job.separated = True
+                except (OSError, ValueError, KeyError):
+                    # unreadable: the track is split again
+                    job.sources = None
+            elif stems and os.path.isdir(stems):
+                job.separated = True
+
+        if not job.separated and job.audio is not None and self.separation_cache is not None:
+            # a track whose stems came from the cache was not checkpointed
+            job.cache_key = separation_key(job.audio, self.model_name, self.model_shifts, self.separator.precision, self.model_overlap, self.model_segment)
+            job.sources = self.separation_cache.get(job.cache_key)
+            job.cache_hit = job.separated = job.sources is not None
+
+
+    def record_stage(self, job, stage, **artifacts):
+        if self.journal is not None:
+            self.journal.record(job.track, stage, **artifacts)
+
+
+    def split_stage(self, job):
+        # tracks found in the separation cache or resumed after splitting are
+        # not split again
+        jobs = [job for job in (job if isinstance(job, list) else [job]) if not job.separated]
+        if len(jobs) == 1:
+            self.check_cancelled(jobs[0])
+        # cancelled tracks of a batch are left out here and dropped when saving
+        jobs = [job for job in jobs if job.track not in self.cancelled_tracks]
+        for job in jobs:
+            if job.streamed:
+                reset_peak_rss()
+                with self.measure("separate"):
+                    self.split_streaming(job)
+                job.peak_rss = peak_rss()
+                # not streamed again if the rest of the batch fails and is retried
+                job.separated = True
+        jobs = [job for job in jobs if not job.streamed]
+        if not jobs:
+            return
+        # Process-wide peak while these tracks are separated, so it includes
+        # the tracks being prepared and saved at the same time. With worker
+        # processes the model runs outside this process and is not included.
+        reset_peak_rss()
+        self.separate_jobs(jobs, min((job.segment for job in jobs if job.segment), default=None))
+        peak = peak_rss()
+        for job in jobs:
+            job.peak_rss = peak
+
+
+    def separate_jobs(self, jobs, segment):
+        # A failed allocation is retried rather than failing the tracks: a
+        # batch one track at a time, a single track with half the segment
+        # length, down to memory.MIN_SEGMENT, then streamed. Models that pad
+        # segments to their training length go straight to streaming.
+        try:
+            with self.measure("separate"):
+                if len(jobs) == 1 and jobs[0].audio is None:
+                    job = jobs[0]
+                    self.split_stems(job.copied_track, job.directory, job.filename, job.filename_extension, job.filename_without_extension, job.bit_depth, segment)
+                else:
+                    self.split_stems_batch(jobs, segment)
+            return
+        except (MemoryError, RuntimeError) as exc:
+            if not is_out_of_memory(exc):
+                raise
+            free_cached_memory()
+            if len(jobs) > 1:
+                print(f"Out of memory separating a batch of {len(jobs)}, retrying one track at a time")
+                for job in jobs:
+                    self.separate_jobs([job], segment)
+                return
+            governor = self.memory or self.memory_governor_for_model()
+            smaller = governor.smaller(segment or getattr(self.separator, "segment", None))
+            if smaller is None:
+                job = jobs[0]
+                if not self.can_stream():
+                    raise
+                print(f"Out of memory separating {job.filename}, streaming it")
+                # the decoded track is read again window by window
+                job.audio = None
+                job.cache_key = None
+                job.streamed = True
+                with self.measure("separate"):
+                    self.split_streaming(job)
+                return
+            print(f"Out of memory separating {jobs[0].filename}, retrying with {smaller:.2f}s segments")
+        self.separate_jobs(jobs, smaller)
+
+
+    def save_stage(self, job):
+        self.check_cancelled(job)
+        if job.resume_from != "saved":
+            if job.cache_key is not None and not job.cache_hit and job.sources is not None:
+                with self.measure("cache"):
+                    self.separation_cache.put(job.cache_key, job.sources)
+            if job.sources is None and job.resume_from != "split":
+                # stems already on disk, only where they are is recorded
+                self.checkpoint_stems(job)
+
+            if job.sources is not None:
+                try:
+                    self.create_stem(job.directory, job.filename, job.filename_extension, job.filename_without_extension, job.sources, job.audio, job.bit_depth > 16)
+                except Exception:
+                    # Stems from the separation cache are found there again
+                    # when the track is resumed; the others are written to the
+                    # work directory so that the next run does not split again.
+                    if not job.cache_hit and job.resume_from != "split":
+                        with self.measure("checkpoint"):
+                            self.checkpoint_stems(job)
+                    raise
+                job.audio = None
+                job.sources = None
+            else:
+                if job.audio is not None:
+                    # the decoded audio becomes the mixdown track of the stem file
+                    mixdown = os.path.join(job.directory, job.filename_without_extension, job.filename_without_extension + ".wav")
+                    save_wav(job.audio, mixdown, int24=job.bit_depth > 16, clip="clamp")
+                    job.audio = None
+                self.create_stem(job.directory, job.filename, job.filename_extension, job.filename_without_extension, encoded=job.streamed)
+            self.record_stage(job, "saved")
+        if self.may_publish is not None and not self.may_publish(job.track):
+            # the work directory now belongs to whoever took the track over
+            raise TrackCancelled(f"{job.filename} taken over, not published")
+        self.clean_dir(job.directory, job.filename_without_extension)
+        if self.journal is not None:
+            self.journal.forget(job.track)
+
+
+    def checkpoint_stems(self, job):
+        # Records where the separated stems are, writing them to the work
+        # directory first when they are only in memory, so that a failure
+        # while saving does not cost a new separation.
+        if self.journal is None:
+            return
+        if job.sources is not None:
+            stems = os.path.join(job.directory, job.filename_without_extension, "stems.npz")
+            save_stems(stems, job.sources)
+        else:
+            stems = os.path.join(job.directory, job.filename_without_extension, self.model_name, job.filename_without_extension)
+        self.record_stage(job, "split", stems=stems)
+
+
+    def stage_changed(self, stage, job, busy):
+        with self.lock:
+            active = self.active_stages.setdefault(stage, [])
+            if busy:
+                active.append(job.filename_without_extension)
+            elif job.filename_without_extension in active:
+                active.remove(job.filename_without_extension)
+            activity = " | ".join(f"{name}: {', '.join(tracks)}" for name, tracks in self.active_stages.items() if tracks)
+            message = f"Processing - {stage} {job.filename_without_extension}"
+            if busy and stage == "splitting":
+                message += " using " + get_device()
+            self.song_processing.emit(activity)
+            self.update_track_counts_ui(message if busy else "Processing - " + (activity or "waiting"))
+            self.track_stage.emit(job.track, stage, busy)
+
+
+    def track_done(self, job):
+        with self.lock:
+            self.processed_tracks.append(job.filename_without_extension)
+            if job.peak_rss is not None:
+                self.peak_memory.append((job.filename_without_extension, job.peak_rss, job.estimated_bytes))
+            self.update_track_counts_ui("Processing - done " + job.filename_without_extension)
+            self.emit_track_result(job, "processed", output=self.stem_path(job), peak_rss=job.peak_rss)
+
+
+    def track_failed(self, job, stage, exc):
+        with self.lock:
+            if isinstance(exc, TrackCancelled):
+                self.cancelled_tracks.discard(job.track)
+                self.skipped_tracks.append(job.filename_without_extension)
+                self.update_track_counts_ui(f"Processing - cancelled {job.filename_without_extension}")
+                self.emit_track_result(job, "cancelled", stage=stage)
+                return
+            self.emit_error(exc)
+            self.failed_tracks.append(job.filename_without_extension)
+            self.update_track_counts_ui(f"Processing - error while {stage} {job.filename_without_extension}")
+            self.emit_track_result(job, "failed", stage=stage, error=str(exc))
+
+
+    def stem_path(self, job):
+        return os.path.join(job.directory, f"{job.filename_without_extension}.stem.m4a")
+
+
+    def emit_track_result(self, job, status, **details):
+        if job.media is not None and job.media.duration:
+            details.setdefault("duration", job.media.duration)
+        self.track_result.emit({"track": job.track, "status": status, **details})
+
                 
     
     def print_report(self):
@@ -130,6 +733,29 @@ class StemGen(QObject):
             for track in self.processed_tracks:
                 details += "\n\t" + track
             details +="\n"
+
+        if self.staged_methods:
+            details += "Staging:"
+            for method, count in sorted(self.staged_methods.items()):
+                details += f"\n\t{method}: {count} track(s)"
+            details += f"\n\tbytes copied: {self.staged_bytes}"
+            details +="\n"
+
+        if self.separation_cache is not None:
+            details += "Separation cache:"
+            details += f"\n\thits: {self.separation_cache.hits}"
+            details += f"\n\tmisses: {self.separation_cache.misses}"
+            details +="\n"
+
+        if self.peak_memory:
+            details += "Peak memory:"
+            if self.memory is not None and self.memory.budget is not None:
+                details += f"\n\tbudget: {self.memory.budget // 1024 ** 2} MB"
+            for track, peak, estimate in self.peak_memory:
+                details += f"\n\t{track}: {peak // 1024 ** 2} MB"
+                if estimate is not None:
+                    details += f" (estimated {estimate // 1024 ** 2} MB)"
+            details +="\n"
         self.details_update.emit(details)
             
         
@@ -259,33 +885,59 @@ class StemGen(QObject):
                     )
 
 
-    def split_stems(self, copied_track, directory, filename, filename_extension, filename_without_extension, bit_depth):
-        if bit_depth == 24:
-            demucs.separate.main([
-                                "--int24",
-                                "-n",
-                                self.model_name,
-                                "--shifts",
-                                self.model_shifts,
-                                "-d",
-                                DEVICE,
-                                copied_track,
-                                "-o",
-                                f"{directory}/{filename_without_extension}"
-                ])
+    def split_stems(self, copied_track, directory, filename, filename_extension, filename_without_extension, bit_depth, segment=None):
+        self.separator.separate_file(
+            copied_track,
+            f"{directory}/{filename_without_extension}/{self.model_name}/{filename_without_extension}",
+            int24=(bit_depth == 24),
+            segment=segment,
+        )
+
+
+    def split_streaming(self, job):
+        # The track is never decoded whole: each window is separated, and the
+        # finished part of every stem and of the mixdown goes straight to its
+        # own ffmpeg encoder. Stems are clamped instead of rescaled since the
+        # peak of the whole stem is not known while it is being written.
+        output_directory = f"{job.directory}/{job.filename_without_extension}/{self.model_name}/{job.filename_without_extension}"
+        os.makedirs(output_directory, exist_ok=True)
+        outputs = {name: os.path.join(output_directory, name + ".m4a") for name in ["drums", "bass", "other", "vocals"]}
+        outputs["mixdown"] = os.path.join(job.directory, job.filename_without_extension, job.filename_without_extension + ".m4a")
+
+        streaming = StreamingSeparator(self.separator, self.streaming_window, self.streaming_overlap)
+        # both are closed even when the other one fails to start or to close
+        with contextlib.ExitStack() as stack:
+            reader = FfmpegReader(job.track, streaming.window_frames)
+            stack.callback(reader.close)
+            encoder = PcmEncoder(outputs, int24=job.bit_depth > 16, codec=self.output_codec)
+            stack.callback(encoder.close)
+            streaming.run(reader.read_into, encoder.write)
+
+
+    def split_stems_batch(self, jobs, segment=None):
+        output_directories = [f"{job.directory}/{job.filename_without_extension}/{self.model_name}/{job.filename_without_extension}" for job in jobs]
+        if self.stream_encode and all(job.audio is not None for job in jobs):
+            results = self.separator.separate_batch([job.audio for job in jobs], segment)
+            for job, sources in zip(jobs, results):
+                job.sources = sources
+        elif all(job.audio is not None for job in jobs):
+            # float input, so every input above 16 bits gets 24-bit stems
+            self.separator.separate_audios(
+                [job.audio for job in jobs],
+                output_directories,
+                [job.bit_depth > 16 for job in jobs],
+                segment,
+            )
         else:
-            demucs.separate.main([ "-n",
-                    self.model_name,
-                    "--shifts",
-                    self.model_shifts,
-                    "-d",
-                    DEVICE,
-                    copied_track,
-                    "-o",
-                    f"{directory}/{filename_without_extension}"])
-
-
-    def create_stem(self, directory, filename, filename_extension, filename_without_extension):
+            self.separator.separate_files(
+                [job.copied_track for job in jobs],
+                output_directories,
+                [job.bit_depth == 24 for job in jobs],
+                segment,
+            )
+
+
+    def create_stem(self, directory, filename, filename_extension, filename_without_extension, sources=None, mixdown_audio=None, int24=False, encoded=False):
         stems = [
             f"{directory}/{filename_without_extension}/{self.model_name}/{filename_without_extension}/drums.wav",
             f"{directory}/{filename_without_extension}/{self.model_name}/{filename_without_extension}/bass.wav",
@@ -293,6 +945,20 @@ class StemGen(QObject):
             f"{directory}/{filename_without_extension}/{self.model_name}/{filename_without_extension}/vocals.wav",
         ]
         mixdown = f"{directory}/{filename_without_extension}/{filename_without_extension}.wav"
+        if encoded:
+            # already encoded by split_streaming, muxed as they are
+            stems = [stem[:-4] + ".m4a" for stem in stems]
+            mixdown = mixdown[:-4] + ".m4a"
+        if sources is not None:
+            # Stems and mixdown in memory: the wav bytes that would have been
+            # written to these paths are piped to the encoder instead.
+            os.makedirs(os.path.dirname(stems[0]), exist_ok=True)
+            samplerate = self.separator.samplerate
+            stems = [
+                MemoryTrack(path, lambda source=sources[os.path.basename(path)[:-4]]: encode_wav(source, samplerate, int24), samplerate)
+                for path in stems
+            ]
+            mixdown = MemoryTrack(mixdown, lambda: encode_wav(mixdown_audio, samplerate, int24, clip="clamp"), samplerate)
         tags =  f"{directory}/{filename_without_extension}/tags.json"
         metadata = {
           "mastering_dsp": {
@@ -322,12 +988,15 @@ class StemGen(QObject):
             {"color": "#56B4E9", "name": "Vox"}
           ]
         }
-        creator = StemCreator(mixdown, stems, "alac", metadata, tags)
+        creator = StemCreator(mixdown, stems, self.output_codec, metadata, tags, measure=self.measure)
         creator.save()
 
 
     def setup(self):
-        for package in self.required_packages:
+        required_packages = self.required_packages
+        if self.in_process_decode:
+            required_packages = [package for package in required_packages if package != "sox"]
+        for package in required_packages:
             if not shutil.which(package):
                 error = f"Please install {package} before running Stemgen."
                 if not (getattr(sys, 'frozen', False)):# and hasattr(sys, '_MEIPASS')):
@@ -335,96 +1004,98 @@ class StemGen(QObject):
                     raise Exception(error)
 
 
-    def prepare(self, track:str, directory:str, filename:str, filename_extension:str, filename_without_extension:str):
+    def prepare(self, track:str, directory:str, filename:str, filename_extension:str, filename_without_extension:str, media=None):
         if not os.path.exists(directory):
             os.mkdir(directory)
      
         if filename_extension not in self.supported_files:
             raise Exception("Invalid input file format. File should be one of:", self.supported_files)
+
+        if media is None:
+            with self.measure("probe"):
+                media = self.media_probe.probe(track)
+        if media.error is not None:
+            raise Exception(media.error)
             
         if not os.path.exists(f"{directory}/{filename_without_extension}"):
             os.mkdir(f"{directory}/{filename_without_extension}")
 
-        copied_track = f"{directory}/{filename_without_extension}/{filename}"
-        shutil.copy(track, copied_track)
+        bit_depth = media.bit_depth
+        sample_rate = media.sample_rate
+        with self.measure("metadata"):
+            if media.has_cover:
+                get_cover(filename_extension, track, directory, filename_without_extension)
+            get_metadata(track, directory, filename_without_extension, media.tags or None)
 
-        bit_depth = self.get_bit_depth(copied_track, filename_extension)
-        sample_rate = self.get_sample_rate(copied_track)
-        get_cover(filename_extension, track, directory, filename_without_extension)
-        get_metadata(track, directory, filename_without_extension)
-        self.convert(copied_track, directory, filename, filename_extension, filename_without_extension, bit_depth, sample_rate)
+        # The source is never copied up front: sox reads it in place when it
+        # has to be converted, otherwise it is linked into the work directory.
+        mixdown = os.path.join(directory, filename_without_extension, filename_without_extension + ".wav")
+        if self.needs_conversion(filename_extension, bit_depth, sample_rate):
+            with self.measure("convert"):
+                self.convert(track, directory, filename, filename_extension, filename_without_extension, bit_depth, sample_rate)
+        else:
+            with self.measure("stage"):
+                method, copied_bytes = stage_file(track, mixdown)
+            with self.lock:
+                self.staged_bytes += copied_bytes
+                self.staged_methods[method] = self.staged_methods.get(method, 0) + 1
+
+        # wav files are split from the 44.1kHz mixdown, other formats from the source
+        copied_track = mixdown if filename_extension == ".wav" else track
         return copied_track, bit_depth
 
 
-    def get_bit_depth(self, file_path, filename_extension):
-        if filename_extension == ".flac":
-            return int(
-                subprocess.check_output(
-                    [
-                        "ffprobe",
-                        "-v",
-                        "error",
-                        "-select_streams",
-                        "a",
-                        "-show_entries",
-                        "stream=bits_per_raw_sample",
-                        "-of",
-                        "default=noprint_wrappers=1:nokey=1",
-                        file_path,
-                    ]
-                )
-            )
-        else:
-            return int(
-                subprocess.check_output(
-                    [
-                        "ffprobe",
-                        "-v",
-                        "error",
-                        "-select_streams",
-                        "a",
-                        "-show_entries",
-                        "stream=bits_per_sample",
-                        "-of",
-                        "default=noprint_wrappers=1:nokey=1",
-                        file_path,
-                    ]
-                )
-            )
+    def prepare_audio(self, track:str, directory:str, filename:str, filename_extension:str, filename_without_extension:str, media=None, decode=True):
+        # Like prepare, but returns the decoded 44.1kHz float audio instead of
+        # writing a converted wav: no sox process and no intermediate file.
+        # With decode=False only cover and tags are extracted.
+        if filename_extension not in self.supported_files:
+            raise Exception("Invalid input file format. File should be one of:", self.supported_files)
+
+        if media is None:
+            with self.measure("probe"):
+                media = self.media_probe.probe(track)
+        if media.error is not None:
+            raise Exception(media.error)
+
+        if not os.path.exists(f"{directory}/{filename_without_extension}"):
+            os.mkdir(f"{directory}/{filename_without_extension}")
+
+        with self.measure("metadata"):
+            if media.has_cover:
+                get_cover(filename_extension, track, directory, filename_without_extension)
+            get_metadata(track, directory, filename_without_extension, media.tags or None)
+        if not decode:
+            return None, media.bit_depth
+        with self.measure("decode"):
+            return load_audio(track), media.bit_depth
 
 
+    def needs_conversion(self, filename_extension, bit_depth, sample_rate):
+        return bit_depth == 32 or not (filename_extension in (".wav", ".wave") and sample_rate == 44100)
+
+
+    def get_bit_depth(self, file_path, filename_extension):
+        return self.media_probe.probe(file_path).bit_depth
+
 
     def get_sample_rate(self, filepath):
-        return int(
-            subprocess.check_output(
-                [
-                    "ffprobe",
-                    "-v",
-                    "error",
-                    "-select_streams",
-                    "a",
-                    "-show_entries",
-                    "stream=sample_rate",
-                    "-of",
-                    "default=noprint_wrappers=1:nokey=1",
-                    filepath,
-                ]
-            )
-        )
+        return self.media_probe.probe(filepath).sample_rate
 
 
     def clean_dir(self, directory, filename_without_extension):
 
         #os.chdir(directory)
 
-        if os.path.isfile(os.path.join(directory, f"{filename_without_extension}.stem.m4a")):
-            os.remove(os.path.join(directory, f"{filename_without_extension}.stem.m4a"))
-
         if os.path.isfile(os.path.join(directory, filename_without_extension, f"{filename_without_extension}.stem.m4a")):
-            os.rename(
+            # published in one step: readers, including other nodes sharing
+            # the library, see the old file or the complete new one
+            os.replace(
                 os.path.join(directory, filename_without_extension, f"{filename_without_extension}.stem.m4a"),
                 os.path.join(directory, f"{filename_without_extension}.stem.m4a"),
             )
+        elif os.path.isfile(os.path.join(directory, f"{filename_without_extension}.stem.m4a")):
+            os.remove(os.path.join(directory, f"{filename_without_extension}.stem.m4a"))
 
         try:
             shutil.rmtree(os.path.join(directory, filename_without_extension))
@@ -1,7 +1,13 @@
 #!/bin/bash
 
 DIR="$(dirname "$(readlink -f "$0")")"
-cd $DIR
 
-source venv/bin/activate
+source "$DIR/venv/bin/activate"
+
+# with arguments: headless batch, paths are relative to the caller's directory
+if [ $# -gt 0 ]; then
+    exec python3 "$DIR/cli.py" "$@"
+fi
+
+cd $DIR
 python3 StemGenApp.py
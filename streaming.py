@@ -0,0 +1,209 @@
+import subprocess
+import tempfile
+
+import numpy as np
+import torch
+
+from audio import SAMPLE_RATE
+from ni_stem import encoderArgs
+
+
+class FfmpegReader:
+    """Decodes a file to 44.1kHz float frames through an ffmpeg pipe.
+
+    Resampling uses soxr at its highest precision, the ffmpeg counterpart of
+    `sox rate -v`. Frames are read into a byte buffer allocated once.
+    close() raises when ffmpeg failed, so that a truncated decode is not
+    taken for the end of the track.
+    """
+
+    def __init__(self, path, max_frames, channels=2, samplerate=SAMPLE_RATE):
+        self.path = path
+        self.channels = channels
+        self.finished = False
+        # a file rather than a pipe, which ffmpeg could fill and block on
+        self.errors = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            [
+                "ffmpeg",
+                "-v",
+                "error",
+                "-i",
+                path,
+                "-map",
+                "0:a:0",
+                "-af",
+                "aresample=resampler=soxr:precision=28",
+                "-ar",
+                str(samplerate),
+                "-ac",
+                str(channels),
+                "-f",
+                "f32le",
+                "pipe:1",
+            ],
+            stdout=subprocess.PIPE,
+            stderr=self.errors,
+        )
+        self.raw = bytearray(max_frames * channels * 4)
+
+
+    def read_into(self, view):
+        # Fills view (channels, frames) and returns how many frames were read.
+        wanted = view.shape[1] * self.channels * 4
+        buffer = memoryview(self.raw)[:wanted]
+        filled = 0
+        while filled < wanted:
+            count = self.process.stdout.readinto(buffer[filled:])
+            if not count:
+                self.finished = True
+                break
+            filled += count
+        frames = filled // (self.channels * 4)
+        samples = np.frombuffer(self.raw, dtype="<f4", count=frames * self.channels)
+        view[:, :frames] = torch.from_numpy(samples.reshape(frames, self.channels).T)
+        return frames
+
+
+    def close(self):
+        if not self.finished:
+            # stopped before the end of the track, ffmpeg has nothing to report
+            self.process.kill()
+        self.process.stdout.close()
+        returncode = self.process.wait()
+        self.errors.seek(0)
+        message = self.errors.read().decode(errors="replace").strip()
+        self.errors.close()
+        if self.finished and returncode != 0:
+            raise Exception(f"Decoding {self.path} failed (ffmpeg exit code {returncode}): {message}")
+
+
+def pcm_bytes(wav, int24=False):
+    # interleaved little-endian 16 or 24-bit PCM, clamped to [-1, 1]
+    wav = wav.clamp(-1, 1).t()
+    if int24:
+        samples = torch.round(wav * (2 ** 23 - 1)).to(torch.int32).numpy().astype("<i4")
+        return samples.view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+    return torch.round(wav * (2 ** 15 - 1)).to(torch.int16).numpy().astype("<i2").tobytes()
+
+
+class PcmEncoder:
+    """Feeds blocks of audio to one ffmpeg encoder per output file.
+
+    codec is "alac" or "aac"; AAC gets the same encoder and VBR setting as
+    the tracks StemCreator converts. close() raises with ffmpeg's messages
+    when an encoder failed.
+    """
+
+    def __init__(self, outputs, int24=False, codec="alac", channels=2, samplerate=SAMPLE_RATE):
+        # outputs maps a stream name to the .m4a file it is encoded to
+        self.int24 = int24
+        self.processes = {}
+        # one file per encoder, as for FfmpegReader
+        self.errors = {}
+        codec_args = encoderArgs(codec)
+        for name, path in outputs.items():
+            self.errors[name] = tempfile.TemporaryFile()
+            self.processes[name] = subprocess.Popen(
+                [
+                    "ffmpeg",
+                    "-v",
+                    "error",
+                    "-y",
+                    "-f",
+                    "s24le" if int24 else "s16le",
+                    "-ar",
+                    str(samplerate),
+                    "-ac",
+                    str(channels),
+                    "-i",
+                    "pipe:0",
+                    *codec_args,
+                    path,
+                ],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=self.errors[name],
+            )
+
+
+    def write(self, blocks):
+        for name, block in blocks.items():
+            self.processes[name].stdin.write(pcm_bytes(block, self.int24))
+
+
+    def close(self):
+        failed = []
+        for name, process in self.processes.items():
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                # ffmpeg exited early, its exit code and messages tell why
+                pass
+            returncode = process.wait()
+            errors = self.errors[name]
+            errors.seek(0)
+            message = errors.read().decode(errors="replace").strip()
+            errors.close()
+            if returncode != 0:
+                failed.append(f"{name} (ffmpeg exit code {returncode}): {message}")
+        if failed:
+            raise Exception("Encoding failed for " + "; ".join(failed))
+
+
+class StreamingSeparator:
+    """Separates a track window by window with memory that does not grow with
+    the length of the track.
+
+    Windows of `window` seconds overlap by `overlap` seconds. The overlapping
+    parts of two consecutive windows are cross-faded linearly, and each
+    finished block is handed to `write` with the matching block of the input
+    as "mixdown". The input window, the cross-fade ramp and the held back
+    tails are allocated once and reused for the whole track.
+    """
+
+    def __init__(self, separator, window=60.0, overlap=5.0, channels=2, samplerate=SAMPLE_RATE):
+        self.separator = separator
+        self.window_frames = int(window * samplerate)
+        self.overlap_frames = int(overlap * samplerate)
+        if not 0 < self.overlap_frames < self.window_frames // 2:
+            raise ValueError("overlap must be positive and less than half the window")
+        self.channels = channels
+
+
+    def run(self, read_into, write):
+        window, overlap = self.window_frames, self.overlap_frames
+        hop = window - overlap
+        buffer = torch.zeros(self.channels, window)
+        fade_in = torch.linspace(0, 1, overlap)
+        fade_out = 1 - fade_in
+        tails = None
+
+        filled = read_into(buffer)
+        while filled > 0:
+            sources = self.separator.separate(buffer[:, :filled])
+
+            if tails is not None:
+                # cross-fade the start of this window with the end of the last one
+                length = min(overlap, filled)
+                for name, source in sources.items():
+                    source[:, :length] = tails[name][:, :length] * fade_out[:length] + source[:, :length] * fade_in[:length]
+            elif filled > hop:
+                tails = {name: torch.zeros(self.channels, overlap) for name in sources}
+
+            if filled < window:
+                # short final window
+                write({"mixdown": buffer[:, :filled], **sources})
+                break
+
+            write({"mixdown": buffer[:, :hop], **{name: source[:, :hop] for name, source in sources.items()}})
+            for name, source in sources.items():
+                tails[name].copy_(source[:, hop:])
+
+            # the overlap becomes the start of the next window
+            buffer[:, :overlap] = buffer[:, hop:].clone()
+            read = read_into(buffer[:, overlap:])
+            if read == 0:
+                write({"mixdown": buffer[:, :overlap], **{name: tails[name] for name in sources}})
+                break
+            filled = overlap + read
@@ -0,0 +1,163 @@
+import json
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from profiling import difference, snapshot
+
+
+# histogram buckets for step durations, in seconds
+BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, math.inf)
+
+
+class Telemetry:
+    """Timing spans as JSON lines and counters for a metrics endpoint.
+
+    Set as StemGen.profiler, every timed step becomes a span: one JSON
+    object per line on `stream` (when given) with the step, its duration,
+    CPU time, bytes read and written, labels, thread and outcome. The same
+    spans feed per-step histograms, and attach() adds track counters and
+    stage occupancy from the engine's signals, and the depth of its pipeline
+    queues. When StemGen.profiler is None none of this runs.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.lock = threading.Lock()
+        # step -> [bucket counts, sum, count]
+        self.durations = {}
+        self.errors = {}
+        self.tracks = {}
+        self.audio_seconds = 0.0
+        self.stages = {}
+        self.engines = []
+
+
+    def span(self, step, **labels):
+        return _Span(self, step, labels)
+
+
+    def record(self, step, labels, measures, error):
+        with self.lock:
+            histogram = self.durations.setdefault(step, [[0] * len(BUCKETS), 0.0, 0])
+            for index, bound in enumerate(BUCKETS):
+                if measures["wall"] <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += measures["wall"]
+            histogram[2] += 1
+            if error is not None:
+                self.errors[step] = self.errors.get(step, 0) + 1
+            if self.stream is not None:
+                line = {
+                    "time": time.time(),
+                    "span": step,
+                    "duration": measures["wall"],
+                    "cpu": measures["cpu"],
+                    "children_cpu": measures["children_cpu"],
+                    "read_bytes": measures["read_bytes"],
+                    "written_bytes": measures["written_bytes"],
+                    "thread": threading.current_thread().name,
+                    "status": "ok" if error is None else "error",
+                }
+                if error is not None:
+                    line["error"] = str(error)
+                line.update(labels)
+                self.stream.write(json.dumps(line) + "\n")
+                self.stream.flush()
+
+
+    def attach(self, stemgen):
+        stemgen.profiler = self
+        with self.lock:
+            self.engines.append(stemgen)
+        stemgen.track_result.connect(self.track_result)
+        stemgen.track_stage.connect(self.track_stage)
+
+
+    def track_result(self, result):
+        with self.lock:
+            self.tracks[result["status"]] = self.tracks.get(result["status"], 0) + 1
+            if result["status"] == "processed":
+                self.audio_seconds += result.get("duration") or 0.0
+
+
+    def track_stage(self, track, stage, busy):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0) + (1 if busy else -1)
+
+
+    def metrics(self):
+        # Prometheus text exposition format
+        with self.lock:
+            lines = [
+                "# HELP stemgen_step_seconds Duration of pipeline stages and the steps within them.",
+                "# TYPE stemgen_step_seconds histogram",
+            ]
+            for step, (buckets, total, count) in sorted(self.durations.items()):
+                for bound, bucket in zip(BUCKETS, buckets):
+                    le = "+Inf" if bound == math.inf else repr(bound)
+                    lines.append(f'stemgen_step_seconds_bucket{{step="{step}",le="{le}"}} {bucket}')
+                lines.append(f'stemgen_step_seconds_sum{{step="{step}"}} {total}')
+                lines.append(f'stemgen_step_seconds_count{{step="{step}"}} {count}')
+            lines += ["# HELP stemgen_step_errors_total Steps that raised, subprocess failures included.", "# TYPE stemgen_step_errors_total counter"]
+            lines += [f'stemgen_step_errors_total{{step="{step}"}} {count}' for step, count in sorted(self.errors.items())]
+            lines += ["# HELP stemgen_tracks_total Tracks by outcome.", "# TYPE stemgen_tracks_total counter"]
+            lines += [f'stemgen_tracks_total{{status="{status}"}} {count}' for status, count in sorted(self.tracks.items())]
+            lines += [
+                "# HELP stemgen_audio_seconds_total Duration of the audio of processed tracks.",
+                "# TYPE stemgen_audio_seconds_total counter",
+                f"stemgen_audio_seconds_total {self.audio_seconds}",
+                "# HELP stemgen_stage_tracks Tracks currently in each stage.",
+                "# TYPE stemgen_stage_tracks gauge",
+            ]
+            lines += [f'stemgen_stage_tracks{{stage="{stage}"}} {count}' for stage, count in sorted(self.stages.items())]
+            depths = {}
+            for engine in self.engines:
+                for stage, depth in engine.queue_depths().items():
+                    depths[stage] = depths.get(stage, 0) + depth
+            lines += ["# HELP stemgen_queue_tracks Tracks waiting in the queue in front of each stage.", "# TYPE stemgen_queue_tracks gauge"]
+            lines += [f'stemgen_queue_tracks{{stage="{stage}"}} {depth}' for stage, depth in sorted(depths.items())]
+        return "\n".join(lines) + "\n"
+
+
+    def serve(self, port):
+        # GET /metrics on localhost, from a daemon thread
+        telemetry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = telemetry.metrics().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        return server
+
+
+class _Span:
+    def __init__(self, telemetry, step, labels):
+        self.telemetry = telemetry
+        self.step = step
+        self.labels = labels
+
+
+    def __enter__(self):
+        self.start = snapshot()
+        return self
+
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.telemetry.record(self.step, self.labels, difference(self.start, snapshot()), exc)
+        return False
@@ -0,0 +1,278 @@
+import ctypes
+import ctypes.util
+import os
+import queue
+import select
+import struct
+import sys
+import threading
+import time
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+_EVENT = struct.Struct("iIII")
+
+
+class _Inotify:
+    # inotify through libc, Linux only
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = {}
+
+
+    def add(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+        self.directories[wd] = directory
+
+
+    def wait(self, timeout):
+        # Paths that changed, or None when events were lost and the
+        # directories have to be scanned again.
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            name = data[offset + _EVENT.size : offset + _EVENT.size + length].rstrip(b"\0")
+            offset += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            directory = self.directories.get(wd)
+            if directory is None or not name:
+                continue
+            changed.add(os.path.join(directory, os.fsdecode(name)))
+        return changed
+
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _Polling:
+    # fallback without inotify: every wait ends with a full scan
+    def __init__(self, interval):
+        self.interval = interval
+
+
+    def add(self, directory):
+        pass
+
+
+    def wait(self, timeout):
+        time.sleep(max(timeout, self.interval))
+        return None
+
+
+    def close(self):
+        pass
+
+
+class FolderWatcher:
+    """Finds audio files added to a set of directories and puts them on a
+    bounded queue once they are complete.
+
+    A file is complete when its size and mtime have not changed for `settle`
+    seconds. When the queue is full the watcher waits, so a bulk copy is
+    handed over a few files at a time; inotify events pile up in the kernel
+    meanwhile, and if they overflow the directories are scanned again.
+    """
+
+    def __init__(self, directories, accept, files, settle=5.0, recursive=True, poll_interval=10.0):
+        self.directories = [os.path.abspath(directory) for directory in directories]
+        # accept(path) tells whether a complete file should be queued
+        self.accept = accept
+        self.files = files
+        self.settle = settle
+        self.recursive = recursive
+        self.stopped = threading.Event()
+        try:
+            self.backend = _Inotify()
+        except (OSError, AttributeError):
+            # no inotify (macOS, Windows, old libc)
+            self.backend = _Polling(poll_interval)
+        # path -> (size, mtime_ns, time the signature was first seen)
+        self.pending = {}
+        # path -> signature of the file when it was queued, until its track
+        # is done or the file is gone; a failed track stays, so that it is
+        # not retried before it changes
+        self.queued = {}
+
+
+    def scan(self, directory):
+        # watches directory (and its sub-directories) and returns the files in it
+        found = []
+        try:
+            self.backend.add(directory)
+            entries = list(os.scandir(directory))
+        except OSError as exc:
+            print(f"watch: {exc}", file=sys.stderr)
+            return found
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if self.recursive:
+                    found.extend(self.scan(entry.path))
+            elif entry.is_file():
+                found.append(entry.path)
+        return found
+
+
+    def run(self):
+        candidates = [path for directory in self.directories for path in self.scan(directory)]
+        while not self.stopped.is_set():
+            for path in candidates:
+                if os.path.isdir(path):
+                    if self.recursive:
+                        self.note(self.scan(path))
+                else:
+                    self.note([path])
+            self.release()
+            changed = self.backend.wait(min(self.settle, 1.0))
+            if changed is None:
+                candidates = [path for directory in self.directories for path in self.scan(directory)]
+                found = set(candidates)
+                for path in list(self.queued):
+                    if path not in found:
+                        self.queued.pop(path, None)
+            else:
+                candidates = changed
+        self.backend.close()
+
+
+    def note(self, paths):
+        for path in paths:
+            if path in self.pending:
+                continue
+            signature = self.signature(path)
+            if signature is None:
+                self.queued.pop(path, None)
+            elif self.queued.get(path) != signature:
+                self.pending[path] = signature + (time.monotonic(),)
+
+
+    def signature(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns)
+
+
+    def release(self):
+        # queues the pending files that stopped changing
+        now = time.monotonic()
+        for path, (size, mtime_ns, since) in list(self.pending.items()):
+            signature = self.signature(path)
+            if signature is None:
+                del self.pending[path]
+            elif signature != (size, mtime_ns):
+                self.pending[path] = signature + (now,)
+            elif now - since >= self.settle:
+                del self.pending[path]
+                if self.accept(path):
+                    self.queued[path] = signature
+                    if not self.put(path):
+                        return
+
+
+    def put(self, path):
+        # blocks while the queue is full, returns False when stopped
+        while not self.stopped.is_set():
+            try:
+                self.files.put(path, timeout=1.0)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+    def done(self, path):
+        # called from the worker thread once the track of path is stemmed
+        self.queued.pop(path, None)
+
+
+    def stop(self):
+        self.stopped.set()
+
+
+class WatchDaemon:
+    """Stems the files a FolderWatcher finds with one resident StemGen.
+
+    The worker takes up to batch_size queued files at a time, so the model is
+    loaded once and a burst of new files goes through the normal pipeline.
+    Separator worker processes, if any, are kept until the daemon stops.
+    """
+
+    def __init__(self, stemgen, directories, settle=5.0, recursive=True, queue_size=8, batch_size=4, poll_interval=10.0):
+        self.stemgen = stemgen
+        self.batch_size = batch_size
+        self.files = queue.Queue(maxsize=queue_size)
+        self.watcher = FolderWatcher(directories, self.accept, self.files, settle, recursive, poll_interval)
+
+
+    def accept(self, path):
+        name, extension = os.path.splitext(path)
+        if extension not in self.stemgen.supported_files or path.endswith(".stem.m4a"):
+            return False
+        # StemGen's own work files, in <dir>/<track name>/ next to the track
+        work_directory = os.path.dirname(path)
+        if any(os.path.isfile(work_directory + supported) for supported in self.stemgen.supported_files):
+            return False
+        stem = name + ".stem.m4a"
+        if not os.path.isfile(stem):
+            return True
+        # with overwrite_existing, only a track changed since its stem was made:
+        # a done track is no longer in queued and would come back on every scan
+        return self.stemgen.overwrite_existing and os.path.getmtime(stem) < os.path.getmtime(path)
+
+
+    def track_result(self, result):
+        if result["status"] in ("processed", "skipped"):
+            self.watcher.done(result["track"])
+
+
+    def run(self):
+        watcher = threading.Thread(target=self.watcher.run, name="watcher", daemon=True)
+        watcher.start()
+        self.stemgen.keep_separator_pool = True
+        self.stemgen.track_result.connect(self.track_result)
+        try:
+            while not self.watcher.stopped.is_set():
+                try:
+                    batch = [self.files.get(timeout=1.0)]
+                except queue.Empty:
+                    continue
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.files.get_nowait())
+                    except queue.Empty:
+                        break
+                # counts and report are per batch
+                self.stemgen.clear_results()
+                self.stemgen.run(batch)
+        finally:
+            self.watcher.stop()
+            watcher.join()
+            self.stemgen.track_result.disconnect(self.track_result)
+            self.stemgen.close()
+
+
+    def stop(self):
+        self.watcher.stop()